@@ -0,0 +1,21 @@
+from django.apps import AppConfig
+from django.core.signals import request_finished
+from django.db.models.signals import post_delete, post_save
+
+
+class TaytayConfig(AppConfig):
+    name = 'taytay'
+
+    def ready(self):
+        from . import chains, pages, timing
+
+        song = self.get_model('Song')
+        post_save.connect(chains.song_saved, sender=song)
+        post_delete.connect(chains.song_deleted, sender=song)
+        user_song = self.get_model('UserSong')
+        post_save.connect(pages.song_saved, sender=user_song)
+        post_delete.connect(pages.song_deleted, sender=user_song)
+        album = self.get_model('Album')
+        post_save.connect(pages.album_changed, sender=album)
+        post_delete.connect(pages.album_changed, sender=album)
+        request_finished.connect(timing.request_finished)
@@ -0,0 +1,362 @@
+"""Load and dump song data with PostgreSQL ``COPY``.
+
+Songs are in the format returned by the Baelor API, either as a whole API
+response in a JSON file or as one song per line in a JSON lines file, and
+either may be compressed with gzip.
+"""
+import gzip
+import io
+import itertools
+import json
+
+from django.db import connection, transaction
+from django.utils.timezone import now
+
+from . import chains, fetch, models, pages, sync
+
+
+ALBUM_STAGING = '''
+CREATE TEMPORARY TABLE taytay_album_import (
+    slug varchar(255), title varchar(255), label varchar(255),
+    genres varchar(100)[], producers varchar(100)[]
+) ON COMMIT DROP
+'''
+
+SONG_STAGING = '''
+CREATE TEMPORARY TABLE taytay_song_import (
+    slug varchar(255), title varchar(255), album_slug varchar(255), lyrics text,
+    writers varchar(100)[], producers varchar(100)[], content_hash varchar(40)
+) ON COMMIT DROP
+'''
+
+UPDATE_ALBUMS = '''
+UPDATE taytay_album AS a
+SET title = i.title, label = i.label, genres = i.genres, producers = i.producers
+FROM taytay_album_import AS i
+WHERE a.slug = i.slug
+    AND (a.title, a.label, a.genres, a.producers)
+        IS DISTINCT FROM (i.title, i.label, i.genres, i.producers)
+RETURNING a.id
+'''
+
+INSERT_ALBUMS = '''
+INSERT INTO taytay_album (slug, title, label, genres, producers)
+SELECT i.slug, i.title, i.label, i.genres, i.producers
+FROM taytay_album_import AS i
+WHERE NOT EXISTS (SELECT 1 FROM taytay_album AS a WHERE a.slug = i.slug)
+RETURNING id
+'''
+
+# The old row joined in FROM still has the values from before the update
+UPDATE_SONGS = '''
+WITH changed AS (
+    UPDATE taytay_song AS s
+    SET title = i.title, album_id = a.id, lyrics = i.lyrics, writers = i.writers,
+        producers = i.producers, content_hash = i.content_hash
+    FROM taytay_song_import AS i, taytay_album AS a, taytay_song AS old
+    WHERE s.slug = i.slug AND a.slug = i.album_slug AND old.id = s.id
+        AND s.content_hash <> i.content_hash
+        AND (s.title, s.album_id, s.lyrics, s.writers, s.producers)
+            IS DISTINCT FROM (i.title, a.id, i.lyrics, i.writers, i.producers)
+    RETURNING old.album_id AS old_album_id, s.album_id
+)
+SELECT old_album_id, album_id, count(*) FROM changed GROUP BY old_album_id, album_id
+'''
+
+# Songs with the same content but a hash from before it was last changed
+UPDATE_HASHES = '''
+UPDATE taytay_song AS s
+SET content_hash = i.content_hash
+FROM taytay_song_import AS i
+WHERE s.slug = i.slug AND s.content_hash <> i.content_hash
+'''
+
+INSERT_SONGS = '''
+WITH created AS (
+    INSERT INTO taytay_song (slug, title, album_id, lyrics, writers, producers, content_hash)
+    SELECT i.slug, i.title, a.id, i.lyrics, i.writers, i.producers, i.content_hash
+    FROM taytay_song_import AS i JOIN taytay_album AS a ON a.slug = i.album_slug
+    WHERE NOT EXISTS (SELECT 1 FROM taytay_song AS s WHERE s.slug = i.slug)
+    RETURNING album_id
+)
+SELECT album_id, count(*) FROM created GROUP BY album_id
+'''
+
+# Written by PostgreSQL as one JSON object per line. CSV with delimiter and
+# quote characters which can't appear in JSON text leaves the lines unescaped.
+EXPORT_SONGS = '''
+COPY (
+    SELECT json_build_object(
+        'slug', s.slug,
+        'title', s.title,
+        'writers', s.writers,
+        'producers', s.producers,
+        'album', json_build_object(
+            'slug', a.slug, 'name', a.title, 'label', a.label,
+            'genres', a.genres, 'producers', a.producers),
+        'lyrics', (
+            SELECT coalesce(json_agg(json_build_object('content', line) ORDER BY n), '[]')
+            FROM unnest(string_to_array(s.lyrics, E'\\n')) WITH ORDINALITY AS l(line, n))
+    )
+    FROM taytay_song AS s JOIN taytay_album AS a ON a.id = s.album_id
+    ORDER BY s.id
+) TO STDOUT WITH (FORMAT csv, DELIMITER E'\\x02', QUOTE E'\\x01')
+'''
+
+
+def array_literal(values):
+    """PostgreSQL array literal of strings."""
+    return '{{{}}}'.format(','.join(
+        '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"')) for value in values))
+
+
+def copy_text(value):
+    """Value in the ``COPY`` text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, list):
+        value = array_literal(value)
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r').replace(
+        '\t', '\\t')
+
+
+class CopyReader(io.TextIOBase):
+    """File to ``COPY`` rows from, formatting them as they are read."""
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+        self.error = None
+
+    def readable(self):
+        return True
+
+    def readline(self, size=-1):
+        if self.buffer:
+            line, _, self.buffer = self.buffer.partition('\n')
+            return line + '\n'
+        try:
+            row = next(self.rows, None)
+        except Exception as e:
+            # psycopg2 replaces errors from read() with its own
+            self.error = e
+            raise
+        if row is None:
+            return ''
+        return '\t'.join(copy_text(value) for value in row) + '\n'
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        self.buffer = ''
+        while size < 0 or length < size:
+            line = self.readline()
+            if not line:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = ''.join(chunks)
+        if size < 0:
+            self.buffer = ''
+            return data
+        data, self.buffer = data[:size], data[size:]
+        return data
+
+
+def copy_rows(cursor, sql, rows):
+    """Run a ``COPY ... FROM STDIN`` of rows, raising any error from reading them."""
+    reader = CopyReader(rows)
+    try:
+        cursor.copy_expert(sql, reader)
+    except Exception:
+        if reader.error is not None:
+            raise reader.error
+        raise
+
+
+def copy_user_songs(songs):
+    """Save songs from ``(title, slug, lyrics)`` tuples with ``COPY``.
+
+    ``COPY`` doesn't send the signals which discard the cached song list, so
+    it's discarded afterwards.
+    """
+    created = now().isoformat()
+    with transaction.atomic(), connection.cursor() as cursor:
+        copy_rows(
+            cursor, 'COPY taytay_usersong (title, slug, lyrics, preview, created_date) '
+            'FROM STDIN',
+            ((title, slug, lyrics, models.make_preview(lyrics), created)
+             for title, slug, lyrics in songs))
+        cursor.execute('ANALYZE taytay_usersong')
+    pages.invalidate_list()
+
+
+def delete_user_songs(condition, params=()):
+    """Delete the user songs matching an SQL condition with one ``DELETE``.
+
+    Deleting a queryset loads every song with its lyrics to send its
+    ``post_delete`` signal, which discards its pages one song at a time. The
+    cached pages are discarded once here instead. Returns the number of songs
+    deleted.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('DELETE FROM taytay_usersong WHERE ' + condition, params)
+        deleted = cursor.rowcount
+        if deleted:
+            pages.invalidate_songs()
+    return deleted
+
+
+class JSONLinesWriter(io.TextIOBase):
+    """File to ``COPY`` JSON lines to, writing them out as JSON lines or a JSON response."""
+
+    def __init__(self, output, as_response=False):
+        self.output = output
+        self.as_response = as_response
+        self.count = 0
+        self._partial = ''
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            if self.as_response:
+                self.output.write('{}\n{}'.format('[' if not self.count else ',', line))
+            else:
+                self.output.write(line + '\n')
+            self.count += 1
+        return len(data)
+
+    def start(self):
+        if self.as_response:
+            self.output.write('{"error": null, "success": true, "result": ')
+
+    def finish(self):
+        if self.as_response:
+            self.output.write('{}]}}\n'.format('' if self.count else '['))
+
+
+def dump_format(path, format=None):
+    """The format of a dump, 'json' or 'jsonl', from its file name if not given."""
+    if format:
+        return format
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'json' if name.endswith('.json') else 'jsonl'
+
+
+def open_dump(path, mode='rb'):
+    """Open a dump file, decompressing it if its name ends with .gz."""
+    encoding = 'utf-8' if 't' in mode else None
+    if path.endswith('.gz'):
+        # The default level 9 is several times slower for little gain
+        return gzip.open(path, mode, compresslevel=6, encoding=encoding)
+    return open(path, mode, encoding=encoding)
+
+
+def read_dump(path, format=None):
+    """Yield the songs in a dump file."""
+    with open_dump(path, 'rb') as f:
+        if dump_format(path, format) == 'json':
+            chunks = iter(lambda: f.read(fetch.CHUNK_SIZE), b'')
+            for song in fetch.iter_results(chunks):
+                yield song
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+
+
+class ImportSummary(object):
+
+    def __init__(self):
+        self.staged = 0
+        self.duplicates = 0
+        self.created = 0
+        self.changed = 0
+        self.albums_created = 0
+        self.albums_changed = 0
+
+    @property
+    def unchanged(self):
+        return self.staged - self.created - self.changed
+
+
+def import_songs(songs):
+    """Load songs into the database with ``COPY`` and merge them in one transaction.
+
+    Songs are copied into temporary tables as they are read, then new songs
+    are inserted and changed songs updated with one statement each. Songs
+    with the same slug as an earlier song are skipped. The saved chains of
+    the albums with changed songs are rebuilt afterwards.
+    """
+    summary = ImportSummary()
+    albums = {}
+    seen = set()
+
+    def song_rows():
+        for song in songs:
+            if song['slug'] in seen:
+                summary.duplicates += 1
+                continue
+            seen.add(song['slug'])
+            album_slug, album_info, info = sync.parse_song(song)
+            albums.setdefault(album_slug, album_info)
+            summary.staged += 1
+            yield (
+                song['slug'], info['title'], album_slug, info['lyrics'], info['writers'],
+                info['producers'], sync.song_hash(album_slug, info))
+
+    with transaction.atomic(), chains.suspend_updates(), connection.cursor() as cursor:
+        cursor.execute(SONG_STAGING)
+        copy_rows(
+            cursor, 'COPY taytay_song_import (slug, title, album_slug, lyrics, writers, '
+            'producers, content_hash) FROM STDIN', song_rows())
+        cursor.execute(ALBUM_STAGING)
+        copy_rows(
+            cursor, 'COPY taytay_album_import (slug, title, label, genres, producers) FROM STDIN',
+            ((slug, info['title'], info['label'], info['genres'], info['producers'])
+             for slug, info in albums.items()))
+        cursor.execute('ANALYZE taytay_song_import')
+        cursor.execute(UPDATE_ALBUMS)
+        touched = set(album_id for album_id, in cursor.fetchall())
+        summary.albums_changed = len(touched)
+        cursor.execute(INSERT_ALBUMS)
+        summary.albums_created = cursor.rowcount
+        if summary.albums_created or summary.albums_changed:
+            pages.invalidate_albums()
+        cursor.execute(UPDATE_SONGS)
+        for old_album_id, album_id, count in cursor.fetchall():
+            touched.update([old_album_id, album_id])
+            summary.changed += count
+        cursor.execute(UPDATE_HASHES)
+        cursor.execute(INSERT_SONGS)
+        for album_id, count in cursor.fetchall():
+            touched.add(album_id)
+            summary.created += count
+        titles = []
+        if touched:
+            cursor.execute('SELECT title FROM taytay_album WHERE id = ANY(%s)', [list(touched)])
+            titles = [title for title, in cursor.fetchall()]
+        # Dropped on commit, but the transaction may be nested in another one
+        cursor.execute('DROP TABLE taytay_song_import, taytay_album_import')
+    chains.rebuild_albums(titles)
+    return summary
+
+
+def import_dumps(paths, format=None):
+    """Import the songs from dump files in one transaction."""
+    return import_songs(itertools.chain.from_iterable(
+        read_dump(path, format) for path in paths))
+
+
+def export_songs(output, format='jsonl'):
+    """Write every song to a text file and return how many were written."""
+    writer = JSONLinesWriter(output, as_response=format == 'json')
+    writer.start()
+    with connection.cursor() as cursor:
+        cursor.copy_expert(EXPORT_SONGS, writer)
+    writer.finish()
+    return writer.count
@@ -0,0 +1,546 @@
+import bisect
+import collections
+import contextlib
+import itertools
+import os
+import random
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, Max
+from django.utils.text import slugify
+
+import markovify
+
+from . import compact, markov, models
+
+
+VERSION_KEY = 'taytay:chains:version'
+
+# Share of the lines of a saved chain changed by a sync past which the chain
+# is rebuilt, since decoding and updating it would take longer
+REBUILD_SHARE = 0.25
+
+
+class LyricsChain(markovify.Chain):
+    """Markov chain built one run at a time instead of from a whole corpus.
+
+    The next words of each state are ordered like the compact encoding, so
+    the same random numbers walk the same path through either chain.
+    """
+
+    def __init__(self, state_size, model=None):
+        self.state_size = state_size
+        self.model = {} if model is None else model
+        self._compiled = {}
+
+    def compile(self, state):
+        """Sorted next words of a state with their cumulative weights."""
+        try:
+            return self._compiled[state]
+        except KeyError:
+            follow = sorted(self.model[state].items(), key=lambda item: markov.word_order(item[0]))
+            words = [word for word, _ in follow]
+            cumulative = list(itertools.accumulate(count for _, count in follow))
+            self._compiled[state] = words, cumulative
+            return words, cumulative
+
+    def move(self, state, rng=random):
+        """Given a state, choose the next word at random."""
+        words, cumulative = self.compile(state)
+        r = rng.random() * cumulative[-1]
+        return words[bisect.bisect(cumulative, r)]
+
+    def walk(self, init_state=None, rng=random):
+        """Return a list of words for a single run of the chain."""
+        state = init_state or (markovify.chain.BEGIN, ) * self.state_size
+        words = []
+        while True:
+            word = self.move(state, rng)
+            if word == markovify.chain.END:
+                break
+            words.append(word)
+            state = tuple(state[1:]) + (word, )
+        return words
+
+    def add(self, run):
+        """Count the transitions of a run of words."""
+        items = ([markovify.chain.BEGIN] * self.state_size) + run + [markovify.chain.END]
+        for i in range(len(run) + 1):
+            state = tuple(items[i:i + self.state_size])
+            follow = self.model.setdefault(state, {})
+            word = items[i + self.state_size]
+            follow[word] = follow.get(word, 0) + 1
+            self._compiled.pop(state, None)
+
+    def remove(self, run):
+        """Subtract the transitions of a run of words added earlier."""
+        items = ([markovify.chain.BEGIN] * self.state_size) + run + [markovify.chain.END]
+        for i in range(len(run) + 1):
+            state = tuple(items[i:i + self.state_size])
+            follow = self.model.get(state, {})
+            word = items[i + self.state_size]
+            count = follow.get(word, 0) - 1
+            self._compiled.pop(state, None)
+            if count > 0:
+                follow[word] = count
+            else:
+                follow.pop(word, None)
+                if not follow:
+                    self.model.pop(state, None)
+
+
+class LineCounter(collections.Counter, collections.OrderedDict):
+    """Counts of lines in the order they were first added.
+
+    The order keeps the source text, and so the chain version, the same in
+    every process.
+    """
+
+
+class LyricsText(markov.SeededText):
+    """Lyrics text fed one song at a time.
+
+    Songs are split into lines separately so the last line of one song isn't
+    run into the first line of the next. The source lines are counted rather
+    than listed, so the lines of a song can be taken out again without
+    searching them all. Repeated lines are grouped in the source text.
+    """
+
+    def __init__(self, state_size=2, model=None, sentences=None):
+        self.chain = LyricsChain(state_size, model=model)
+        self._sentences = LineCounter(sentences or ())
+        self._rejoined_text = None
+        # Songs in the corpus when the chain was built, unknown once it's changed
+        self.fingerprint = None
+
+    @classmethod
+    def from_compact(cls, lyrics_generator):
+        """Unpack a compact chain so songs can be added and removed."""
+        text = str(lyrics_generator.rejoined_text)
+        return cls(
+            state_size=lyrics_generator.chain.state_size,
+            model=lyrics_generator.chain.to_model(),
+            sentences=text.split('\n') if text else [])
+
+    def sentence_join(self, sentences):
+        return '\n'.join(sentences)
+
+    def add(self, lyrics):
+        """Add the lines of a song to the chain."""
+        for run in self.generate_corpus(lyrics):
+            self.chain.add(run)
+            self._sentences[self.word_join(run)] += 1
+        self._rejoined_text = None
+        self._version = None
+        self.fingerprint = None
+
+    def remove(self, lyrics):
+        """Take the lines of a song added earlier out of the chain."""
+        for run in self.generate_corpus(lyrics):
+            self.chain.remove(run)
+            line = self.word_join(run)
+            if self._sentences[line] > 1:
+                self._sentences[line] -= 1
+            else:
+                self._sentences.pop(line, None)
+        self._rejoined_text = None
+        self._version = None
+        self.fingerprint = None
+
+    def apply_delta(self, removed=None, added=None):
+        """Replace the lyrics of a song, either of which may be None."""
+        if removed is not None:
+            self.remove(removed)
+        if added is not None:
+            self.add(added)
+
+    @property
+    def rejoined_text(self):
+        if self._rejoined_text is None:
+            self._rejoined_text = self.sentence_join(self._sentences.elements())
+        return self._rejoined_text
+
+
+def stream_values(queryset, chunk_size=2000):
+    """Iterate over the rows of a values_list queryset using a server-side cursor.
+
+    Only ``chunk_size`` rows are held in memory at a time rather than the
+    whole result set.
+    """
+    sql, params = queryset.query.sql_with_params()
+    with transaction.atomic():
+        connection.ensure_connection()
+        name = 'taytay_{}'.format(uuid.uuid4().hex)
+        with connection.connection.cursor(name=name) as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute(sql, params)
+            for row in cursor:
+                yield row
+
+
+def lyrics_queryset(album=None):
+    """Lyrics of the songs of an album or of every album, in the order they were added."""
+    qs = models.Song.objects.order_by('pk')
+    if album is not None:
+        qs = qs.filter(album__title=album)
+    return qs.values_list('lyrics')
+
+
+def corpus_fingerprint(album=None):
+    """Number of songs and the highest song id of an album or of every album.
+
+    Saved chains keep the fingerprint of the songs they were built from, so
+    songs written without updating the chains, such as by ``loaddata`` or by
+    restoring the database, are noticed when the chains are loaded. Lyrics
+    changed in place by raw SQL don't change it.
+    """
+    qs = models.Song.objects.all()
+    if album is not None:
+        qs = qs.filter(album__title=album)
+    result = qs.aggregate(songs=Count('id'), last_song=Max('id'))
+    return result['songs'], result['last_song'] or 0
+
+
+def build_chain(album=None):
+    """Build a Markov chain from the lyrics of an album or of every album."""
+    lyrics_generator = LyricsText(state_size=2)
+    # Taken first, so songs added while building make the chain look stale
+    fingerprint = corpus_fingerprint(album)
+    for lyrics, in stream_values(lyrics_queryset(album)):
+        lyrics_generator.add(lyrics)
+    lyrics_generator.fingerprint = fingerprint
+    return lyrics_generator
+
+
+def artifact_path(album=None):
+    """Location of the saved chain for an album or for all albums."""
+    if album is None:
+        name = 'all'
+    else:
+        name = 'album-{}'.format(slugify(album))
+    return os.path.join(settings.MARKOV_MODEL_ROOT, '{}.chain'.format(name))
+
+
+def save_chain(lyrics_generator, album=None):
+    """Write a built chain to MARKOV_MODEL_ROOT and return its path.
+
+    Chains updated in place are saved with the fingerprint of the songs now
+    in the database, since they are updated after the changes are committed.
+    """
+    path = artifact_path(album)
+    fingerprint = lyrics_generator.fingerprint
+    if fingerprint is None:
+        fingerprint = corpus_fingerprint(album)
+    compact.save(
+        path, lyrics_generator.chain.model, lyrics_generator.chain.state_size,
+        lyrics_generator.rejoined_text, album=album, fingerprint=fingerprint)
+    return path
+
+
+def read_chain(path):
+    """Map a saved chain, returning None if it was saved in another format."""
+    try:
+        return compact.load(path)
+    except ValueError:
+        return None
+
+
+def read_current_chain(album=None):
+    """Map the saved chain for the album, or return None if it's missing or out of date."""
+    try:
+        lyrics_generator = read_chain(artifact_path(album))
+    except FileNotFoundError:
+        return None
+    if lyrics_generator is None or lyrics_generator.fingerprint != corpus_fingerprint(album):
+        return None
+    return lyrics_generator
+
+
+def load_chain(album=None):
+    """Load the saved chain for the album, falling back to building it."""
+    lyrics_generator = read_current_chain(album)
+    if lyrics_generator is None:
+        lyrics_generator = build_chain(album)
+    return lyrics_generator
+
+
+def stale_artifacts():
+    """Albums, with None for all albums, whose saved chain is missing or out of date."""
+    albums = models.Album.objects.order_by('title').values_list('title', flat=True)
+    return [album for album in [None] + list(albums) if read_current_chain(album) is None]
+
+
+def build_artifacts():
+    """Build and save the chains for all albums and each album."""
+    os.makedirs(settings.MARKOV_MODEL_ROOT, exist_ok=True)
+    albums = models.Album.objects.order_by('title').values_list('title', flat=True)
+    paths = []
+    for album in [None] + list(albums):
+        paths.append(save_chain(build_chain(album), album))
+    invalidate()
+    return paths
+
+
+def version_key(album=None):
+    if album is None:
+        return '{}:all'.format(VERSION_KEY)
+    return '{}:album:{}'.format(VERSION_KEY, slugify(album))
+
+
+def current_version(album=None):
+    """Versions of all chains and of the chain for one album from the Django cache."""
+    keys = [VERSION_KEY, version_key(album)]
+    versions = cache.get_many(keys)
+    return tuple(versions.get(key) for key in keys)
+
+
+class ChainCache(object):
+    """Least recently used cache of built Markov chains keyed by album.
+
+    The ``None`` key holds the chain built from all albums. The versions stored
+    in the Django cache are checked on every lookup so that a process sharing
+    the cache backend can invalidate the chains held by the others.
+    """
+
+    def __init__(self, build, max_size):
+        self.build = build
+        self.max_size = max_size
+        self._chains = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, album):
+        return album in self._chains
+
+    def __len__(self):
+        return len(self._chains)
+
+    def get(self, album=None):
+        """Return the chain for the album, building it if needed."""
+        version = current_version(album)
+        with self._lock:
+            if album in self._chains:
+                chain_version, chain = self._chains[album]
+                if chain_version == version:
+                    self._chains.move_to_end(album)
+                    return chain
+                del self._chains[album]
+        chain = self.build(album)
+        self.set(album, chain, version=version)
+        return chain
+
+    def set(self, album, chain, version=None):
+        """Store a chain that was built elsewhere."""
+        if version is None:
+            version = current_version(album)
+        with self._lock:
+            self._chains[album] = (version, chain)
+            self._chains.move_to_end(album)
+            while len(self._chains) > self.max_size:
+                self._chains.popitem(last=False)
+
+    def discard(self, album=None):
+        """Drop the chain for one album held by this process."""
+        with self._lock:
+            self._chains.pop(album, None)
+
+    def clear(self):
+        """Drop every chain held by this process."""
+        with self._lock:
+            self._chains.clear()
+
+
+chain_cache = ChainCache(load_chain, max_size=settings.MARKOV_CACHE_SIZE)
+
+
+def preload():
+    """Fill the cache with every chain saved in MARKOV_MODEL_ROOT which is up to date.
+
+    Out of date chains are left to be built when they are first used.
+    """
+    root = settings.MARKOV_MODEL_ROOT
+    if not os.path.isdir(root):
+        return
+    try:
+        for name in sorted(os.listdir(root)):
+            if name.endswith('.chain'):
+                lyrics_generator = read_chain(os.path.join(root, name))
+                album = None if lyrics_generator is None else lyrics_generator.chain.album
+                if lyrics_generator is not None and (
+                        lyrics_generator.fingerprint == corpus_fingerprint(album)):
+                    chain_cache.set(album, lyrics_generator)
+    finally:
+        # The web processes are forked after preloading and mustn't share the
+        # connection used to check the chains
+        if not connection.in_atomic_block:
+            connection.close()
+
+
+def invalidate():
+    """Discard the built chains in this and every other process."""
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+    chain_cache.clear()
+
+
+def invalidate_album(album=None):
+    """Discard the chain for one album, or for all albums, in every process."""
+    cache.set(version_key(album), uuid.uuid4().hex, None)
+    chain_cache.discard(album)
+
+
+def changed_share(lyrics_generator, changes):
+    """Lines of the changed lyrics as a share of the lines of a saved chain."""
+    lines = bytes(lyrics_generator.rejoined_text.data()).count(b'\n') + 1
+    changed = sum(
+        lyrics.count('\n') + 1 for change in changes for lyrics in change if lyrics is not None)
+    return changed / lines
+
+
+def apply_deltas(deltas):
+    """Update the saved chains for the songs that changed.
+
+    ``deltas`` is a list of ``(album, removed, added)`` tuples with the old
+    and new lyrics of a song, either of which may be None. Each is applied to
+    the chain for its album and to the chain for all albums. Saved chains are
+    updated in place rather than rebuilt, and the affected albums are
+    invalidated so every process reloads them. Chains with more than
+    ``REBUILD_SHARE`` of their lines changed are rebuilt instead.
+    """
+    changes = collections.OrderedDict()
+    for album, removed, added in deltas:
+        for key in (album, None):
+            changes.setdefault(key, []).append((removed, added))
+    saved = os.path.isdir(settings.MARKOV_MODEL_ROOT)
+    for album, album_changes in changes.items():
+        if saved:
+            try:
+                lyrics_generator = read_chain(artifact_path(album))
+            except FileNotFoundError:
+                lyrics_generator = None
+            if lyrics_generator is None or changed_share(
+                    lyrics_generator, album_changes) > REBUILD_SHARE:
+                # No usable saved chain to update, such as for a new album, or
+                # so much of it changed that rebuilding is faster
+                lyrics_generator = build_chain(album)
+            else:
+                lyrics_generator = LyricsText.from_compact(lyrics_generator)
+                for removed, added in album_changes:
+                    lyrics_generator.apply_delta(removed, added)
+            save_chain(lyrics_generator, album)
+        invalidate_album(album)
+
+
+def rebuild_albums(albums):
+    """Rebuild the saved chains for albums, and for all albums, from the database."""
+    if not albums:
+        return
+    saved = os.path.isdir(settings.MARKOV_MODEL_ROOT)
+    for album in list(albums) + [None]:
+        if saved:
+            save_chain(build_chain(album), album)
+        invalidate_album(album)
+
+
+def discard_albums(albums):
+    """Delete the saved chains for deleted albums and rebuild the chain for all albums."""
+    if not albums:
+        return
+    for album in albums:
+        try:
+            os.remove(artifact_path(album))
+        except FileNotFoundError:
+            pass
+        invalidate_album(album)
+    if os.path.isdir(settings.MARKOV_MODEL_ROOT):
+        save_chain(build_chain(), None)
+    invalidate_album(None)
+
+
+_updates = threading.local()
+
+
+@contextlib.contextmanager
+def suspend_updates():
+    """Ignore song signals while a sync applies its own deltas."""
+    _updates.suspended = True
+    try:
+        yield
+    finally:
+        _updates.suspended = False
+
+
+class PendingChanges(object):
+    """Changes to the chains made by the songs saved in one transaction.
+
+    They are applied together once the transaction commits, so a rolled back
+    transaction leaves the saved chains alone and an album changed by several
+    songs is updated or rebuilt once.
+    """
+
+    def __init__(self):
+        self.deltas = []
+        # Albums with songs changed in place, whose previous lyrics are gone
+        self.rebuild = set()
+        self.invalidate = False
+
+    def apply(self):
+        if getattr(_updates, 'pending', None) is self:
+            _updates.pending = None
+        if self.invalidate:
+            invalidate()
+        if self.rebuild:
+            # Deltas for the other albums are rebuilt with them, since the
+            # chain for all albums is rebuilt anyway
+            rebuild_albums(self.rebuild.union(album for album, _, _ in self.deltas))
+        else:
+            apply_deltas(self.deltas)
+
+
+def pending_changes():
+    """Changes waiting for the current transaction, and whether they are new.
+
+    Changes whose callback is no longer registered, because their transaction
+    was rolled back, are dropped.
+    """
+    pending = getattr(_updates, 'pending', None)
+    if pending is not None and connection.in_atomic_block and any(
+            func == pending.apply for _, func in connection.run_on_commit):
+        return pending, False
+    pending = _updates.pending = PendingChanges()
+    return pending, True
+
+
+def defer(deltas=(), rebuild=(), invalidate_all=False):
+    """Apply changes to the chains once the current transaction commits."""
+    pending, new = pending_changes()
+    pending.deltas.extend(deltas)
+    pending.rebuild.update(rebuild)
+    pending.invalidate = pending.invalidate or invalidate_all
+    if new:
+        transaction.on_commit(pending.apply)
+
+
+def song_saved(sender, instance, created, **kwargs):
+    """Signal handler to add new songs to the chains or rebuild changed ones."""
+    if getattr(_updates, 'suspended', False):
+        return
+    if created:
+        defer(deltas=[(instance.album.title, None, instance.lyrics)])
+    else:
+        # The previous lyrics are gone so the album has to be rebuilt
+        defer(rebuild=[instance.album.title])
+
+
+def song_deleted(sender, instance, **kwargs):
+    """Signal handler to take deleted songs out of the chains."""
+    if getattr(_updates, 'suspended', False):
+        return
+    try:
+        album = instance.album.title
+    except models.Album.DoesNotExist:
+        defer(invalidate_all=True)
+    else:
+        defer(deltas=[(album, instance.lyrics, None)])
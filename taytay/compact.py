@@ -0,0 +1,251 @@
+"""Compact read-only encoding of Markov chains.
+
+Words are interned as integer ids and the states, transitions and cumulative
+weights are stored in flat arrays so a saved chain can be ``mmap``ed and used
+without unpacking it. Every process mapping the same file shares one copy of
+the chain in the page cache.
+
+The header also holds the number of songs and the highest song id of the
+corpus the chain was built from, to tell when it's out of date.
+
+Layout, after the header, with each section padded to four bytes:
+
+- album title (UTF-8)
+- word offsets into the vocabulary, ``vocab_size + 1`` unsigned ints
+- vocabulary (UTF-8), ids 0 and 1 are the begin and end markers
+- states, ``state_count * state_size`` word ids sorted lexicographically
+- state offsets into the transitions, ``state_count + 1`` unsigned ints
+- next word ids, ``transition_count`` unsigned ints
+- cumulative weights, ``transition_count`` unsigned ints
+- source text used to reject sentences copied from the lyrics (UTF-8)
+"""
+import array
+import bisect
+import mmap
+import os
+import random
+import struct
+import sys
+
+import markovify
+
+from . import markov
+
+
+FORMAT_VERSION = 3
+
+MAGIC = b'TAYCHAIN'
+
+HEADER = struct.Struct('=8sIcx?xIIIIIIIIQ')
+
+BEGIN_ID, END_ID = 0, 1
+
+
+def _uints(values=()):
+    uints = array.array('I', values)
+    assert uints.itemsize == 4
+    return uints
+
+
+def _pad(data):
+    return data + b'\0' * (-len(data) % 4)
+
+
+def encode(model, state_size, text, album=None, fingerprint=(0, 0)):
+    """Encode a markovify chain model and its source text as bytes.
+
+    The fingerprint is the number of songs and the highest song id of the corpus.
+    """
+    words = set()
+    for state, follow in model.items():
+        words.update(state)
+        words.update(follow)
+    words.difference_update([markovify.chain.BEGIN, markovify.chain.END])
+    vocab = [markovify.chain.BEGIN, markovify.chain.END] + sorted(words)
+    ids = dict((word, i) for i, word in enumerate(vocab))
+
+    rows = sorted((tuple(ids[word] for word in state), follow) for state, follow in model.items())
+    states, state_offsets, next_ids, cumulative = _uints(), _uints([0]), _uints(), _uints()
+    for state, follow in rows:
+        states.extend(state)
+        total = 0
+        for next_id, count in sorted((ids[word], count) for word, count in follow.items()):
+            total += count
+            next_ids.append(next_id)
+            cumulative.append(total)
+        state_offsets.append(len(next_ids))
+
+    encoded_words = [word.encode('utf-8') for word in vocab]
+    word_offsets = _uints([0])
+    for word in encoded_words:
+        word_offsets.append(word_offsets[-1] + len(word))
+    vocab_data = b''.join(encoded_words)
+    album_data = (album or '').encode('utf-8')
+    text_data = text.encode('utf-8')
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, sys.byteorder[0].encode('ascii'), album is not None,
+        state_size, len(vocab), len(rows), len(next_ids),
+        len(album_data), len(vocab_data), len(text_data), fingerprint[0], fingerprint[1])
+    return b''.join([
+        header, _pad(album_data), word_offsets.tobytes(), _pad(vocab_data),
+        states.tobytes(), state_offsets.tobytes(), next_ids.tobytes(), cumulative.tobytes(),
+        text_data,
+    ])
+
+
+class MappedText(object):
+    """Source text left in the mapped buffer, searched without decoding it."""
+
+    def __init__(self, buf, start, end):
+        self.buf = buf
+        self.start = start
+        self.end = end
+
+    def __contains__(self, value):
+        return self.buf.find(value.encode('utf-8'), self.start, self.end) != -1
+
+    def __str__(self):
+        return bytes(self.data()).decode('utf-8')
+
+    def data(self):
+        """The encoded text without copying it."""
+        return memoryview(self.buf)[self.start:self.end]
+
+
+class CompactChain(object):
+    """Markov chain read from an encoded buffer.
+
+    Provides the parts of ``markovify.Chain`` used for generating sentences.
+    """
+
+    def __init__(self, buf):
+        (magic, version, byteorder, has_album, self.state_size, vocab_size, self.state_count,
+         transition_count, album_len, vocab_len, text_len,
+         songs, last_song) = HEADER.unpack_from(buf)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError('Unsupported chain format.')
+        if byteorder != sys.byteorder[0].encode('ascii'):
+            raise ValueError('Chain was saved with a different byte order.')
+        self.buf = buf
+        view = memoryview(buf)
+        offset = HEADER.size
+
+        def section(size, itemsize=4):
+            nonlocal offset
+            data = view[offset:offset + size * itemsize]
+            offset += size * itemsize + (-size * itemsize % 4)
+            return data
+
+        album = bytes(section(album_len, 1)).decode('utf-8')
+        self.album = album if has_album else None
+        self.fingerprint = (songs, last_song)
+        self._word_offsets = section(vocab_size + 1).cast('I')
+        self._vocab = section(vocab_len, 1)
+        self._vocab_size = vocab_size
+        self._states = section(self.state_count * self.state_size).cast('I')
+        self._state_offsets = section(self.state_count + 1).cast('I')
+        self._next_ids = section(transition_count).cast('I')
+        self._cumulative = section(transition_count).cast('I')
+        self.text = MappedText(buf, offset, offset + text_len)
+
+    def word(self, word_id):
+        """Look up a word by its id."""
+        start, end = self._word_offsets[word_id], self._word_offsets[word_id + 1]
+        return bytes(self._vocab[start:end]).decode('utf-8')
+
+    def word_id(self, word):
+        """Look up the id of a word."""
+        if word == markovify.chain.BEGIN:
+            return BEGIN_ID
+        if word == markovify.chain.END:
+            return END_ID
+        lo, hi = END_ID + 1, self._vocab_size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = self.word(mid)
+            if value < word:
+                lo = mid + 1
+            elif value > word:
+                hi = mid
+            else:
+                return mid
+        raise KeyError(word)
+
+    def state_index(self, state):
+        """Binary search the sorted states for a tuple of word ids."""
+        size = self.state_size
+        lo, hi = 0, self.state_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = tuple(self._states[mid * size:(mid + 1) * size].tolist())
+            if value < state:
+                lo = mid + 1
+            elif value > state:
+                hi = mid
+            else:
+                return mid
+        raise KeyError(state)
+
+    def move_id(self, state, rng=random):
+        """Given a state of word ids, choose the id of the next word at random."""
+        index = self.state_index(state)
+        start, end = self._state_offsets[index], self._state_offsets[index + 1]
+        r = rng.random() * self._cumulative[end - 1]
+        return self._next_ids[bisect.bisect(self._cumulative, r, start, end)]
+
+    def walk(self, init_state=None, rng=random):
+        """Return a list of words for a single run of the chain."""
+        if init_state is None:
+            state = (BEGIN_ID, ) * self.state_size
+        else:
+            state = tuple(self.word_id(word) for word in init_state)
+        word_ids = []
+        while True:
+            next_id = self.move_id(state, rng)
+            if next_id == END_ID:
+                break
+            word_ids.append(next_id)
+            state = state[1:] + (next_id, )
+        return [self.word(word_id) for word_id in word_ids]
+
+    def to_model(self):
+        """Decode the chain into a markovify model of word counts."""
+        words = [self.word(i) for i in range(self._vocab_size)]
+        size = self.state_size
+        model = {}
+        for index in range(self.state_count):
+            state = tuple(words[i] for i in self._states[index * size:(index + 1) * size])
+            follow = {}
+            previous = 0
+            for i in range(self._state_offsets[index], self._state_offsets[index + 1]):
+                follow[words[self._next_ids[i]]] = self._cumulative[i] - previous
+                previous = self._cumulative[i]
+            model[state] = follow
+        return model
+
+
+class CompactText(markov.SeededText):
+    """Lyrics text backed by a compact chain."""
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.rejoined_text = chain.text
+        self.fingerprint = chain.fingerprint
+
+    def source_data(self):
+        return self.rejoined_text.data()
+
+
+def save(path, model, state_size, text, album=None, fingerprint=(0, 0)):
+    """Encode a chain model and write it to path atomically."""
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb') as f:
+        f.write(encode(model, state_size, text, album=album, fingerprint=fingerprint))
+    os.replace(tmp_path, path)
+
+
+def load(path):
+    """Map a saved chain read-only and return its text."""
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return CompactText(CompactChain(buf))
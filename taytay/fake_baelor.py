@@ -0,0 +1,148 @@
+"""Local stand-in for the Baelor API, for tests and benchmarks."""
+import email.utils
+import hashlib
+import http.server
+import json
+import socketserver
+import threading
+import time
+import urllib.parse
+
+
+def make_song(slug, album, lyrics, title=None):
+    """Song in the format returned by the API."""
+    return {
+        'slug': slug,
+        'title': title or slug.replace('-', ' ').title(),
+        'writers': [],
+        'producers': [],
+        'album': {
+            'slug': album.lower().replace(' ', '-'),
+            'name': album,
+            'label': 'Big Machine',
+            'genres': [],
+            'producers': [],
+        },
+        'lyrics': [{'content': line} for line in lyrics.splitlines()],
+    }
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        api = self.server.api
+        api.requests.append((self.path, dict(self.headers)))
+        if api.latency:
+            time.sleep(api.latency)
+        if api.fail():
+            self.send_error(503)
+            return
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        page = int(query.get('page', [0])[0]) or None
+        per_page = int(query.get('per_page', [0])[0]) or None
+        try:
+            body, etag, last_modified = api.response(url.path, page=page, per_page=per_page)
+        except KeyError:
+            self.send_error(404)
+            return
+        if self.headers.get('If-None-Match') == etag or (
+                'If-None-Match' not in self.headers and
+                self.headers.get('If-Modified-Since') == last_modified):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class FakeBaelor(object):
+    """Serve songs like the Baelor API on a local port.
+
+    Songs are served from ``/api/v0/songs`` and the songs of one album from
+    ``/api/v0/albums/<slug>/songs``, in pages with the ``page`` and
+    ``per_page`` parameters. Responses have an ``ETag`` and ``Last-Modified``
+    header and conditional requests get a 304 until the songs are changed.
+
+    Each request is delayed by ``latency`` seconds and the next ``failures``
+    requests get a 503. Requests are recorded in ``requests`` as the path
+    and headers.
+    """
+
+    PATH = '/api/v0/'
+
+    def __init__(self, songs=(), latency=0, failures=0):
+        self.requests = []
+        self.latency = latency
+        self.failures = failures
+        self.set_songs(songs)
+        self.server = None
+        self._lock = threading.Lock()
+
+    def set_songs(self, songs):
+        self.songs = list(songs)
+        self.modified = time.time()
+
+    def fail(self):
+        """Whether to fail the current request."""
+        with self._lock:
+            if self.failures > 0:
+                self.failures -= 1
+                return True
+            return False
+
+    def songs_for(self, path):
+        """Songs served from a path, raising KeyError for an unknown path."""
+        parts = path[len(self.PATH):].strip('/').split('/')
+        if path.startswith(self.PATH) and parts == ['songs']:
+            return self.songs
+        if path.startswith(self.PATH) and len(parts) == 3 and parts[::2] == ['albums', 'songs']:
+            return [song for song in self.songs if song['album']['slug'] == parts[1]]
+        raise KeyError(path)
+
+    def response(self, path=PATH + 'songs', page=None, per_page=None):
+        """Body, ETag and Last-Modified header of the response for a path."""
+        songs = self.songs_for(path)
+        if per_page:
+            start = ((page or 1) - 1) * per_page
+            songs = songs[start:start + per_page]
+        body = json.dumps({'result': songs, 'error': None, 'success': True}).encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        return body, etag, email.utils.formatdate(self.modified, usegmt=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}{}'.format(self.server.server_address[1], self.PATH)
+
+    def start(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.api = self
+        thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,200 @@
+"""Fetch song data from the Baelor API over a shared, retrying session."""
+import codecs
+import collections
+import itertools
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+
+# Seconds to wait to connect and for each read
+TIMEOUT = (5, 30)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Bytes read from a streamed response at a time
+CHUNK_SIZE = 64 * 1024
+
+
+class FetchError(Exception):
+    """The API returned an error instead of songs."""
+
+
+def make_session(retries=3, backoff=0.5, pool_size=10):
+    """Session keeping connections alive and retrying failures with exponential backoff.
+
+    Failed connections and responses with a status in ``RETRY_STATUSES`` are
+    retried up to ``retries`` times, waiting ``backoff * 2 ** (n - 1)``
+    seconds before the nth retry.
+    """
+    retry = Retry(
+        total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+        method_whitelist=frozenset(['GET']))
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def songs_url(album=None):
+    """URL of the songs of one album or of every album."""
+    if album is None:
+        return '{}songs'.format(settings.BAELOR_API_URL)
+    return '{}albums/{}/songs'.format(settings.BAELOR_API_URL, album)
+
+
+def read_result(response):
+    """Songs from an API response, raising FetchError if it has an error."""
+    try:
+        data = response.json()
+    except ValueError:
+        response.raise_for_status()
+        raise FetchError('Invalid response from {}'.format(response.url))
+    if data['error']:
+        raise FetchError('Error fetching songs: {error}'.format(**data))
+    return data['result']
+
+
+def fetch_page(session, url, page, per_page, headers=None, timeout=TIMEOUT):
+    """Fetch one page of songs."""
+    response = session.get(
+        url, params={'page': page, 'per_page': per_page}, headers=headers, timeout=timeout)
+    return read_result(response)
+
+
+def fetch_pages(session, url, per_page, workers=4, first_page=1, headers=None, timeout=TIMEOUT):
+    """Fetch pages of songs concurrently and yield ``(page, songs)`` in page order.
+
+    Up to ``workers`` pages are requested ahead of the one being yielded.
+    Fetching stops at the first page with fewer than ``per_page`` songs.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        page = first_page
+        while True:
+            while len(pending) < workers:
+                pending.append((page, executor.submit(
+                    fetch_page, session, url, page, per_page, headers=headers, timeout=timeout)))
+                page += 1
+            current, future = pending.popleft()
+            try:
+                songs = future.result()
+            except Exception:
+                for _, later in pending:
+                    later.cancel()
+                raise
+            yield current, songs
+            if len(songs) < per_page:
+                for _, later in pending:
+                    later.cancel()
+                return
+
+
+class JSONStream(object):
+    """Read JSON values one at a time from chunks of UTF-8 encoded text.
+
+    Only the unparsed rest of the text is kept, so a large document can be
+    read without holding all of it in memory.
+    """
+
+    WHITESPACE = ' \t\n\r'
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.text = ''
+        self.pos = 0
+        self.done = False
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+
+    def read(self):
+        """Read the next chunk, returning False at the end of the text."""
+        if self.done:
+            return False
+        try:
+            chunk = self._decoder.decode(next(self.chunks))
+        except StopIteration:
+            chunk = self._decoder.decode(b'', final=True)
+            self.done = True
+        self.text = self.text[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """The next character after any whitespace, or '' at the end."""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.read():
+                return ''
+
+    def expect(self, chars):
+        """Consume and return the next character, which must be one of chars."""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expected one of {!r} but found {!r}'.format(chars, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode the next complete value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self.text, self.pos)
+            except ValueError:
+                if self.read():
+                    continue
+                raise
+            # A number at the end of the text may continue in the next chunk
+            if end == len(self.text) and self.read():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_results(chunks):
+    """Yield the songs of an API response as they are read from the body.
+
+    Raises FetchError if the response has an error.
+    """
+    stream = JSONStream(chunks)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key == 'result':
+            stream.expect('[')
+            if stream.peek() == ']':
+                stream.expect(']')
+            else:
+                while True:
+                    yield stream.value()
+                    if stream.expect(',]') == ']':
+                        break
+        else:
+            value = stream.value()
+            if key == 'error' and value:
+                raise FetchError('Error fetching songs: {}'.format(value))
+        if stream.expect(',}') == '}':
+            return
+
+
+def batches(iterable, size):
+    """Split an iterable into lists of up to size items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
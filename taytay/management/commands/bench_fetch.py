@@ -0,0 +1,68 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+import requests
+
+from ... import fake_baelor, fetch, synthetic
+
+
+class Command(BaseCommand):
+    help = 'Compare fetching songs page by page without a session and concurrently with one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--songs', type=int, default=5000, help='Songs served.')
+        parser.add_argument('--albums', type=int, default=10, help='Albums the songs are in.')
+        parser.add_argument('--lines', type=int, default=40, help='Lines per song.')
+        parser.add_argument('--per-page', type=int, default=100, help='Songs per page.')
+        parser.add_argument(
+            '--latency', type=float, default=0.05, help='Seconds added to each response.')
+        parser.add_argument(
+            '--failures', type=int, default=0, help='Requests failed with a 503 in each run.')
+        parser.add_argument(
+            '--workers', type=int, nargs='+', default=[1, 4, 8],
+            help='Numbers of pages fetched at once to measure.')
+
+    def handle(self, *args, **options):
+        # Don't log every connection
+        logging.getLogger('requests.packages.urllib3').setLevel(logging.WARNING)
+        corpus = synthetic.make_corpus(options['songs'], lines=options['lines'])
+        songs = [
+            fake_baelor.make_song(
+                'song-{}'.format(i), 'Album {}'.format(i % options['albums']), lyrics)
+            for i, lyrics in enumerate(corpus)
+        ]
+        with fake_baelor.FakeBaelor(songs, latency=options['latency']) as api:
+            url = '{}songs'.format(api.url)
+            self.stdout.write('mode\tworkers\trequests\tsongs\tseconds\tsongs/s')
+            runs = [('unpooled', 1)] + [('session', workers) for workers in options['workers']]
+            for mode, workers in runs:
+                api.requests = []
+                api.failures = options['failures']
+                start = time.perf_counter()
+                if mode == 'unpooled':
+                    count = self.fetch_unpooled(url, options['per_page'])
+                else:
+                    session = fetch.make_session(backoff=0.1, pool_size=workers)
+                    count = sum(len(page) for _, page in fetch.fetch_pages(
+                        session, url, options['per_page'], workers=workers))
+                elapsed = time.perf_counter() - start
+                self.stdout.write('\t'.join(map(str, [
+                    mode, workers, len(api.requests), count, '{:.2f}'.format(elapsed),
+                    '{:.0f}'.format(count / elapsed if elapsed else 0),
+                ])))
+
+    def fetch_unpooled(self, url, per_page):
+        """Fetch each page in turn with a new connection and no retries."""
+        count = 0
+        page = 1
+        while True:
+            response = requests.get(url, params={'page': page, 'per_page': per_page})
+            if response.status_code == 503:
+                continue
+            songs = fetch.read_result(response)
+            count += len(songs)
+            if len(songs) < per_page:
+                return count
+            page += 1
@@ -0,0 +1,162 @@
+import json
+import random
+import statistics
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import chains, synthetic
+from ...views import make_song, make_stanza, make_title
+
+
+# Measured for each corpus size. Lower is better for all of them.
+METRICS = (
+    'build_s', 'build_peak_kb', 'sentence_ms', 'sentence_p95_ms', 'walks_per_sentence',
+    'none_rate', 'stanza_ms', 'song_ms', 'song_p95_ms', 'title_ms',
+)
+
+
+def build(corpus):
+    """Build a chain from the lyrics of each song, as build_chain does."""
+    lyrics_generator = chains.LyricsText(state_size=2)
+    for lyrics in corpus:
+        lyrics_generator.add(lyrics)
+    return lyrics_generator
+
+
+def timed(run, times):
+    """Results of each run and the milliseconds it took, sorted."""
+    results, timings = [], []
+    for _ in range(times):
+        start = time.perf_counter()
+        results.append(run())
+        timings.append((time.perf_counter() - start) * 1000)
+    return results, sorted(timings)
+
+
+def p95(timings):
+    return timings[max(0, int(len(timings) * 0.95) - 1)]
+
+
+def compare(baseline, results, threshold):
+    """Yield ``(songs, metric, baseline value, value)`` for each metric past the threshold.
+
+    Only corpus sizes in both runs are compared. A metric regresses when it
+    grows by more than ``threshold`` times its baseline value.
+    """
+    previous = dict((row['songs'], row) for row in baseline['results'])
+    for row in results:
+        if row['songs'] not in previous:
+            continue
+        for metric in METRICS:
+            before, after = previous[row['songs']].get(metric), row[metric]
+            if before is not None and after > before * (1 + threshold):
+                yield row['songs'], metric, before, after
+
+
+class Command(BaseCommand):
+    help = 'Measure song generation on synthetic corpora and compare against a baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--songs', type=int, nargs='+', default=[100, 1000, 10000],
+            help='Corpus sizes to measure, in songs.')
+        parser.add_argument('--lines', type=int, default=40, help='Lines per song.')
+        parser.add_argument('--vocabulary', type=int, default=5000, help='Distinct words.')
+        parser.add_argument(
+            '--sentences', type=int, default=500, help='Sentences generated per size.')
+        parser.add_argument(
+            '--generate', type=int, default=20, help='Songs and titles generated per size.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for corpora and songs.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+        parser.add_argument(
+            '--baseline', help='JSON results of an earlier run to compare against.')
+        parser.add_argument(
+            '--threshold', type=float, default=0.2,
+            help='Fail when a metric grows by more than this fraction of its baseline.')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            try:
+                with open(options['baseline']) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError('Error reading baseline: {}'.format(e))
+            if not isinstance(baseline, dict) or 'results' not in baseline:
+                raise CommandError('Baseline has no results.')
+        config = dict(
+            (name, options[name])
+            for name in ('lines', 'vocabulary', 'sentences', 'generate', 'seed'))
+        self.stdout.write('\t'.join(('songs', ) + METRICS))
+        results = []
+        for songs in options['songs']:
+            row = self.run(songs, **config)
+            results.append(row)
+            self.stdout.write('\t'.join(
+                [str(songs)] + ['{:.3f}'.format(row[metric]) for metric in METRICS]))
+        report = {'config': config, 'results': results}
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        if baseline is not None:
+            self.check_baseline(baseline, report, options['threshold'])
+
+    def run(self, songs, lines, vocabulary, sentences, generate, seed):
+        corpus = synthetic.make_corpus(songs, lines=lines, vocabulary=vocabulary, seed=seed)
+        row = {'songs': songs}
+        start = time.perf_counter()
+        lyrics_generator = build(corpus)
+        row['build_s'] = time.perf_counter() - start
+        # Traced separately, since tracing slows the build down
+        tracemalloc.start()
+        try:
+            build(corpus)
+            row['build_peak_kb'] = tracemalloc.get_traced_memory()[1] / 1024
+        finally:
+            tracemalloc.stop()
+
+        # Count the walks make_sentence takes to find a sentence it can use
+        chain = lyrics_generator.chain
+        walks = [0]
+
+        def walk(*args, **kwargs):
+            walks[0] += 1
+            return type(chain).walk(chain, *args, **kwargs)
+
+        chain.walk = walk
+        rng = random.Random(seed)
+        try:
+            made, timings = timed(lambda: lyrics_generator.make_sentence(rng=rng), sentences)
+        finally:
+            del chain.walk
+        row['sentence_ms'] = statistics.median(timings)
+        row['sentence_p95_ms'] = p95(timings)
+        row['walks_per_sentence'] = walks[0] / sentences
+        row['none_rate'] = made.count(None) / sentences
+
+        _, timings = timed(lambda: make_stanza(lyrics_generator, rng), generate)
+        row['stanza_ms'] = statistics.median(timings)
+        seeds = iter(range(seed, seed + generate))
+        made, timings = timed(
+            lambda: make_song(lyrics_generator=lyrics_generator, seed=next(seeds)), generate)
+        row['song_ms'] = statistics.median(timings)
+        row['song_p95_ms'] = p95(timings)
+        made = iter(made)
+        _, timings = timed(lambda: make_title(next(made), seed=seed), generate)
+        row['title_ms'] = statistics.median(timings)
+        return row
+
+    def check_baseline(self, baseline, report, threshold):
+        if baseline.get('config') != report['config']:
+            self.stderr.write('Baseline was run with other settings: {}'.format(
+                baseline.get('config')))
+        regressions = list(compare(baseline, report['results'], threshold))
+        for songs, metric, before, after in regressions:
+            self.stderr.write('{} songs: {} regressed from {:.3f} to {:.3f} ({:+.0%})'.format(
+                songs, metric, before, after, after / before - 1 if before else float('inf')))
+        if regressions:
+            raise CommandError('{} metrics regressed by more than {:.0%}.'.format(
+                len(regressions), threshold))
+        self.stdout.write('No metrics regressed by more than {:.0%}.'.format(threshold))
@@ -0,0 +1,352 @@
+import bisect
+import collections
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+
+import requests
+
+from ... import bulk, chains, fake_baelor, models, pagination, synthetic, views
+
+
+# Prefix of the slugs of the songs added, which random slugs never have
+SLUG_PREFIX = 'load'
+
+ROUTES = ('generate', 'list', 'detail', 'save')
+
+# Upper bounds of the latency histogram buckets in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# Song list pages requested, from the first
+LIST_PAGES = 20
+
+
+def parse_mix(values):
+    """Weights of the routes from ``route=weight`` arguments."""
+    mix = collections.OrderedDict()
+    for value in values:
+        route, _, weight = value.partition('=')
+        if route not in ROUTES:
+            raise CommandError('Unknown route {!r}, choose from {}.'.format(
+                route, ', '.join(ROUTES)))
+        try:
+            mix[route] = float(weight)
+        except ValueError:
+            raise CommandError('Invalid weight for {}: {!r}'.format(route, weight))
+    if not any(weight > 0 for weight in mix.values()):
+        raise CommandError('At least one route needs a positive weight.')
+    return mix
+
+
+def percentile(timings, percent):
+    """Nearest rank percentile of sorted timings."""
+    if not timings:
+        return 0
+    return timings[max(0, int(round(len(timings) * percent / 100.0)) - 1)]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Client(threading.Thread):
+    """Send requests for routes picked by weight until the deadline, recording each.
+
+    Results are ``(route, status, milliseconds)`` with a status of 0 when no
+    response came back.
+    """
+
+    def __init__(self, driver, deadline, seed):
+        super().__init__(daemon=True)
+        self.driver = driver
+        self.deadline = deadline
+        self.rng = random.Random(seed)
+        self.session = requests.Session()
+        self.results = []
+
+    def run(self):
+        routes = list(self.driver.mix)
+        cumulative = list(self.driver.cumulative)
+        while time.perf_counter() < self.deadline:
+            route = routes[bisect.bisect(cumulative, self.rng.random() * cumulative[-1])]
+            method, path, data = getattr(self.driver, route)(self.rng)
+            start = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method, self.driver.url + path, data=data, allow_redirects=False,
+                    timeout=self.driver.timeout)
+            except requests.RequestException:
+                status = 0
+            else:
+                status = response.status_code
+                if route == 'save' and status == 201:
+                    self.driver.saved.append(response.json()['slug'])
+            self.results.append((route, status, (time.perf_counter() - start) * 1000))
+
+
+class Driver(object):
+    """Requests for each route, drawn from the songs in the database."""
+
+    def __init__(self, url, mix, timeout):
+        self.url = url.rstrip('/')
+        self.mix = mix
+        self.cumulative = []
+        total = 0
+        for weight in mix.values():
+            total += weight
+            self.cumulative.append(total)
+        self.timeout = timeout
+        self.albums = [''] + list(models.Album.objects.values_list('slug', flat=True))
+        self.cursors = self.list_cursors()
+        self.slugs = list(models.UserSong.objects.order_by('?').values_list(
+            'slug', flat=True)[:1000])
+        if mix.get('detail') and not self.slugs:
+            raise CommandError('There are no saved songs to request.')
+        # Slugs of the songs saved during the run
+        self.saved = []
+
+    def list_cursors(self):
+        """Cursors of the first pages of the song list."""
+        cursors = ['']
+        queryset = views.SongListView.queryset
+        for _ in range(LIST_PAGES - 1):
+            page = pagination.paginate(
+                queryset, views.SongListView.ordering, cursors[-1],
+                views.SongListView.paginate_by)
+            if not page.has_next():
+                break
+            cursors.append(page.next_cursor)
+        return cursors
+
+    def generate(self, rng):
+        return 'GET', '{}?album={}'.format(reverse('new-song'), rng.choice(self.albums)), None
+
+    def list(self, rng):
+        cursor = rng.choice(self.cursors)
+        return 'GET', reverse('song-list') + ('?cursor={}'.format(cursor) if cursor else ''), None
+
+    def detail(self, rng):
+        return 'GET', reverse('song-detail', kwargs={'slug': rng.choice(self.slugs)}), None
+
+    def save(self, rng):
+        data = {'album': rng.choice(self.albums), 'seed': rng.randrange(views.MAX_SEED)}
+        return 'POST', reverse('api-save-song'), data
+
+
+class Command(BaseCommand):
+    help = 'Load test the song pages under gunicorn and report latency per route'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--songs', type=int, default=5000, help='Source songs to have in the database.')
+        parser.add_argument(
+            '--add-songs', action='store_true',
+            help='Import synthetic source songs until there are --songs. They change the '
+                 'albums and chains of the site, so only use a database of its own.')
+        parser.add_argument('--albums', type=int, default=10, help='Albums of the songs added.')
+        parser.add_argument(
+            '--saved', type=int, default=100000,
+            help='Saved songs to have in the database, adding synthetic songs if needed.')
+        parser.add_argument('--lines', type=int, default=40, help='Lines per song added.')
+        parser.add_argument(
+            '--mix', nargs='+', default=['generate=4', 'list=3', 'detail=6', 'save=1'],
+            help='Weights of the routes requested, as route=weight.')
+        parser.add_argument('--clients', type=int, default=16, help='Concurrent clients.')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to run for.')
+        parser.add_argument(
+            '--timeout', type=float, default=30, help='Seconds to wait for each response.')
+        parser.add_argument('--workers', type=int, default=4, help='Gunicorn workers.')
+        parser.add_argument(
+            '--url', help="Load test the server at this URL instead of starting gunicorn. It "
+                          "must use the same database.")
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+        parser.add_argument(
+            '--keep', action='store_true',
+            help="Don't delete the source and saved songs added, before or during the run.")
+
+    def handle(self, *args, **options):
+        mix = parse_mix(options['mix'])
+        # Don't log every connection
+        logging.getLogger('requests.packages.urllib3').setLevel(logging.WARNING)
+        driver = None
+        # Slugs of the source and saved songs added by this run, to delete exactly those
+        self.songs_added = []
+        self.saved_added = []
+        try:
+            self.add_songs(
+                options['songs'], options['albums'], options['lines'], options['add_songs'])
+            self.add_saved_songs(options['saved'], options['lines'])
+            if options['url']:
+                server = None
+                url = options['url']
+            else:
+                server, url = self.start_server(options['workers'])
+            try:
+                driver = Driver(url, mix, options['timeout'])
+                results, elapsed = self.run(driver, options['clients'], options['duration'])
+            finally:
+                if server is not None:
+                    self.stop_server(server)
+        finally:
+            if not options['keep']:
+                saved = self.saved_added + (driver.saved if driver is not None else [])
+                if saved:
+                    bulk.delete_user_songs('slug = ANY(%s)', [saved])
+                if self.songs_added:
+                    self.delete_songs(self.songs_added)
+        report = self.report(mix, results, elapsed)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    def add_songs(self, count, albums, lines, add=False):
+        """Import synthetic source songs until there are ``count``, if allowed to."""
+        existing = models.Song.objects.count()
+        if existing >= count:
+            return
+        if not add:
+            raise CommandError(
+                'There are {} source songs. Pass --add-songs to import synthetic songs into '
+                'this database, or lower --songs.'.format(existing))
+        start = time.perf_counter()
+        corpus = synthetic.make_corpus(count - existing, lines=lines, seed=existing)
+        slugs = ['{}-{}'.format(SLUG_PREFIX, existing + i) for i in range(len(corpus))]
+        bulk.import_songs(
+            fake_baelor.make_song(slug, 'Load Album {}'.format(i % albums), lyrics)
+            for i, (slug, lyrics) in enumerate(zip(slugs, corpus)))
+        self.songs_added = slugs
+        self.stderr.write('Added {} songs in {:.1f}s'.format(
+            count - existing, time.perf_counter() - start))
+
+    def delete_songs(self, slugs):
+        """Delete the synthetic source songs and their albums, and rebuild the chains.
+
+        The songs are deleted with one ``DELETE``, which doesn't update the
+        chains song by song, and the chains of their albums are rebuilt once.
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM taytay_song WHERE slug = ANY(%s) RETURNING album_id', [slugs])
+            albums = models.Album.objects.filter(id__in={row[0] for row in cursor.fetchall()})
+            titles = list(albums.values_list('title', flat=True))
+            albums.filter(song=None).delete()
+        chains.discard_albums(titles)
+
+    def add_saved_songs(self, count, lines):
+        """Add synthetic saved songs until there are ``count``."""
+        existing = models.UserSong.objects.count()
+        if existing >= count:
+            return
+        start = time.perf_counter()
+        rng = random.Random(existing)
+        words = synthetic.make_words(5000)
+        slugs = ['{}{}'.format(SLUG_PREFIX, i) for i in range(existing, count)]
+        bulk.copy_user_songs(
+            (synthetic.make_line(words, rng, 2, 4), slug,
+             '\n'.join(synthetic.make_line(words, rng) for _ in range(lines)))
+            for slug in slugs)
+        self.saved_added = slugs
+        self.stderr.write('Added {} saved songs in {:.1f}s'.format(
+            count - existing, time.perf_counter() - start))
+
+    def start_server(self, workers):
+        """Start gunicorn as in the Procfile and wait until it answers."""
+        port = free_port()
+        url = 'http://127.0.0.1:{}'.format(port)
+        self.server_log = tempfile.TemporaryFile()
+        server = subprocess.Popen(
+            # The entry point of the gunicorn script, run with this Python
+            [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+             'taytay.wsgi', '--preload',
+             '--bind', '127.0.0.1:{}'.format(port), '--workers', str(workers)],
+            stdout=self.server_log, stderr=subprocess.STDOUT, env=os.environ.copy())
+        deadline = time.perf_counter() + 30
+        while True:
+            try:
+                requests.get(url + '/', timeout=1)
+            except requests.RequestException:
+                if server.poll() is not None or time.perf_counter() > deadline:
+                    self.server_log.seek(0)
+                    output = self.server_log.read().decode('utf-8', 'replace')
+                    self.stop_server(server)
+                    raise CommandError('Gunicorn failed to start:\n{}'.format(output))
+                time.sleep(0.1)
+            else:
+                break
+        self.stderr.write('Started gunicorn with {} workers at {}'.format(workers, url))
+        return server, url
+
+    def stop_server(self, server):
+        if server.poll() is None:
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+        self.server_log.close()
+
+    def run(self, driver, clients, duration):
+        """Run the clients at once and return their results and how long they took."""
+        start = time.perf_counter()
+        threads = [Client(driver, start + duration, seed) for seed in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        return [result for thread in threads for result in thread.results], elapsed
+
+    def report(self, mix, results, elapsed):
+        """Write a summary and a latency histogram per route, and return them."""
+        by_route = collections.OrderedDict((route, []) for route in mix)
+        for route, status, ms in results:
+            by_route[route].append((status, ms))
+        by_route['all'] = [(status, ms) for _, status, ms in results]
+        report = {'seconds': elapsed, 'routes': collections.OrderedDict()}
+        self.stdout.write(
+            'route\trequests\terrors\terror rate\treq/s\tp50 ms\tp95 ms\tp99 ms\tmax ms')
+        for route, route_results in by_route.items():
+            timings = sorted(ms for _, ms in route_results)
+            statuses = collections.Counter(str(status) for status, _ in route_results)
+            errors = sum(1 for status, _ in route_results if not 200 <= status < 400)
+            histogram = [0] * (len(BUCKETS) + 1)
+            for ms in timings:
+                histogram[bisect.bisect_left(BUCKETS, ms)] += 1
+            stats = {
+                'requests': len(timings),
+                'errors': errors,
+                'error_rate': errors / len(timings) if timings else 0,
+                'throughput': len(timings) / elapsed if elapsed else 0,
+                'p50_ms': percentile(timings, 50),
+                'p95_ms': percentile(timings, 95),
+                'p99_ms': percentile(timings, 99),
+                'max_ms': timings[-1] if timings else 0,
+                'statuses': dict(statuses),
+                'histogram': histogram,
+            }
+            report['routes'][route] = stats
+            self.stdout.write('\t'.join([route, str(stats['requests']), str(errors)] + [
+                '{:.3f}'.format(stats['error_rate']), '{:.1f}'.format(stats['throughput'])] + [
+                '{:.1f}'.format(stats[name]) for name in ('p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+            ]))
+        self.stdout.write('')
+        self.stdout.write('\t'.join(['ms'] + list(by_route)))
+        labels = ['<={}'.format(bucket) for bucket in BUCKETS] + ['>{}'.format(BUCKETS[-1])]
+        for i, label in enumerate(labels):
+            self.stdout.write('\t'.join([label] + [
+                str(stats['histogram'][i]) for stats in report['routes'].values()]))
+        return report
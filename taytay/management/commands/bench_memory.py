@@ -0,0 +1,97 @@
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+
+from django.core.management.base import BaseCommand
+
+import markovify
+
+from ... import compact, synthetic
+
+
+def memory_usage():
+    """Return the resident and private memory of this process in kB."""
+    usage = {'rss': 0, 'private': 0}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name == 'Rss':
+                    usage['rss'] = int(value.split()[0])
+                elif name.startswith('Private_'):
+                    usage['private'] += int(value.split()[0])
+    except FileNotFoundError:
+        # Without smaps we can't tell shared and private pages apart
+        usage['rss'] = usage['private'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage
+
+
+def measure(kind, source, sentences, results):
+    """Load a chain as a worker would and report how much memory it added."""
+    before = memory_usage()
+    if kind == 'compact':
+        lyrics_generator = compact.load(source)
+    else:
+        lyrics_generator = markovify.text.NewlineText(source, state_size=2)
+    for _ in range(sentences):
+        lyrics_generator.make_sentence()
+    after = memory_usage()
+    results.put(dict((key, after[key] - before[key]) for key in before))
+
+
+class Command(BaseCommand):
+    help = 'Compare the memory used per worker by markovify and compact chains'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--songs', type=int, nargs='+', default=[100, 1000, 10000],
+            help='Corpus sizes to measure, in songs.')
+        parser.add_argument('--lines', type=int, default=40, help='Lines per song.')
+        parser.add_argument('--vocabulary', type=int, default=5000, help='Distinct words.')
+        parser.add_argument('--workers', type=int, default=4, help='Worker processes.')
+        parser.add_argument(
+            '--sentences', type=int, default=100, help='Sentences generated by each worker.')
+
+    def handle(self, *args, **options):
+        root = tempfile.mkdtemp()
+        try:
+            self.stdout.write(
+                'songs\ttransitions\tfile kB\t'
+                'markovify rss kB\tmarkovify private kB\tcompact rss kB\tcompact private kB')
+            for songs in options['songs']:
+                self.stdout.write('\t'.join(map(str, self.run(root, songs, options))))
+        finally:
+            shutil.rmtree(root)
+
+    def run(self, root, songs, options):
+        corpus = '\n'.join(synthetic.make_corpus(
+            songs, lines=options['lines'], vocabulary=options['vocabulary']))
+        lyrics_generator = markovify.text.NewlineText(corpus, state_size=2)
+        model = lyrics_generator.chain.model
+        path = os.path.join(root, '{}.chain'.format(songs))
+        compact.save(path, model, 2, lyrics_generator.rejoined_text)
+        transitions = sum(len(follow) for follow in model.values())
+        del lyrics_generator, model
+
+        results = {}
+        for kind, source in (('markovify', corpus), ('compact', path)):
+            queue = multiprocessing.Queue()
+            workers = [
+                multiprocessing.Process(
+                    target=measure, args=(kind, source, options['sentences'], queue))
+                for _ in range(options['workers'])
+            ]
+            for worker in workers:
+                worker.start()
+            usage = [queue.get() for _ in workers]
+            for worker in workers:
+                worker.join()
+            results[kind] = dict(
+                (key, sum(u[key] for u in usage) // len(usage)) for key in ('rss', 'private'))
+        return [
+            songs, transitions, os.path.getsize(path) // 1024,
+            results['markovify']['rss'], results['markovify']['private'],
+            results['compact']['rss'], results['compact']['private'],
+        ]
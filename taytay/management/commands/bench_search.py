@@ -0,0 +1,86 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from ... import bulk, models, search, synthetic
+
+
+SLUG_PREFIX = 'bench'
+
+
+class Command(BaseCommand):
+    help = 'Measure search latency over saved songs as the table grows'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows', type=int, nargs='+', default=[10000, 100000, 1000000],
+            help='Table sizes to measure, in saved songs.')
+        parser.add_argument('--lines', type=int, default=8, help='Lines per song.')
+        parser.add_argument('--vocabulary', type=int, default=5000, help='Distinct words.')
+        parser.add_argument(
+            '--queries', type=int, default=20, help='Times each search is run per size.')
+        parser.add_argument(
+            '--words', nargs='+', default=['la2000 la3000', 'la1000', 'la300', 'la20'],
+            help='Searches to run, from rare to common words.')
+        parser.add_argument(
+            '--icontains', action='store_true',
+            help='Also measure the same search with icontains, which reads every row.')
+        parser.add_argument(
+            '--keep', action='store_true', help="Don't delete the saved songs added.")
+
+    def handle(self, *args, **options):
+        words = synthetic.make_words(options['vocabulary'])
+        rng = random.Random(0)
+        # Songs kept by an earlier run with --keep
+        added = models.UserSong.objects.filter(slug__startswith=SLUG_PREFIX).count()
+        self.stdout.write('rows\tsearch\tmatches\tmethod\tmedian ms\tp95 ms')
+        try:
+            for rows in sorted(options['rows']):
+                if rows > added:
+                    start = time.perf_counter()
+                    self.add_songs(added, rows - added, words, rng, options['lines'])
+                    added = rows
+                    self.stderr.write('Loaded {} songs in {:.1f}s'.format(
+                        rows, time.perf_counter() - start))
+                for terms in options['words']:
+                    methods = [('search', lambda: search.search(models.UserSong, terms))]
+                    if options['icontains']:
+                        methods.append(('icontains', lambda: list(
+                            models.UserSong.objects.filter(lyrics__icontains=terms)[:24])))
+                    matches = self.count_matches(terms)
+                    for method, run in methods:
+                        timings = self.measure(run, options['queries'])
+                        self.stdout.write('\t'.join(map(str, [
+                            rows, terms, matches, method,
+                            '{:.2f}'.format(statistics.median(timings)),
+                            '{:.2f}'.format(timings[int(len(timings) * 0.95) - 1]),
+                        ])))
+        finally:
+            if added and not options['keep']:
+                bulk.delete_user_songs('slug LIKE %s', [SLUG_PREFIX + '%'])
+
+    def add_songs(self, start, count, words, rng, lines):
+        """Add saved songs with COPY, which the trigger indexes as they are written."""
+        bulk.copy_user_songs(
+            (synthetic.make_line(words, rng, 2, 4), '{}{}'.format(SLUG_PREFIX, i),
+             '\n'.join(synthetic.make_line(words, rng) for _ in range(lines)))
+            for i in range(start, start + count))
+
+    def count_matches(self, terms):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT count(*) FROM taytay_usersong '
+                'WHERE search_vector @@ plainto_tsquery(%s, %s)', [search.CONFIG, terms])
+            return cursor.fetchone()[0]
+
+    def measure(self, run, queries):
+        """Milliseconds taken by each run, sorted."""
+        timings = []
+        for _ in range(queries):
+            start = time.perf_counter()
+            run()
+            timings.append((time.perf_counter() - start) * 1000)
+        return sorted(timings)
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import chains
+
+
+class Command(BaseCommand):
+    help = 'Build the Markov chains for each album and save them to MARKOV_MODEL_ROOT'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help="Only check that the saved chains are up to date with the songs, failing "
+                 "if any aren't.")
+
+    def handle(self, *args, **options):
+        if options['check']:
+            stale = chains.stale_artifacts()
+            for album in stale:
+                self.stdout.write('Out of date {}'.format(chains.artifact_path(album)))
+            if stale:
+                raise CommandError('{} chains are missing or out of date in {}.'.format(
+                    len(stale), settings.MARKOV_MODEL_ROOT))
+            self.stdout.write('Chains in {} are up to date.'.format(settings.MARKOV_MODEL_ROOT))
+            return
+        paths = chains.build_artifacts()
+        for path in paths:
+            self.stdout.write('Saved {}'.format(path))
+        self.stdout.write('Built {} chains in {}'.format(len(paths), settings.MARKOV_MODEL_ROOT))
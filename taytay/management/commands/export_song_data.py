@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ... import bulk
+
+
+class Command(BaseCommand):
+    help = 'Export song data for import_song_data as JSON or JSON lines, optionally gzipped'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output', default='-',
+            help='File to write to, defaults to stdout. Names ending in .gz are compressed.')
+        parser.add_argument(
+            '--format', choices=['json', 'jsonl'],
+            help='JSON response or JSON lines, by default from the file name or JSON lines.')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        format = bulk.dump_format(options['output'], options['format'])
+        if options['output'] == '-':
+            count = bulk.export_songs(self.stdout, format=format)
+        else:
+            with bulk.open_dump(options['output'], 'wt') as output:
+                count = bulk.export_songs(output, format=format)
+        self.stderr.write('Exported {} songs in {:.2f}s'.format(
+            count, time.perf_counter() - start))
@@ -1,43 +1,152 @@
+import time
+
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.timezone import now
 
 import requests
 
-from ... import models
+from ... import fetch, models, sync
 
 
 class Command(BaseCommand):
     help = 'Fetch song data from baelor.io'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--prune', action='store_true',
+            help='Delete songs which are no longer returned by the API.')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Fetch the songs even if they have not changed since the last sync, '
+                 'starting over instead of resuming a paged sync.')
+        parser.add_argument(
+            '--album', action='append', dest='albums', default=[], metavar='SLUG',
+            help='Only fetch the songs of this album. Can be given more than once.')
+        parser.add_argument(
+            '--per-page', type=int, default=0,
+            help='Fetch the songs in pages of this size. An interrupted sync resumes after '
+                 'the last page synced.')
+        parser.add_argument(
+            '--workers', type=int, default=4, help='Number of pages to fetch at once.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of songs to parse and write at a time.')
+        parser.add_argument(
+            '--retries', type=int, default=3, help='Times to retry a failed request.')
+        parser.add_argument(
+            '--timeout', type=float, default=fetch.TIMEOUT[1],
+            help='Seconds to wait for a response.')
+
     def handle(self, *args, **options):
         api_key = getattr(settings, 'BAELOR_API_KEY', None)
         if not api_key:
             raise CommandError('BAELOR_API_KEY has not been configured.')
-        auth = {'Authorization': 'bearer {}'.format(api_key)}
-        response = requests.get('https://baelor.io/api/v0/songs', headers=auth).json()
-        if response['error']:
-            raise CommandError('Error fetching songs: {error}'.format(**response))
-        else:
-            albums = {}
-            for song in response['result']:
-                song_slug = song['slug']
-                song_info = {
-                    'title': song['title'],
-                    'writers': song['writers'],
-                    'producers': song['producers'],
-                }
-                album = song['album']
-                album_slug = album['slug']
-                album_info = {
-                    'title': album['name'],
-                    'label': album['label'],
-                    'genres': album['genres'],
-                    'producers': album['producers'],
-                }
-                if album_slug not in albums:
-                    albums[album_slug], _ = models.Album.objects.update_or_create(
-                        slug=album_slug, defaults=album_info)
-                song_info['album'] = albums[album_slug]
-                song_info['lyrics'] = '\n'.join(line['content'] for line in song['lyrics'])
-                models.Song.objects.update_or_create(
-                    slug=song_slug, defaults=song_info)
+        if options['prune'] and options['albums']:
+            raise CommandError('--prune can only be used when fetching every album.')
+        self.session = fetch.make_session(
+            retries=options['retries'], pool_size=max(options['workers'], 1))
+        self.auth = {'Authorization': 'bearer {}'.format(api_key)}
+        self.timeout = (fetch.TIMEOUT[0], options['timeout'])
+        urls = [fetch.songs_url(album) for album in options['albums']] or [fetch.songs_url()]
+        for url in urls:
+            state = models.SyncState.objects.filter(url=url).first() or models.SyncState(url=url)
+            start = time.perf_counter()
+            try:
+                if options['per_page']:
+                    summary = self.fetch_pages(state, **options)
+                else:
+                    summary = self.fetch_all(state, **options)
+            except (requests.RequestException, fetch.FetchError) as e:
+                raise CommandError(str(e))
+            if summary is not None:
+                self.report(summary, time.perf_counter() - start, options['verbosity'])
+
+    def fetch_all(self, state, force=False, prune=False, batch_size=1000, **options):
+        """Fetch every song in one request unless they haven't changed since the last sync.
+
+        The songs are parsed as the response is read and synced in batches,
+        all in one transaction.
+        """
+        headers = dict(self.auth)
+        if not force:
+            headers.update(state.conditional_headers())
+        response = self.session.get(state.url, headers=headers, timeout=self.timeout, stream=True)
+        if response.status_code == 304:
+            self.stdout.write('Songs have not changed since {}.'.format(state.synced_date))
+            return None
+        response.raise_for_status()
+        summary = sync.SyncSummary()
+        seen = []
+        with transaction.atomic():
+            songs = fetch.iter_results(response.iter_content(fetch.CHUNK_SIZE))
+            try:
+                for batch in fetch.batches(songs, batch_size):
+                    summary.update(sync.sync_songs(batch, update_chains=False))
+                    seen.extend(song['slug'] for song in batch)
+            except ValueError as e:
+                # Such as an HTML error page from a proxy, as in fetch.read_result
+                raise fetch.FetchError('Invalid response from {}: {}'.format(state.url, e))
+            if prune:
+                summary.update(sync.prune_songs(seen, update_chains=False))
+            state.etag = response.headers.get('ETag', '')
+            state.last_modified = response.headers.get('Last-Modified', '')
+            state.checkpoint = 0
+            state.synced_date = now()
+            state.save()
+        summary.update_chains()
+        return summary
+
+    def fetch_pages(self, state, force=False, prune=False, per_page=100, workers=4, **options):
+        """Fetch and sync the songs a page at a time, saving a checkpoint after each page.
+
+        The chains are updated once at the end with the changes of every page,
+        including when the sync stops early, since the pages synced so far are
+        committed.
+        """
+        first_page = 1 if force else state.checkpoint + 1
+        if first_page > 1:
+            self.stdout.write('Resuming after page {}.'.format(state.checkpoint))
+        summary = sync.SyncSummary()
+        seen = []
+        pages = fetch.fetch_pages(
+            self.session, state.url, per_page, workers=max(workers, 1), first_page=first_page,
+            headers=self.auth, timeout=self.timeout)
+        try:
+            for page, songs in pages:
+                summary.update(sync.sync_songs(songs, update_chains=False))
+                seen.extend(song['slug'] for song in songs)
+                state.checkpoint = page
+                state.save()
+                if options['verbosity'] > 1:
+                    self.stdout.write('Synced page {} with {} songs'.format(page, len(songs)))
+            if prune:
+                if first_page > 1:
+                    self.stderr.write('Not pruning songs after resuming a sync, use --force.')
+                else:
+                    summary.update(sync.prune_songs(seen, update_chains=False))
+        finally:
+            summary.update_chains()
+        state.etag = ''
+        state.last_modified = ''
+        state.checkpoint = 0
+        state.synced_date = now()
+        state.save()
+        return summary
+
+    def report(self, summary, total_time, verbosity=1):
+        if verbosity > 1:
+            for label, slugs in (('Created', summary.created), ('Changed', summary.changed),
+                                 ('Deleted', summary.deleted)):
+                for song_slug in slugs:
+                    self.stdout.write('{} {}'.format(label, song_slug))
+        self.stdout.write('Created {}, changed {} and deleted {} songs.'.format(
+            len(summary.created), len(summary.changed), len(summary.deleted)))
+        self.stdout.write(
+            '{} songs unchanged, {} albums created and {} changed.'.format(
+                len(summary.unchanged), summary.albums_created, summary.albums_changed))
+        timings = ', '.join(
+            '{} {:.2f}s'.format(step, seconds) for step, seconds in summary.timings.items())
+        self.stdout.write('Finished in {:.2f}s, syncing took {:.2f}s ({}).'.format(
+            total_time, summary.total_time, timings))
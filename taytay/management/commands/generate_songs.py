@@ -0,0 +1,68 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import models, pages
+from ...views import make_songs
+
+
+class Command(BaseCommand):
+    help = 'Generate a batch of songs as JSON lines or save them as user songs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=100, help='Number of songs.')
+        parser.add_argument('--album', help='Slug of the album to base the songs on.')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1, help='Worker processes.')
+        parser.add_argument(
+            '--output', default='-', help='File to write JSON lines to, defaults to stdout.')
+        parser.add_argument(
+            '--save', action='store_true', help='Save the songs instead of writing them out.')
+        parser.add_argument(
+            '--batch-size', type=int, default=500, help='Songs saved per query.')
+
+    def handle(self, *args, **options):
+        album = None
+        if options['album']:
+            try:
+                album = models.Album.objects.get(slug=options['album']).title
+            except models.Album.DoesNotExist:
+                raise CommandError('Album "{}" does not exist.'.format(options['album']))
+        songs = make_songs(options['count'], album=album, workers=options['workers'])
+        start = time.perf_counter()
+        if options['save']:
+            count = self.save(songs, options['batch_size'])
+        elif options['output'] == '-':
+            count = self.write(songs, self.stdout)
+        else:
+            with open(options['output'], 'w') as output:
+                count = self.write(songs, output)
+        elapsed = time.perf_counter() - start
+        self.stderr.write('Generated {} songs in {:.2f}s ({:.1f} songs/s)'.format(
+            count, elapsed, count / elapsed if elapsed else 0.0))
+
+    def write(self, songs, output):
+        count = 0
+        for song in songs:
+            output.write(json.dumps(song) + '\n')
+            count += 1
+        return count
+
+    def save(self, songs, batch_size):
+        count = 0
+        batch = []
+        for song in songs:
+            # bulk_create doesn't call save(), which sets the preview
+            batch.append(models.UserSong(
+                title=song['title'], lyrics=song['lyrics'],
+                preview=models.make_preview(song['lyrics'])))
+            if len(batch) >= batch_size:
+                models.UserSong.objects.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        models.UserSong.objects.bulk_create(batch)
+        # bulk_create doesn't send post_save
+        pages.invalidate_list()
+        return count + len(batch)
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import bulk, fetch
+
+
+class Command(BaseCommand):
+    help = 'Import song data from JSON or JSON lines dumps, optionally gzipped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', metavar='PATH', help='Dump files to import.')
+        parser.add_argument(
+            '--format', choices=['json', 'jsonl'],
+            help='Format of the dumps, by default from the file names. JSON files hold an '
+                 'API response and JSON lines files one song per line.')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            summary = bulk.import_dumps(options['paths'], format=options['format'])
+        except (OSError, ValueError, KeyError, fetch.FetchError) as e:
+            raise CommandError('Error importing songs: {}'.format(e))
+        elapsed = time.perf_counter() - start
+        self.stdout.write('Created {}, changed {} and left {} songs unchanged.'.format(
+            summary.created, summary.changed, summary.unchanged))
+        self.stdout.write('Created {} and changed {} albums.'.format(
+            summary.albums_created, summary.albums_changed))
+        if summary.duplicates:
+            self.stdout.write('Skipped {} songs with duplicate slugs.'.format(summary.duplicates))
+        self.stdout.write('Imported {} songs in {:.2f}s ({:.0f} songs/s).'.format(
+            summary.staged, elapsed, summary.staged / elapsed if elapsed else 0))
@@ -0,0 +1,52 @@
+"""Markov text models which can generate sentences reproducibly."""
+import hashlib
+import random
+
+import markovify
+
+
+def word_order(word):
+    """Sort key putting the begin and end markers before every word."""
+    if word == markovify.chain.BEGIN:
+        return (0, word)
+    if word == markovify.chain.END:
+        return (1, word)
+    return (2, word)
+
+
+class SeededText(markovify.text.NewlineText):
+    """Newline separated text generating sentences from a given random source.
+
+    Passing a seeded ``random.Random`` to ``make_sentence`` makes the output
+    depend only on the seed and the model, which is identified by ``version``.
+    """
+
+    _version = None
+
+    def source_data(self):
+        """Source text as UTF-8 bytes."""
+        return self.rejoined_text.encode('utf-8')
+
+    @property
+    def version(self):
+        """Digest of the source text, which determines the chain."""
+        if self._version is None:
+            digest = hashlib.sha1(str(self.chain.state_size).encode('ascii'))
+            digest.update(self.source_data())
+            self._version = digest.hexdigest()[:16]
+        return self._version
+
+    def make_sentence(self, init_state=None, rng=None, **kwargs):
+        """Attempts `tries` times to generate a sentence which isn't copied from the lyrics.
+
+        Works like ``markovify.Text.make_sentence``, choosing words with
+        ``rng`` rather than the global random generator.
+        """
+        tries = kwargs.get('tries', markovify.text.DEFAULT_TRIES)
+        mor = kwargs.get('max_overlap_ratio', markovify.text.DEFAULT_MAX_OVERLAP_RATIO)
+        mot = kwargs.get('max_overlap_total', markovify.text.DEFAULT_MAX_OVERLAP_TOTAL)
+        for _ in range(tries):
+            words = self.chain.walk(init_state, rng=rng or random)
+            if self.test_sentence_output(words, mor, mot):
+                return self.word_join(words)
+        return None
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 10:44
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taytay', '0005_syncstate_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='usersong',
+            index_together=set([('title', 'id')]),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 10:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# The first stanza as models.make_preview() finds it, set in one statement. It's
+# passed in a list so Django runs it as is rather than splitting it.
+BACKFILL_PREVIEW = r"""
+UPDATE taytay_usersong
+SET preview = (regexp_split_to_array(btrim(lyrics, E' \t\n\r'), E'\\s*\n\\s*\n'))[1]
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taytay', '0006_usersong_title_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usersong',
+            name='preview',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.RunSQL([BACKFILL_PREVIEW], migrations.RunSQL.noop),
+    ]
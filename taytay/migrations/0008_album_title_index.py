@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-18 10:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taytay', '0007_usersong_preview'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='album',
+            name='title',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Titles are weighted above lyrics. The text search configuration must match
+# taytay.search.CONFIG.
+UPDATE_FUNCTION = """
+CREATE FUNCTION taytay_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('pg_catalog.english', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('pg_catalog.english', coalesce(NEW.lyrics, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""
+
+# Statements are listed one by one so Django doesn't need to split them, and
+# the function body quoted with $$ stays whole.
+ADD_COLUMN = [
+    "ALTER TABLE {table} ADD COLUMN search_vector tsvector",
+    "CREATE TRIGGER {table}_search_vector BEFORE INSERT OR UPDATE OF title, lyrics ON {table} "
+    "FOR EACH ROW EXECUTE PROCEDURE taytay_search_vector_update()",
+    "UPDATE {table} SET title = title",
+    "CREATE INDEX {table}_search_vector ON {table} USING gin(search_vector)",
+]
+
+DROP_COLUMN = [
+    "DROP TRIGGER {table}_search_vector ON {table}",
+    "ALTER TABLE {table} DROP COLUMN search_vector",
+]
+
+
+class Migration(migrations.Migration):
+    """Full text search columns kept up to date by a trigger, which models don't load."""
+
+    dependencies = [
+        ('taytay', '0008_album_title_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL([UPDATE_FUNCTION], ['DROP FUNCTION taytay_search_vector_update()']),
+    ] + [
+        migrations.RunSQL(
+            [sql.format(table=table) for sql in ADD_COLUMN],
+            [sql.format(table=table) for sql in DROP_COLUMN])
+        for table in ('taytay_song', 'taytay_usersong')
+    ]
@@ -1,3 +1,4 @@
+import re
 import uuid
 
 from django.core.urlresolvers import reverse
@@ -9,7 +10,8 @@ from django.utils.timezone import now
 class Album(models.Model):
     """Collection of songs."""
 
-    title = models.CharField(max_length=255)
+    # Chains and cached songs refer to albums by title
+    title = models.CharField(max_length=255, db_index=True)
     slug = models.SlugField(max_length=255, unique=True)
     label = models.CharField(max_length=255)
     genres = ArrayField(
@@ -32,6 +34,7 @@ class Song(models.Model):
         models.CharField(max_length=100), size=10)
     producers = ArrayField(
         models.CharField(max_length=100), size=10)
+    content_hash = models.CharField(max_length=40, blank=True, default='', editable=False)
 
     def __str__(self):
         return self.title
@@ -42,20 +45,57 @@ def slug():
     return '{0:x}'.format(uuid.uuid4().int)
 
 
+STANZA_BREAK = re.compile(r'\s*\n\s*\n')
+
+
+def make_preview(lyrics):
+    """Returns the first stanza of the lyrics, which are separated by blank lines."""
+    return STANZA_BREAK.split(lyrics.strip(), 1)[0]
+
+
 class UserSong(models.Model):
     """Generated songs that the user liked enough to save."""
 
     title = models.CharField(max_length=255)
     slug = models.SlugField(max_length=32, unique=True, default=slug)
     lyrics = models.TextField()
+    # First stanza, kept so the song list doesn't need the lyrics
+    preview = models.TextField(blank=True, editable=False)
     created_date = models.DateTimeField(default=now)
 
+    class Meta:
+        # For paging through the songs by title
+        index_together = [('title', 'id')]
+
     def __str__(self):
         return self.title
 
     def get_absolute_url(self):
         return reverse('song-detail', kwargs={'slug': self.slug})
 
-    def preview(self):
-        """Returns the first stanza of the song."""
-        return self.lyrics.split('\n\n')[0]
+    def save(self, *args, **kwargs):
+        self.preview = make_preview(self.lyrics)
+        super().save(*args, **kwargs)
+
+
+class SyncState(models.Model):
+    """Validators from the last successful fetch of an API resource."""
+
+    url = models.CharField(max_length=255, unique=True)
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=64, blank=True)
+    synced_date = models.DateTimeField(null=True, blank=True)
+    # Last page synced by a paged sync which hasn't finished
+    checkpoint = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return self.url
+
+    def conditional_headers(self):
+        """Headers to only fetch the resource again if it has changed."""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
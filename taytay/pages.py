@@ -0,0 +1,167 @@
+"""Rendered pages kept in the Django cache, served with validators for conditional requests.
+
+Saved songs never change, so their pages are cached until the song is
+deleted, or under a version which changes when songs are deleted in bulk.
+Song list pages are cached under a version which changes whenever
+a saved song is added or deleted. The album choices shown by the song forms
+are cached the same way until albums are synced, and the homepage until its
+templates change.
+"""
+import collections
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from django.template.loader import get_template
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+from . import models, timing
+
+
+DETAIL_VERSION_KEY = 'taytay:pages:song:version'
+
+LIST_VERSION_KEY = 'taytay:pages:song-list:version'
+
+ALBUMS_VERSION_KEY = 'taytay:pages:albums:version'
+
+# Hashes of template sources by template names
+_template_versions = {}
+
+
+class CachedPage(collections.namedtuple(
+        'CachedPage', ['content', 'content_type', 'etag', 'last_modified'])):
+    """Body and headers of a rendered page, small and plain enough for any cache backend.
+
+    The ETag is a hash of the body, so it's a strong validator. Last modified
+    is a timestamp or None.
+    """
+
+    @classmethod
+    def from_response(cls, response, last_modified=None):
+        if hasattr(response, 'render'):
+            with timing.phase('render'):
+                response.render()
+        return cls(
+            response.content, response['Content-Type'],
+            hashlib.sha1(response.content).hexdigest(), last_modified)
+
+    def respond(self, request, max_age=0):
+        """Response for the page, or a 304 if the client's copy is current."""
+        response = HttpResponse(self.content, content_type=self.content_type)
+        response['ETag'] = quote_etag(self.etag)
+        if self.last_modified is not None:
+            response['Last-Modified'] = http_date(self.last_modified)
+        patch_cache_control(response, public=True, max_age=max_age)
+        return get_conditional_response(
+            request, etag=self.etag, last_modified=self.last_modified, response=response)
+
+
+def current_version(key):
+    """Version stored in the cache under a key, starting a new one if it's missing."""
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def new_version(key):
+    """Replace the version under a key, discarding everything cached for the old one.
+
+    Done again when the transaction commits, in case something was cached
+    without the change in the meantime.
+    """
+    cache.set(key, uuid.uuid4().hex, None)
+    transaction.on_commit(lambda: cache.set(key, uuid.uuid4().hex, None))
+
+
+def detail_key(slug):
+    return 'taytay:pages:song:{}:{}'.format(current_version(DETAIL_VERSION_KEY), slug)
+
+
+def list_key(cursor='', fragment=False):
+    """Key of a song list page for the current version of the list.
+
+    The cursor is hashed to keep keys short enough for memcached.
+    """
+    return 'taytay:pages:song-list:{}:{}:{}'.format(
+        current_version(LIST_VERSION_KEY), 'fragment' if fragment else 'page',
+        hashlib.sha1(cursor.encode('utf-8')).hexdigest())
+
+
+def invalidate_list():
+    """Discard every cached song list page."""
+    new_version(LIST_VERSION_KEY)
+
+
+def invalidate_songs():
+    """Discard every cached saved song and song list page, after songs are deleted in bulk."""
+    new_version(DETAIL_VERSION_KEY)
+    invalidate_list()
+
+
+def album_choices():
+    """Slugs and titles of the albums ordered by title, from the cache once loaded.
+
+    They expire after ALBUMS_TIMEOUT seconds in case albums were written
+    without invalidating them.
+    """
+    key = 'taytay:pages:albums:{}'.format(current_version(ALBUMS_VERSION_KEY))
+    choices = cache.get(key)
+    if choices is None:
+        choices = list(models.Album.objects.order_by('title').values_list('slug', 'title'))
+        cache.set(key, choices, settings.ALBUMS_TIMEOUT)
+    return choices
+
+
+def invalidate_albums():
+    """Discard the cached album choices, after albums are written in bulk."""
+    new_version(ALBUMS_VERSION_KEY)
+
+
+def template_version(names):
+    """Hash of the sources of templates.
+
+    Templates only change when the code is deployed, so the hash is kept for
+    the life of the process unless DEBUG is on.
+    """
+    names = tuple(names)
+    version = _template_versions.get(names)
+    if version is None or settings.DEBUG:
+        digest = hashlib.sha1()
+        for name in names:
+            digest.update(get_template(name).template.source.encode('utf-8'))
+        version = _template_versions[names] = digest.hexdigest()
+    return version
+
+
+def homepage_key(templates):
+    """Key of the homepage for the current version of its templates."""
+    return 'taytay:pages:homepage:{}'.format(template_version(templates))
+
+
+def song_saved(sender, instance, created, **kwargs):
+    """Signal handler to show new saved songs in the list."""
+    if created:
+        invalidate_list()
+
+
+def song_deleted(sender, instance, **kwargs):
+    """Signal handler to stop serving songs deleted one at a time.
+
+    Deleting a queryset sends it for every song, so bulk deletes use
+    ``bulk.delete_user_songs`` instead.
+    """
+    key = detail_key(instance.slug)
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
+    invalidate_list()
+
+
+def album_changed(sender, **kwargs):
+    """Signal handler to show albums saved or deleted one at a time in the choices."""
+    invalidate_albums()
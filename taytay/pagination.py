@@ -0,0 +1,77 @@
+"""Keyset pagination, which pages by the values of the last row instead of an offset.
+
+Each page is found with an index range scan starting after the cursor, so
+every page costs the same however deep it is, and no count is needed.
+"""
+import base64
+import json
+
+from django.db.models import Q
+
+
+def encode_cursor(values):
+    """Opaque cursor for the ordering values of the last row of a page."""
+    data = json.dumps(list(values), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    """Ordering values from a cursor, raising ValueError if it is invalid."""
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data.decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid cursor {!r}'.format(cursor))
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError('Invalid cursor {!r}'.format(cursor))
+    return values
+
+
+def after(fields, values):
+    """Filter for the rows ordered after the given values of the fields.
+
+    The condition on the first field alone lets the database start an index
+    scan at the cursor, the rest breaks ties.
+    """
+    condition = Q()
+    for i, field in enumerate(fields):
+        term = Q(**{'{}__gt'.format(field): values[i]})
+        for previous, value in zip(fields[:i], values):
+            term &= Q(**{previous: value})
+        condition |= term
+    return Q(**{'{}__gte'.format(fields[0]): values[0]}) & condition
+
+
+class KeysetPage(object):
+    """A page of rows with the cursor of the next page, like a Django Page."""
+
+    def __init__(self, object_list, next_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def paginate(queryset, fields, cursor=None, per_page=24):
+    """Page of a queryset ordered by fields, which must end with a unique field.
+
+    Fetches one extra row to tell whether there is a next page. Raises
+    ValueError if the cursor is invalid.
+    """
+    queryset = queryset.order_by(*fields)
+    if cursor:
+        queryset = queryset.filter(after(fields, decode_cursor(cursor, len(fields))))
+    rows = list(queryset[:per_page + 1])
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, field) for field in fields)
+    return KeysetPage(rows, next_cursor)
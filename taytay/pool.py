@@ -0,0 +1,127 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+from . import chains, timing
+
+
+logger = logging.getLogger(__name__)
+
+
+class SongPool(object):
+    """Bounded queues of songs generated ahead of time for each album.
+
+    Requests take a ready song from the queue for their album and a background
+    thread in each process keeps the queues topped up. A queue is emptied when
+    the chain for its album is invalidated so stale songs aren't served.
+
+    The depth of the queue and the refill rate are counted in the timings of
+    each request which asks the pool for a song.
+    """
+
+    def __init__(self, generate, size, interval=1):
+        self.generate = generate
+        self.size = size
+        self.interval = interval
+        self.generated = 0
+        self.hits = 0
+        self.misses = 0
+        self.rate = 0.0
+        self._queues = collections.OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def _check_version(self, album):
+        """Empty the queue if the chain for the album has changed."""
+        version = chains.current_version(album)
+        with self._lock:
+            if version != self._versions.get(album):
+                self._queues.setdefault(album, collections.deque(maxlen=self.size)).clear()
+                self._versions[album] = version
+        return version
+
+    def get(self, album=None):
+        """Return a ready song for the album or None if there isn't one."""
+        if not self.enabled:
+            return None
+        self.start()
+        self._check_version(album)
+        with self._lock:
+            queue = self._queues[album]
+            # Sent with the timings of the request, since the pool is per process
+            timing.count('pool_depth', len(queue))
+            timing.count('pool_rate', round(self.rate, 1))
+            try:
+                song = queue.popleft()
+            except IndexError:
+                self.misses += 1
+                timing.count('pool_misses')
+                return None
+            self.hits += 1
+            timing.count('pool_hits')
+            return song
+
+    def depth(self):
+        """Number of ready songs for each album."""
+        with self._lock:
+            return dict((album, len(queue)) for album, queue in self._queues.items())
+
+    def stats(self):
+        """Queue depths along with hit, miss and refill counts."""
+        return {
+            'depth': self.depth(),
+            'generated': self.generated,
+            'hits': self.hits,
+            'misses': self.misses,
+            'rate': self.rate,
+        }
+
+    def refill(self):
+        """Generate songs until every queue is full and return how many were made."""
+        start = time.perf_counter()
+        generated = 0
+        for album in list(self._queues):
+            version = self._check_version(album)
+            for _ in range(self.size - len(self._queues[album])):
+                song = self.generate(album)
+                with self._lock:
+                    if version != self._versions[album]:
+                        break
+                    self._queues[album].append(song)
+                generated += 1
+        elapsed = time.perf_counter() - start
+        if generated:
+            self.generated += generated
+            self.rate = generated / elapsed if elapsed else 0.0
+            logger.info(
+                'Refilled song pool with %d songs at %.1f songs/s, depth %s',
+                generated, self.rate, self.depth())
+        return generated
+
+    def run(self):
+        while True:
+            try:
+                self.refill()
+            except Exception:
+                logger.exception('Failed to refill song pool.')
+            time.sleep(self.interval)
+
+    def start(self):
+        """Start the refill thread unless it is already running in this process."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            # Threads don't survive a fork, so each worker starts its own
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self.run, name='song-pool', daemon=True)
+            self._thread.start()
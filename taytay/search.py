@@ -0,0 +1,99 @@
+"""Full text search over the titles and lyrics of songs.
+
+``taytay_song`` and ``taytay_usersong`` have a ``search_vector`` column with
+a GIN index, which a trigger keeps up to date when a song is written. The
+column isn't a model field, so it's never loaded with the songs.
+"""
+from django.conf import settings
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from . import models, pagination
+
+
+# Must match the configuration used by the trigger
+CONFIG = 'pg_catalog.english'
+
+# Ranks are compared as integers so cursors hold them exactly
+RANK = (
+    "(ts_rank(s.search_vector, plainto_tsquery('{}', %s)) * 1000000)::integer".format(CONFIG))
+
+# Matches are marked with control characters, so the snippet can be escaped
+# before the marks are turned into tags
+START, STOP = '\x02', '\x03'
+
+HEADLINE_OPTIONS = (
+    'MaxFragments=2, MinWords=5, MaxWords=15, FragmentDelimiter=" ... ", '
+    'StartSel={}, StopSel={}'.format(START, STOP))
+
+# Only the most recent matches are ranked, so a common word costs about as much
+# as a rare one, and every page of a search ranks the same matches. One more
+# match than are ranked is found, to tell whether some were left out. The
+# snippet is only made for the rows of the page.
+SEARCH = """
+SELECT page.id, page.title, page.slug, {outer_columns} page.rank, page.candidates,
+    ts_headline('{config}', page.lyrics, plainto_tsquery('{config}', %s), %s) AS snippet
+FROM (
+    SELECT s.id, s.title, s.slug, s.lyrics, {inner_columns} {rank} AS rank, s.candidates
+    FROM (
+        SELECT c.*, count(*) OVER () AS candidates, row_number() OVER (ORDER BY c.id DESC) AS n
+        FROM (
+            SELECT * FROM {table}
+            WHERE search_vector @@ plainto_tsquery('{config}', %s)
+            ORDER BY id DESC
+            LIMIT %s + 1
+        ) AS c
+    ) AS s
+    WHERE s.n <= %s {after}
+    ORDER BY rank DESC, s.id DESC
+    LIMIT %s
+) AS page
+ORDER BY page.rank DESC, page.id DESC
+"""
+
+# Extra columns loaded for each kind of song
+COLUMNS = {
+    models.Song: ['album_id'],
+    models.UserSong: [],
+}
+
+
+def highlight(snippet):
+    """HTML for a snippet with the matches in bold."""
+    return mark_safe(escape(snippet).replace(START, '<b>').replace(STOP, '</b>'))
+
+
+def search(model, terms, cursor=None, per_page=20, max_ranked=None):
+    """Page of songs matching the search terms, best match first.
+
+    Only the ``max_ranked`` most recent matches are ranked, SEARCH_MAX_RANKED
+    by default, and the page is ``truncated`` when there are more. Each
+    song has its ``rank`` and a ``snippet`` of the lyrics with the matches in
+    ``<b>`` tags. Raises ValueError if the cursor is invalid.
+    """
+    if max_ranked is None:
+        max_ranked = settings.SEARCH_MAX_RANKED
+    columns = COLUMNS[model]
+    params = [terms, HEADLINE_OPTIONS, terms, terms, max_ranked, max_ranked]
+    after = ''
+    if cursor:
+        rank, pk = pagination.decode_cursor(cursor, 2)
+        if not (isinstance(rank, int) and isinstance(pk, int)):
+            raise ValueError('Invalid cursor {!r}'.format(cursor))
+        after = 'AND ({}, s.id) < (%s, %s)'.format(RANK)
+        params += [terms, rank, pk]
+    sql = SEARCH.format(
+        outer_columns=''.join('page.{}, '.format(column) for column in columns),
+        inner_columns=''.join('s.{}, '.format(column) for column in columns),
+        config=CONFIG, rank=RANK, table=model._meta.db_table, after=after)
+    songs = list(model.objects.raw(sql, params + [per_page + 1]))
+    for song in songs:
+        song.snippet = highlight(song.snippet)
+    next_cursor = None
+    if len(songs) > per_page:
+        songs = songs[:per_page]
+        next_cursor = pagination.encode_cursor([songs[-1].rank, songs[-1].pk])
+    page = pagination.KeysetPage(songs, next_cursor)
+    page.max_ranked = max_ranked
+    page.truncated = bool(songs) and songs[0].candidates > max_ranked
+    return page
@@ -28,6 +28,8 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    # First, so the time spent in the other middleware is included
+    'taytay.timing.TimingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -63,6 +65,20 @@ DATABASES = {
     'default': dj_database_url.config(default='postgres:///taytay'),
 }
 
+# Shared by every process, so invalidations made by one (such as a management
+# command) reach the others. Use memcached or the database cache when the web
+# processes run on more than one host.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get(
+            'CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', os.path.join(BASE_DIR, 'cache')),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('CACHE_MAX_ENTRIES', 10000)),
+        },
+    },
+}
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
@@ -132,13 +148,22 @@ LOGGING = {
         'default': {
             'format': '[%(asctime)s: %(levelname)s/%(name)s] - %(message)s',
         },
+        'message': {
+            'format': '%(message)s',
+        },
     },
     'handlers': {
         'console': {
             'level': 'INFO',
             'class': 'logging.StreamHandler',
             'formatter': 'default',
-        }
+        },
+        # One JSON object per line
+        'timing': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+            'formatter': 'message',
+        },
     },
     'root': {
         'level': 'INFO',
@@ -148,6 +173,11 @@ LOGGING = {
         'django': {
             'propagate': True,
         },
+        'taytay.timing': {
+            'level': 'INFO',
+            'handlers': ['timing', ],
+            'propagate': False,
+        },
     }
 }
 
@@ -162,12 +192,62 @@ SILENCED_SYSTEM_CHECKS = [
 
 BAELOR_API_KEY = os.environ.get('BAELOR_API_KEY', '')
 
+BAELOR_API_URL = os.environ.get('BAELOR_API_URL', 'https://baelor.io/api/v0/')
+
+# Number of built Markov chains (one per album plus all albums) kept per process
+MARKOV_CACHE_SIZE = int(os.environ.get('MARKOV_CACHE_SIZE', 10))
+
+# Chains saved by the build_markov_models command and loaded at startup
+MARKOV_MODEL_ROOT = os.environ.get('MARKOV_MODEL_ROOT', os.path.join(BASE_DIR, 'markov'))
+
+# Songs generated ahead of time per album by a background thread in each process.
+# The thread competes with requests for the GIL while it refills the pool, so
+# set it to 0 when workers are CPU bound and every request should be served first.
+SONG_POOL_SIZE = int(os.environ.get('SONG_POOL_SIZE', 10))
+
+SONG_POOL_INTERVAL = float(os.environ.get('SONG_POOL_INTERVAL', 1))
+
+# Seconds that songs generated from a seed are cached for
+SONG_CACHE_TIMEOUT = int(os.environ.get('SONG_CACHE_TIMEOUT', 60 * 60 * 24))
+
+# Seconds that rendered saved song pages are cached for, by the server and by clients
+SONG_PAGE_TIMEOUT = int(os.environ.get('SONG_PAGE_TIMEOUT', 60 * 60 * 24))
+
+# Seconds that rendered song list pages are cached for, until a song is saved
+SONG_LIST_TIMEOUT = int(os.environ.get('SONG_LIST_TIMEOUT', 60 * 60))
+
+# Seconds that the rendered homepage is cached for, until its templates change
+HOMEPAGE_TIMEOUT = int(os.environ.get('HOMEPAGE_TIMEOUT', 60 * 60 * 24))
+
+# Seconds that the albums listed by the song forms are cached for, unless albums change sooner
+ALBUMS_TIMEOUT = int(os.environ.get('ALBUMS_TIMEOUT', 60 * 60))
+
+# Time the phases of each request, for a Server-Timing header and a JSON log line
+REQUEST_TIMING = os.environ.get('REQUEST_TIMING', 'on') == 'on'
+
+# Search results shown at a time
+SEARCH_PAGE_SIZE = 24
+
+# Most matches ranked per search, to bound the cost of searching for common words
+SEARCH_MAX_RANKED = int(os.environ.get('SEARCH_MAX_RANKED', 2000))
+
 # Conditional test settings
 if 'test' in sys.argv:
     LOGGING['root']['level'] = 'WARNING'
+    LOGGING['loggers']['taytay.timing']['level'] = 'WARNING'
 
     STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
 
+    MARKOV_MODEL_ROOT = os.path.join(BASE_DIR, 'markov-test')
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+
+    SONG_POOL_SIZE = 0
+
     PASSWORD_HASHERS = (
         'django.contrib.auth.hashers.SHA1PasswordHasher',
         'django.contrib.auth.hashers.MD5PasswordHasher',
@@ -0,0 +1,271 @@
+"""Apply song data from the Baelor API to the database in bulk."""
+import collections
+import hashlib
+import json
+import time
+
+from django.db import connection, transaction
+
+from . import chains, models, pages
+
+
+ALBUM_FIELDS = ('title', 'label', 'genres', 'producers')
+
+SONG_FIELDS = ('title', 'album', 'lyrics', 'writers', 'producers')
+
+# Changed songs kept to update the chains with before rebuilding the albums instead
+MAX_DELTAS = 1000
+
+
+def content_hash(values):
+    """Digest of the synced fields of a row, to find rows which changed."""
+    data = json.dumps(list(values), ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def song_hash(album_slug, info):
+    """Content hash of a song, which depends on the slug of its album rather than the id."""
+    return content_hash([
+        info['title'], album_slug, info['lyrics'], info['writers'], info['producers']])
+
+
+def parse_song(song):
+    """Split an API result into the album slug and fields and the song fields."""
+    album = song['album']
+    album_info = {
+        'title': album['name'],
+        'label': album['label'],
+        'genres': album['genres'],
+        'producers': album['producers'],
+    }
+    song_info = {
+        'title': song['title'],
+        'lyrics': '\n'.join(line['content'] for line in song['lyrics']),
+        'writers': song['writers'],
+        'producers': song['producers'],
+    }
+    return album['slug'], album_info, song_info
+
+
+def bulk_update(model, rows, fields, batch_size=500):
+    """Update many rows with one ``UPDATE ... FROM (VALUES ...)`` per batch.
+
+    ``rows`` is a list of ``(pk, values)`` with the values in the order of
+    ``fields``.
+    """
+    qn = connection.ops.quote_name
+    opts = model._meta
+    columns = [opts.get_field(name) for name in fields]
+    placeholder = '({})'.format(', '.join(
+        ['%s::integer'] +
+        ['%s::{}'.format(field.db_type(connection)) for field in columns]))
+    sql = 'UPDATE {table} AS t SET {assignments} FROM (VALUES {{values}}) AS v({names}) ' \
+        'WHERE t.{pk} = v.{pk}'.format(
+            table=qn(opts.db_table),
+            assignments=', '.join('{0} = v.{0}'.format(qn(field.column)) for field in columns),
+            names=', '.join([qn(opts.pk.column)] + [qn(field.column) for field in columns]),
+            pk=qn(opts.pk.column))
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            params = []
+            for pk, values in batch:
+                params.append(pk)
+                for field, value in zip(columns, values):
+                    params.append(field.get_db_prep_save(value, connection))
+            cursor.execute(sql.format(values=', '.join([placeholder] * len(batch))), params)
+
+
+class SyncSummary(object):
+    """Slugs of the songs touched by a sync and the time taken by each step.
+
+    Changes to the chains are kept as ``(album, old lyrics, new lyrics)``
+    deltas until ``update_chains`` is called. Past ``MAX_DELTAS`` the albums
+    are rebuilt instead, so the lyrics of a large sync aren't held in memory.
+    """
+
+    def __init__(self):
+        self.deltas = []
+        self.rebuild = set()
+        self.created = []
+        self.changed = []
+        self.unchanged = []
+        self.deleted = []
+        self.albums_created = 0
+        self.albums_changed = 0
+        self.timings = collections.OrderedDict()
+        self._start = time.perf_counter()
+
+    def lap(self, step):
+        """Add the time since the previous step to the time taken by this step."""
+        now = time.perf_counter()
+        self.timings[step] = self.timings.get(step, 0) + now - self._start
+        self._start = now
+
+    def add_deltas(self, deltas):
+        self.deltas.extend(deltas)
+        if len(self.deltas) > MAX_DELTAS:
+            self.rebuild.update(album for album, _, _ in self.deltas)
+            self.deltas = []
+
+    def update_chains(self):
+        """Apply the changes to the chains and rebuild the albums with too many."""
+        self._start = time.perf_counter()
+        chains.apply_deltas([delta for delta in self.deltas if delta[0] not in self.rebuild])
+        chains.rebuild_albums(self.rebuild)
+        self.deltas = []
+        self.rebuild = set()
+        self.lap('chains')
+
+    def update(self, other):
+        """Add the songs, changes and timings of another sync, such as the next batch."""
+        self.add_deltas(other.deltas)
+        self.rebuild.update(other.rebuild)
+        for name in ('created', 'changed', 'unchanged', 'deleted'):
+            getattr(self, name).extend(getattr(other, name))
+        self.albums_created += other.albums_created
+        self.albums_changed += other.albums_changed
+        for step, seconds in other.timings.items():
+            self.timings[step] = self.timings.get(step, 0) + seconds
+
+    @property
+    def total_time(self):
+        return sum(self.timings.values())
+
+
+def sync_albums(albums, summary):
+    """Create or update albums.
+
+    Returns the ids of the albums by slug and the titles of the existing
+    albums by id from before they were updated.
+    """
+    existing = dict(
+        (row[0], row[1:]) for row in
+        models.Album.objects.values_list('slug', 'id', *ALBUM_FIELDS))
+    new, changed = [], []
+    for slug, info in albums.items():
+        values = tuple(info[name] for name in ALBUM_FIELDS)
+        if slug not in existing:
+            new.append(models.Album(slug=slug, **info))
+            continue
+        pk, old_values = existing[slug][0], existing[slug][1:]
+        if tuple(old_values) != values:
+            changed.append((pk, values))
+    models.Album.objects.bulk_create(new)
+    bulk_update(models.Album, changed, ALBUM_FIELDS)
+    summary.albums_created = len(new)
+    summary.albums_changed = len(changed)
+    if new or changed:
+        # Bulk writes don't send the signals which do this
+        pages.invalidate_albums()
+    ids = dict((slug, values[0]) for slug, values in existing.items())
+    if new:
+        ids.update(models.Album.objects.filter(
+            slug__in=[album.slug for album in new]).values_list('slug', 'id'))
+    titles = dict((values[0], values[1]) for values in existing.values())
+    return ids, titles
+
+
+def sync_songs(results, prune=False, update_chains=True):
+    """Bring the albums and songs in line with the API results in one transaction.
+
+    Existing songs are compared by content hash, so unchanged songs aren't
+    written. New songs are inserted with ``bulk_create`` and changed songs
+    with one ``UPDATE`` per batch. The saved Markov chains are updated with
+    the changes after the transaction commits.
+    """
+    summary = SyncSummary()
+    albums = collections.OrderedDict()
+    songs = collections.OrderedDict()
+    for song in results:
+        album_slug, album_info, song_info = parse_song(song)
+        albums.setdefault(album_slug, album_info)
+        songs[song['slug']] = (album_slug, song_info)
+    summary.lap('parse')
+    # Changes to the chains are recorded as (album, old lyrics, new lyrics)
+    deltas = []
+    with transaction.atomic(), chains.suspend_updates():
+        album_ids, old_titles = sync_albums(albums, summary)
+        titles = dict((album_ids[slug], info['title']) for slug, info in albums.items())
+        existing = models.Song.objects.all()
+        if not prune:
+            existing = existing.filter(slug__in=list(songs))
+        existing = dict(
+            (slug, (pk, digest)) for slug, pk, digest in
+            existing.values_list('slug', 'id', 'content_hash'))
+        summary.lap('load')
+        new, stale = [], []
+        for slug, (album_slug, info) in songs.items():
+            album_id = album_ids[album_slug]
+            values = tuple(album_id if name == 'album' else info[name] for name in SONG_FIELDS)
+            digest = song_hash(album_slug, info)
+            if slug not in existing:
+                new.append(models.Song(slug=slug, album_id=album_id, content_hash=digest, **info))
+                summary.created.append(slug)
+                deltas.append((titles[album_id], None, info['lyrics']))
+            elif existing[slug][1] != digest:
+                stale.append((slug, values, digest))
+            else:
+                summary.unchanged.append(slug)
+        # Rows hashed before they were last edited, or never hashed, are
+        # compared field by field so only real changes are counted
+        previous = dict(
+            (row[0], row[1:]) for row in
+            models.Song.objects.filter(slug__in=[slug for slug, _, _ in stale]).values_list(
+                'slug', *SONG_FIELDS))
+        changed = []
+        for slug, values, digest in stale:
+            old_values = previous[slug]
+            changed.append((existing[slug][0], values + (digest, )))
+            if tuple(old_values) == values:
+                summary.unchanged.append(slug)
+                continue
+            summary.changed.append(slug)
+            deltas.append((old_titles[old_values[1]], old_values[2], None))
+            deltas.append((titles[values[1]], None, values[2]))
+        summary.lap('compare')
+        models.Song.objects.bulk_create(new, batch_size=1000)
+        bulk_update(models.Song, changed, SONG_FIELDS + ('content_hash', ))
+        summary.lap('write')
+        renamed = [pk for pk, title in titles.items() if old_titles.get(pk, title) != title]
+        if renamed:
+            # Chains are saved by album title, so move the songs of renamed albums
+            skip = set(summary.created + summary.changed)
+            for slug, album_id, lyrics in models.Song.objects.filter(
+                    album_id__in=renamed).values_list('slug', 'album_id', 'lyrics'):
+                if slug not in skip:
+                    deltas.append((old_titles[album_id], lyrics, None))
+                    deltas.append((titles[album_id], None, lyrics))
+        if prune:
+            summary.deleted = delete_songs(set(existing) - set(songs), deltas)
+            summary.lap('prune')
+    summary.add_deltas(deltas)
+    if update_chains:
+        summary.update_chains()
+    return summary
+
+
+def delete_songs(slugs, deltas):
+    """Delete songs, recording their lyrics in deltas, and return their slugs."""
+    deleted = []
+    if slugs:
+        qs = models.Song.objects.filter(slug__in=list(slugs))
+        for slug, album, lyrics in qs.values_list('slug', 'album__title', 'lyrics'):
+            deleted.append(slug)
+            deltas.append((album, lyrics, None))
+        qs.delete()
+    return deleted
+
+
+def prune_songs(keep, update_chains=True):
+    """Delete every song not in ``keep``, after syncing the songs in batches."""
+    summary = SyncSummary()
+    deltas = []
+    with transaction.atomic(), chains.suspend_updates():
+        slugs = set(models.Song.objects.values_list('slug', flat=True)) - set(keep)
+        summary.deleted = delete_songs(slugs, deltas)
+    summary.lap('prune')
+    summary.add_deltas(deltas)
+    if update_chains:
+        summary.update_chains()
+    return summary
@@ -0,0 +1,22 @@
+"""Synthetic lyrics for benchmarking song generation at scale."""
+import random
+
+
+def make_words(vocabulary):
+    """Return a list of distinct made up words."""
+    return ['la{}'.format(i) for i in range(vocabulary)]
+
+
+def make_line(words, rng, min_words=4, max_words=10):
+    """Make a line of lyrics favouring common words, roughly like real lyrics."""
+    size = len(words)
+    return ' '.join(
+        words[int(size ** rng.random()) - 1]
+        for _ in range(rng.randint(min_words, max_words)))
+
+
+def make_corpus(songs, lines=40, vocabulary=2000, seed=0):
+    """Return the lyrics of a number of songs with one line per row."""
+    rng = random.Random(seed)
+    words = make_words(vocabulary)
+    return ['\n'.join(make_line(words, rng) for _ in range(lines)) for _ in range(songs)]
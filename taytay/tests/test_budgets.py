@@ -0,0 +1,140 @@
+import io
+
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from .. import chains, fake_baelor, models, sync, synthetic
+from ..views import make_save_token
+from .utils import QueryBudgetMixin
+
+
+ALBUMS = ('Red', '1989', 'Speak Now')
+
+# More rows than QueryBudgetMixin.full_scan_rows, so full scans are caught
+ROWS = 150
+
+
+def make_songs(count=ROWS):
+    """Songs in the API format spread over the albums."""
+    return [
+        fake_baelor.make_song('song-{}'.format(i), ALBUMS[i % len(ALBUMS)], lyrics)
+        for i, lyrics in enumerate(synthetic.make_corpus(count, lines=8))
+    ]
+
+
+class ViewBudgetTestCase(QueryBudgetMixin, TestCase):
+    """Queries run by each page."""
+
+    def setUp(self):
+        chains.chain_cache.clear()
+        sync.sync_songs(make_songs())
+        models.UserSong.objects.bulk_create(
+            models.UserSong(title='Song {}'.format(i), lyrics='...') for i in range(ROWS))
+        self.song = models.UserSong.objects.create(title='Style', lyrics='Midnight')
+
+    def test_homepage(self):
+        """The homepage form only has a title, and the page is then cached."""
+        with self.assertQueryBudget(0):
+            response = self.client.get(reverse('home'))
+        self.assertEqual(response.status_code, 200)
+        with self.assertQueryBudget(0), self.assertTemplateNotUsed('homepage.html'):
+            cached = self.client.get(reverse('home'))
+        self.assertEqual(cached.content, response.content)
+
+    def test_generate(self):
+        """List the albums and fingerprint and build the chain once, then only use the caches."""
+        with self.assertQueryBudget(4):
+            response = self.client.get(reverse('new-song'), {'album': 'red', 'seed': 1})
+        self.assertEqual(response.status_code, 200)
+        with self.assertQueryBudget(0):
+            response = self.client.get(reverse('new-song'), {'album': 'red', 'seed': 2})
+        self.assertEqual(response.status_code, 200)
+
+    def test_save(self):
+        token = make_save_token('Style', 'Midnight')
+        with self.assertQueryBudget(1):
+            response = self.client.post(reverse('new-song'), {'token': token})
+        self.assertEqual(response.status_code, 302)
+
+    def test_song_list(self):
+        """Every page is one query, without a count."""
+        with self.assertQueryBudget(1):
+            response = self.client.get(reverse('song-list'))
+        self.assertEqual(response.status_code, 200)
+        cursor = response.context['page_obj'].next_cursor
+        with self.assertQueryBudget(1):
+            response = self.client.get(reverse('song-list'), {'cursor': cursor})
+        self.assertEqual(response.status_code, 200)
+
+    def test_song_detail(self):
+        """Saved songs are looked up once, then served from the cache."""
+        with self.assertQueryBudget(1):
+            response = self.client.get(self.song.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        with self.assertQueryBudget(0):
+            response = self.client.get(self.song.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+
+    def test_search(self):
+        """Search finds matches through the index, then looks up the albums of songs."""
+        with self.assertQueryBudget(1):
+            response = self.client.get(reverse('search'), {'q': 'style'})
+        self.assertEqual(len(response.context['songs']), 1)
+        with self.assertQueryBudget(2):
+            response = self.client.get(reverse('search'), {'q': 'la17', 'source': 'lyrics'})
+        self.assertTrue(response.context['songs'])
+
+    def test_build_chain(self):
+        """Chains are built from the songs of an album without reading every song."""
+        models.Album.objects.bulk_create(
+            models.Album(title='Album {}'.format(i), slug='album-{}'.format(i), label='',
+                         genres=[], producers=[])
+            for i in range(ROWS))
+        self.assertQuerysetNoFullScan(chains.lyrics_queryset('Red'))
+
+
+class CommandBudgetTestCase(QueryBudgetMixin, TestCase):
+    """Queries run by the management commands."""
+
+    def setUp(self):
+        self.api = fake_baelor.FakeBaelor(make_songs())
+        self.api.start()
+        self.addCleanup(self.api.stop)
+        settings = self.settings(BAELOR_API_URL=self.api.url, BAELOR_API_KEY='XXXXXX')
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def call_command(self, *args):
+        call_command('fetch_song_data', *args, stdout=io.StringIO(), stderr=io.StringIO())
+
+    def test_fetch_song_data(self):
+        """The number of queries doesn't grow with the number of songs."""
+        with self.assertQueryBudget(11):
+            self.call_command()
+        songs = make_songs(ROWS + 10)
+        songs[1]['title'] = 'Changed'
+        self.api.set_songs(songs[1:])
+        with self.assertQueryBudget(17):
+            self.call_command('--prune')
+
+
+class QueryBudgetTestCase(QueryBudgetMixin, TestCase):
+    """The budget assertions themselves."""
+
+    def setUp(self):
+        models.UserSong.objects.bulk_create(
+            models.UserSong(title='Song {}'.format(i), lyrics='...') for i in range(ROWS))
+
+    def test_query_count(self):
+        with self.assertRaisesRegex(AssertionError, 'Ran 2 queries, over the budget of 1'):
+            with self.assertQueryBudget(1):
+                list(models.UserSong.objects.filter(slug='a'))
+                list(models.UserSong.objects.filter(slug='b'))
+
+    def test_full_scan(self):
+        """Reading a large table in full fails, a small one is allowed."""
+        queryset = models.UserSong.objects.filter(lyrics='...')
+        with self.assertRaisesRegex(AssertionError, 'Full scan of taytay_usersong'):
+            self.assertQuerysetNoFullScan(queryset)
+        self.assertQuerysetNoFullScan(queryset, full_scan_rows=ROWS + 1)
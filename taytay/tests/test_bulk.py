@@ -0,0 +1,25 @@
+from django.test import SimpleTestCase
+
+from .. import bulk
+
+
+class CopyTextTestCase(SimpleTestCase):
+    """Format rows for COPY."""
+
+    def test_escape(self):
+        self.assertEqual(bulk.copy_text('a\tb\\c\nd\r'), 'a\\tb\\\\c\\nd\\r')
+        self.assertEqual(bulk.copy_text(None), '\\N')
+
+    def test_array(self):
+        """Array elements are quoted and then escaped again for COPY."""
+        self.assertEqual(
+            bulk.array_literal(['Max Martin', 'A "B", C']), '{"Max Martin","A \\"B\\", C"}')
+        self.assertEqual(bulk.copy_text([]), '{}')
+        self.assertEqual(bulk.copy_text(['a\\b']), '{"a\\\\\\\\b"}')
+
+    def test_reader(self):
+        """Rows are formatted as they are read, in chunks of any size."""
+        reader = bulk.CopyReader([('a', None), ('b', ['c'])])
+        self.assertEqual(reader.read(3), 'a\t\\')
+        self.assertEqual(reader.read(), 'N\nb\t{"c"}\n')
+        self.assertEqual(reader.read(), '')
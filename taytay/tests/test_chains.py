@@ -0,0 +1,261 @@
+import shutil
+import tempfile
+from unittest.mock import call, Mock, patch
+
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+
+import markovify
+
+from .. import chains, compact, models, synthetic
+from .utils import shared_cache
+
+
+class ChainCacheTestCase(TestCase):
+    """Caching built Markov chains per album."""
+
+    def setUp(self):
+        self.build = Mock(side_effect=lambda album: Mock(album=album))
+        self.cache = chains.ChainCache(self.build, max_size=2)
+
+    def test_reuse_chain(self):
+        """Chains are only built once per album."""
+        chain = self.cache.get('Red')
+        self.assertEqual(chain.album, 'Red')
+        self.assertIs(self.cache.get('Red'), chain)
+        self.build.assert_called_once_with('Red')
+
+    def test_all_albums(self):
+        """The chain for all albums is cached under None."""
+        self.cache.get()
+        self.assertIn(None, self.cache)
+        self.build.assert_called_once_with(None)
+
+    def test_evict_least_recently_used(self):
+        """The least recently used chain is dropped when the cache is full."""
+        self.cache.get('Red')
+        self.cache.get('1989')
+        self.cache.get('Red')
+        self.cache.get('Fearless')
+        self.assertEqual(len(self.cache), 2)
+        self.assertIn('Red', self.cache)
+        self.assertNotIn('1989', self.cache)
+
+    def test_invalidate(self):
+        """Bumping the shared version rebuilds the chains."""
+        self.cache.get('Red')
+        chains.invalidate()
+        self.cache.get('Red')
+        self.assertEqual(self.build.call_count, 2)
+
+    def test_invalidate_other_process(self):
+        """Chains invalidated by another process, such as a command, are rebuilt."""
+        with shared_cache() as run:
+            self.cache.get('Red')
+            run('from taytay import chains\nchains.invalidate_album("Red")')
+            self.cache.get('Red')
+        self.assertEqual(self.build.call_count, 2)
+
+    def test_build_chain(self):
+        """Chains are built from the lyrics of the album, one song at a time."""
+        red = models.Album.objects.create(
+            title='Red', slug='red', producers=[], genres=[])
+        models.Song.objects.create(
+            title='Red', slug='red', album=red, producers=[], writers=[],
+            lyrics='Loving him was red\nLoving him was blue')
+        models.Song.objects.create(
+            title='Treacherous', slug='treacherous', album=red, producers=[], writers=[],
+            lyrics='This slope is treacherous')
+        chain = chains.build_chain('Red')
+        self.assertEqual(
+            chain.rejoined_text,
+            'Loving him was red\nLoving him was blue\nThis slope is treacherous')
+        expected = markovify.text.NewlineText(
+            'Loving him was red\nLoving him was blue\nThis slope is treacherous')
+        self.assertEqual(chain.chain.model, expected.chain.model)
+        self.assertEqual(chains.build_chain('1989').chain.model, {})
+
+
+class ChainSignalTestCase(TransactionTestCase):
+    """Updating the chains once songs saved or deleted are committed."""
+
+    def setUp(self):
+        self.build = Mock(side_effect=lambda album: Mock(album=album))
+        self.cache = chains.ChainCache(self.build, max_size=2)
+        self.red = models.Album.objects.create(
+            title='Red', slug='red', producers=[], genres=[])
+
+    def create_song(self, slug):
+        return models.Song.objects.create(
+            title='Red', slug=slug, album=self.red, producers=[], writers=[],
+            lyrics='Loving him was red.')
+
+    def test_song_saved(self):
+        """Saving or deleting a song invalidates the chains."""
+        self.cache.get('Red')
+        song = self.create_song('red')
+        self.cache.get('Red')
+        song.delete()
+        self.cache.get('Red')
+        self.assertEqual(self.build.call_count, 3)
+
+    def test_rolled_back(self):
+        """Songs saved in a transaction which is rolled back leave the chains alone."""
+        self.cache.get('Red')
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.create_song('red')
+                raise ValueError
+        self.cache.get('Red')
+        self.assertEqual(self.build.call_count, 1)
+        self.create_song('red')
+        self.cache.get('Red')
+        self.assertEqual(self.build.call_count, 2)
+
+    def test_one_update_per_transaction(self):
+        """Songs changed together update the chains once, when they are committed."""
+        with patch('taytay.chains.apply_deltas') as apply_deltas:
+            with transaction.atomic():
+                self.create_song('red')
+                self.create_song('treacherous')
+                self.assertFalse(apply_deltas.called)
+        apply_deltas.assert_called_once_with(
+            [('Red', None, 'Loving him was red.'), ('Red', None, 'Loving him was red.')])
+        with patch('taytay.chains.rebuild_albums') as rebuild_albums:
+            with transaction.atomic():
+                song = self.create_song('state-of-grace')
+                song.lyrics = 'Loving him was blue.'
+                song.save()
+                models.Song.objects.get(slug='red').save()
+        rebuild_albums.assert_called_once_with({'Red'})
+
+
+class LyricsTextTestCase(TestCase):
+    """Adding and removing songs from a chain."""
+
+    def test_apply_delta(self):
+        """Replacing a song gives the same chain as building without it."""
+        lyrics_generator = chains.LyricsText()
+        lyrics_generator.add('Loving him was red\nLoving him was blue')
+        lyrics_generator.add('This slope is treacherous\nLoving him was red')
+        lyrics_generator.apply_delta(
+            removed='This slope is treacherous\nLoving him was red', added='Burning red')
+        expected = chains.LyricsText()
+        expected.add('Loving him was red\nLoving him was blue\nBurning red')
+        self.assertEqual(lyrics_generator.chain.model, expected.chain.model)
+        self.assertEqual(
+            sorted(lyrics_generator.rejoined_text.splitlines()),
+            sorted(expected.rejoined_text.splitlines()))
+
+    def test_repeated_lines(self):
+        """Lines repeated by several songs stay in the text until every song is removed."""
+        lyrics_generator = chains.LyricsText()
+        lyrics_generator.add('Loving him was red\nLoving him was blue')
+        lyrics_generator.add('Burning red\nLoving him was red')
+        lyrics_generator.remove('Loving him was red\nLoving him was blue')
+        self.assertEqual(lyrics_generator.rejoined_text, 'Loving him was red\nBurning red')
+        lyrics_generator.remove('Burning red\nLoving him was red')
+        self.assertEqual(lyrics_generator.rejoined_text, '')
+        self.assertEqual(lyrics_generator.chain.model, {})
+
+    def test_from_compact(self):
+        """Compact chains are unpacked so they can be changed."""
+        lyrics_generator = chains.LyricsText()
+        lyrics_generator.add('Loving him was red\nLoving him was blue')
+        mapped = compact.CompactText(compact.CompactChain(compact.encode(
+            lyrics_generator.chain.model, 2, lyrics_generator.rejoined_text)))
+        unpacked = chains.LyricsText.from_compact(mapped)
+        unpacked.remove('Loving him was blue')
+        expected = chains.LyricsText()
+        expected.add('Loving him was red')
+        self.assertEqual(unpacked.chain.model, expected.chain.model)
+        self.assertEqual(unpacked.rejoined_text, 'Loving him was red')
+
+
+class ChainArtifactTestCase(TestCase):
+    """Saving built chains to disk."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        red = models.Album.objects.create(
+            title='Red', slug='red', producers=[], genres=[])
+        models.Song.objects.create(
+            title='Red', slug='red', album=red, producers=[], writers=[],
+            lyrics='Loving him is like driving a new Maserati down a dead-end street\n'
+                   'Faster than the wind, passionate as sin, ending so suddenly')
+
+    def test_save_and_load(self):
+        """Saved chains are loaded instead of built."""
+        with self.settings(MARKOV_MODEL_ROOT=self.root):
+            paths = chains.build_artifacts()
+            self.assertEqual(len(paths), 2)
+            with patch('taytay.chains.build_chain') as mock_build:
+                lyrics_generator = chains.load_chain('Red')
+                self.assertFalse(mock_build.called)
+        expected = chains.build_chain('Red')
+        self.assertEqual(lyrics_generator.chain.album, 'Red')
+        self.assertEqual(lyrics_generator.chain.to_model(), expected.chain.model)
+        self.assertEqual(str(lyrics_generator.rejoined_text), expected.rejoined_text)
+        self.assertEqual(len(expected.rejoined_text.splitlines()), 2)
+        self.assertTrue(lyrics_generator.chain.walk())
+
+    def test_missing_artifact(self):
+        """Chains are built when they haven't been saved."""
+        with self.settings(MARKOV_MODEL_ROOT=self.root):
+            with patch('taytay.chains.build_chain') as mock_build:
+                lyrics_generator = chains.load_chain('Red')
+        mock_build.assert_called_with('Red')
+        self.assertEqual(lyrics_generator, mock_build.return_value)
+
+    def test_old_format(self):
+        """Chains saved in an older format are rebuilt."""
+        with self.settings(MARKOV_MODEL_ROOT=self.root):
+            chains.build_artifacts()
+            with patch('taytay.compact.FORMAT_VERSION', compact.FORMAT_VERSION + 1):
+                with patch('taytay.chains.build_chain') as mock_build:
+                    chains.load_chain('Red')
+        mock_build.assert_called_with('Red')
+
+    def test_stale_artifact(self):
+        """Chains saved before songs were written without updating them are rebuilt."""
+        with self.settings(MARKOV_MODEL_ROOT=self.root):
+            chains.build_artifacts()
+            models.Song.objects.bulk_create([models.Song(
+                title='Red', slug='red-2', album=models.Album.objects.get(title='Red'),
+                producers=[], writers=[], lyrics='Burning red')])
+            with patch('taytay.chains.build_chain') as mock_build:
+                chains.load_chain('Red')
+            mock_build.assert_called_with('Red')
+            chains.chain_cache.clear()
+            chains.preload()
+            self.assertNotIn('Red', chains.chain_cache)
+            self.assertEqual(chains.stale_artifacts(), [None, 'Red'])
+
+    def test_apply_deltas(self):
+        """Saved chains are updated with small changes and rebuilt after large ones."""
+        red = models.Album.objects.get(title='Red')
+        for i, lyrics in enumerate(synthetic.make_corpus(4, lines=10)):
+            models.Song.objects.create(
+                title='Red', slug='red-{}'.format(i), album=red, producers=[], writers=[],
+                lyrics=lyrics)
+        with self.settings(MARKOV_MODEL_ROOT=self.root):
+            chains.build_artifacts()
+            with patch('taytay.chains.build_chain', side_effect=chains.build_chain) as mock_build:
+                chains.apply_deltas([('Red', None, 'Burning red')])
+                self.assertFalse(mock_build.called)
+                self.assertIn('Burning red', chains.load_chain('Red').rejoined_text)
+                # Rebuilt from the songs in the database, which this one isn't
+                chains.apply_deltas([('Red', None, '\n'.join(['Burning red'] * 20))])
+            self.assertNotIn('Burning red', chains.load_chain('Red').rejoined_text)
+        self.assertEqual(mock_build.call_args_list, [call('Red'), call(None)])
+
+    def test_preload(self):
+        """Saved chains are loaded into the cache at startup."""
+        chains.chain_cache.clear()
+        with self.settings(MARKOV_MODEL_ROOT=self.root):
+            chains.build_artifacts()
+            chains.preload()
+        self.assertIn(None, chains.chain_cache)
+        self.assertIn('Red', chains.chain_cache)
+        chains.chain_cache.clear()
@@ -1,11 +1,19 @@
 import io
-from unittest.mock import patch, Mock
+import json
+import os
+import shutil
+import tempfile
+from unittest.mock import ANY, patch, Mock
 
 from django.core.management import call_command
 from django.core.management.base import CommandError
-from django.test import override_settings, TestCase
+from django.db import connection
+from django.test import LiveServerTestCase, override_settings, TestCase
+from django.test.utils import CaptureQueriesContext
 
-from .. import models
+import requests
+
+from .. import bulk, chains, fake_baelor, models, sync, synthetic
 
 
 class CommandMixin(object):
@@ -22,7 +30,15 @@ class CommandMixin(object):
         return stdout, stderr
 
 
-@patch('requests.get')
+def api_response():
+    """Mock a response from the API streaming the data set as its json return value."""
+    response = Mock(status_code=200, headers={})
+    response.iter_content.side_effect = lambda chunk_size=1: iter(
+        [json.dumps(response.json.return_value).encode('utf-8')])
+    return response
+
+
+@patch('requests.Session.get')
 @override_settings(BAELOR_API_KEY='XXXXXX')
 class FetchSongDataTestCase(CommandMixin, TestCase):
     """Populate song data from Baelor API."""
@@ -38,7 +54,7 @@ class FetchSongDataTestCase(CommandMixin, TestCase):
 
     def test_fetch_songs(self, mock_get):
         """Fetch all songs."""
-        songs_response = Mock()
+        songs_response = api_response()
         songs_response.json.return_value = {
             'result': [
                 {
@@ -93,7 +109,8 @@ class FetchSongDataTestCase(CommandMixin, TestCase):
         ]
         self.call_command()
         mock_get.assert_called_with(
-            'https://baelor.io/api/v0/songs', headers={'Authorization': 'bearer XXXXXX'})
+            'https://baelor.io/api/v0/songs', headers={'Authorization': 'bearer XXXXXX'},
+            timeout=ANY, stream=True)
         songs = models.Song.objects.all()
         self.assertEqual(songs.count(), 1)
         self.assertEqual(songs[0].title, 'Welcome to New York')
@@ -101,9 +118,99 @@ class FetchSongDataTestCase(CommandMixin, TestCase):
         self.assertEqual(albums.count(), 1)
         self.assertEqual(albums[0].title, '1989')
 
+    def song_response(self, *songs):
+        """Mock a response from the API with simplified songs."""
+        response = api_response()
+        response.json.return_value = {
+            'result': [
+                {
+                    'slug': slug,
+                    'title': slug.title(),
+                    'writers': [],
+                    'producers': [],
+                    'album': {
+                        'slug': album.lower(),
+                        'name': album,
+                        'label': 'Big Machine',
+                        'genres': [],
+                        'producers': [],
+                    },
+                    'lyrics': [{'content': line} for line in lyrics.splitlines()],
+                } for slug, album, lyrics in songs
+            ],
+            'error': None,
+            'success': True,
+        }
+        return response
+
+    def test_record_changes(self, mock_get):
+        """Created, changed and deleted songs are reported."""
+        mock_get.return_value = self.song_response(
+            ('red', 'Red', 'Loving him was red'), ('sad', 'Red', 'Sad beautiful tragic'))
+        stdout, _ = self.call_command()
+        self.assertIn('Created 2, changed 0 and deleted 0 songs.', stdout.getvalue())
+        mock_get.return_value = self.song_response(
+            ('red', 'Red', 'Loving him was red\nBurning red'), ('style', '1989', 'Midnight'))
+        stdout, _ = self.call_command('--prune', verbosity=2)
+        self.assertIn('Created 1, changed 1 and deleted 1 songs.', stdout.getvalue())
+        self.assertIn('Deleted sad', stdout.getvalue())
+        self.assertEqual(
+            sorted(models.Song.objects.values_list('slug', flat=True)), ['red', 'style'])
+
+    def test_bulk_queries(self, mock_get):
+        """The number of queries doesn't grow with the number of songs."""
+        queries = []
+        for count in (2, 40):
+            models.Album.objects.all().delete()
+            mock_get.return_value = self.song_response(*(
+                ('song-{}'.format(i), 'Red', 'Line {}'.format(i)) for i in range(count)))
+            with CaptureQueriesContext(connection) as context:
+                self.call_command()
+            queries.append(len(context))
+        self.assertEqual(queries[0], queries[1])
+        self.assertEqual(models.Song.objects.count(), 40)
+
+    def test_unchanged_songs(self, mock_get):
+        """Songs are compared by content hash and unchanged songs aren't written."""
+        mock_get.return_value = self.song_response(
+            ('red', 'Red', 'Loving him was red'), ('style', '1989', 'Midnight'))
+        self.call_command()
+        models.Song.objects.filter(slug='red').update(content_hash='')
+        stdout, _ = self.call_command()
+        self.assertIn('Created 0, changed 0 and deleted 0 songs.', stdout.getvalue())
+        self.assertIn('2 songs unchanged', stdout.getvalue())
+        self.assertNotIn('', models.Song.objects.values_list('content_hash', flat=True))
+        mock_get.return_value = self.song_response(
+            ('red', 'Red', 'Loving him was red'), ('style', 'Red', 'Midnight'))
+        stdout, _ = self.call_command()
+        self.assertIn('Created 0, changed 1 and deleted 0 songs.', stdout.getvalue())
+        self.assertEqual(models.Song.objects.get(slug='style').album.title, 'Red')
+
+    def test_update_chains(self, mock_get):
+        """Saved Markov chains are updated with the changed songs."""
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        mock_get.return_value = self.song_response(
+            ('red', 'Red', 'Loving him was red'), ('style', '1989', 'Midnight'))
+        with self.settings(MARKOV_MODEL_ROOT=root):
+            self.call_command()
+            chains.build_artifacts()
+            mock_get.return_value = self.song_response(
+                ('red', 'Red', 'Burning red'), ('style', '1989', 'Midnight'))
+            # Every change is a large share of chains this small
+            with patch('taytay.chains.REBUILD_SHARE', float('inf')):
+                with patch('taytay.chains.build_chain') as mock_build:
+                    self.call_command()
+            self.assertFalse(mock_build.called)
+            red = chains.read_chain(chains.artifact_path('Red'))
+            everything = chains.read_chain(chains.artifact_path())
+        self.assertEqual(str(red.rejoined_text), 'Burning red')
+        self.assertEqual(str(everything.rejoined_text), 'Midnight\nBurning red')
+        self.assertEqual(red.chain.to_model(), chains.build_chain('Red').chain.model)
+
     def test_song_error(self, mock_get):
         """Handle errors when fetching songs."""
-        songs_response = Mock()
+        songs_response = api_response()
         songs_response.json.return_value = {
             'result': [],
             'error': '0x1073',
@@ -115,13 +222,30 @@ class FetchSongDataTestCase(CommandMixin, TestCase):
         with self.assertRaises(CommandError):
             self.call_command()
         mock_get.assert_called_with(
-            'https://baelor.io/api/v0/songs', headers={'Authorization': 'bearer XXXXXX'})
+            'https://baelor.io/api/v0/songs', headers={'Authorization': 'bearer XXXXXX'},
+            timeout=ANY, stream=True)
         albums = models.Album.objects.all()
         self.assertEqual(albums.count(), 0)
 
+    def test_http_error(self, mock_get):
+        """Responses with an error status or a body that isn't JSON are reported."""
+        error_response = api_response()
+        error_response.status_code = 503
+        error_response.raise_for_status.side_effect = requests.HTTPError('503 Server Error')
+        mock_get.return_value = error_response
+        with self.assertRaisesRegex(CommandError, '503 Server Error'):
+            self.call_command()
+        html_response = api_response()
+        html_response.iter_content.side_effect = lambda chunk_size=1: iter(
+            [b'<html>Bad Gateway</html>'])
+        mock_get.return_value = html_response
+        with self.assertRaisesRegex(CommandError, 'Invalid response'):
+            self.call_command()
+        self.assertFalse(models.SyncState.objects.exists())
+
     def test_build_lyrics(self, mock_get):
         """Build song lyrics from the response data."""
-        songs_response = Mock()
+        songs_response = api_response()
         songs_response.json.return_value = {
             'result': [
                 {
@@ -505,7 +629,470 @@ class FetchSongDataTestCase(CommandMixin, TestCase):
         ]
         self.call_command()
         mock_get.assert_called_with(
-            'https://baelor.io/api/v0/songs', headers={'Authorization': 'bearer XXXXXX'})
+            'https://baelor.io/api/v0/songs', headers={'Authorization': 'bearer XXXXXX'},
+            timeout=ANY, stream=True)
         songs = models.Song.objects.all()
         self.assertEqual(songs.count(), 1)
         self.assertTrue(songs[0].lyrics)
+
+
+@override_settings(BAELOR_API_KEY='XXXXXX')
+class ConditionalFetchTestCase(CommandMixin, TestCase):
+    """Skip syncing songs which haven't changed upstream."""
+
+    command = 'fetch_song_data'
+
+    def setUp(self):
+        self.api = fake_baelor.FakeBaelor([
+            fake_baelor.make_song('red', 'Red', 'Loving him was red'),
+            fake_baelor.make_song('style', '1989', 'Midnight'),
+        ])
+        self.api.start()
+        self.addCleanup(self.api.stop)
+        settings = self.settings(BAELOR_API_URL=self.api.url)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_not_modified(self):
+        """Send the validators from the last sync and skip syncing on a 304."""
+        stdout, _ = self.call_command()
+        self.assertIn('Created 2', stdout.getvalue())
+        state = models.SyncState.objects.get()
+        _, etag, last_modified = self.api.response()
+        self.assertEqual(state.etag, etag)
+        self.assertEqual(state.last_modified, last_modified)
+        with patch('taytay.sync.sync_songs') as mock_sync:
+            stdout, _ = self.call_command()
+        self.assertFalse(mock_sync.called)
+        self.assertIn('have not changed', stdout.getvalue())
+        self.assertEqual(self.api.requests[-1][1]['If-None-Match'], etag)
+
+    def test_changed(self):
+        """Only the changed songs are written when the catalogue changes."""
+        self.call_command()
+        self.api.set_songs([
+            fake_baelor.make_song('red', 'Red', 'Burning red'),
+            fake_baelor.make_song('style', '1989', 'Midnight'),
+        ])
+        stdout, _ = self.call_command()
+        self.assertIn('Created 0, changed 1 and deleted 0 songs.', stdout.getvalue())
+        self.assertIn('1 songs unchanged', stdout.getvalue())
+        self.assertEqual(models.Song.objects.get(slug='red').lyrics, 'Burning red')
+
+    def test_batches(self):
+        """Songs are written in batches as the response is read."""
+        with patch('taytay.sync.sync_songs', wraps=sync.sync_songs) as mock_sync:
+            stdout, _ = self.call_command('--batch-size', '1', '--prune')
+        self.assertEqual(mock_sync.call_count, 2)
+        self.assertIn('Created 2, changed 0 and deleted 0 songs.', stdout.getvalue())
+
+    def test_force(self):
+        """Ignore the validators with --force."""
+        self.call_command()
+        stdout, _ = self.call_command('--force')
+        self.assertNotIn('If-None-Match', self.api.requests[-1][1])
+        self.assertIn('2 songs unchanged', stdout.getvalue())
+
+
+@override_settings(BAELOR_API_KEY='XXXXXX')
+class PagedFetchTestCase(CommandMixin, TestCase):
+    """Fetch songs a page at a time, retrying failures and resuming interrupted syncs."""
+
+    command = 'fetch_song_data'
+
+    def setUp(self):
+        self.api = fake_baelor.FakeBaelor([
+            fake_baelor.make_song(
+                'song-{}'.format(i), 'Red' if i % 2 else '1989', 'Line {}'.format(i))
+            for i in range(7)
+        ])
+        self.api.start()
+        self.addCleanup(self.api.stop)
+        settings = self.settings(BAELOR_API_URL=self.api.url)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def pages(self):
+        return [path.split('page=')[-1] for path, _ in self.api.requests]
+
+    def test_pages(self):
+        """Fetch pages concurrently until a short page."""
+        stdout, _ = self.call_command('--per-page', '3', '--workers', '2')
+        self.assertIn('Created 7, changed 0 and deleted 0 songs.', stdout.getvalue())
+        self.assertEqual(models.Song.objects.count(), 7)
+        self.assertEqual(models.SyncState.objects.get().checkpoint, 0)
+        self.assertTrue(all('per_page=3' in path for path, _ in self.api.requests))
+
+    def test_resume(self):
+        """An interrupted sync resumes after the last page synced."""
+        sync_songs = sync.sync_songs
+        with patch('taytay.sync.sync_songs') as mock_sync:
+            mock_sync.side_effect = [
+                sync_songs(self.api.songs[:3], update_chains=False), ValueError('Interrupted')]
+            with self.assertRaises(ValueError):
+                self.call_command('--per-page', '3', '--workers', '1')
+        self.assertEqual(models.SyncState.objects.get().checkpoint, 1)
+        self.api.requests = []
+        stdout, _ = self.call_command('--per-page', '3', '--workers', '1', '--prune')
+        self.assertIn('Resuming after page 1.', stdout.getvalue())
+        self.assertNotIn('1', self.pages())
+        self.assertEqual(models.Song.objects.count(), 7)
+        self.assertEqual(models.SyncState.objects.get().checkpoint, 0)
+
+    def test_update_chains(self):
+        """The chains are updated once with the changes of every page."""
+        with patch('taytay.chains.apply_deltas') as mock_apply:
+            self.call_command('--per-page', '3', '--workers', '2')
+        mock_apply.assert_called_once_with(ANY)
+        self.assertEqual(len(mock_apply.call_args[0][0]), 7)
+
+    def test_update_chains_interrupted(self):
+        """The chains are updated with the pages synced before an interruption."""
+        sync_songs = sync.sync_songs
+        with patch('taytay.sync.sync_songs') as mock_sync, \
+                patch('taytay.chains.apply_deltas') as mock_apply:
+            mock_sync.side_effect = [
+                sync_songs(self.api.songs[:3], update_chains=False), ValueError('Interrupted')]
+            with self.assertRaises(ValueError):
+                self.call_command('--per-page', '3', '--workers', '1')
+        mock_apply.assert_called_once_with(ANY)
+        self.assertEqual(len(mock_apply.call_args[0][0]), 3)
+
+    def test_retry(self):
+        """Retry a failed request."""
+        self.api.failures = 1
+        self.call_command('--per-page', '10')
+        self.assertEqual(models.Song.objects.count(), 7)
+        self.api.failures = 1
+        with self.assertRaises(CommandError):
+            self.call_command('--retries', '0')
+
+    def test_album(self):
+        """Fetch the songs of one album."""
+        stdout, _ = self.call_command('--album', 'red')
+        self.assertEqual(self.api.requests[0][0], '/api/v0/albums/red/songs')
+        self.assertEqual(models.Song.objects.count(), 3)
+        with self.assertRaises(CommandError):
+            self.call_command('--album', 'red', '--prune')
+
+
+class ImportExportSongDataTestCase(CommandMixin, TestCase):
+    """Load and dump songs with COPY."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.songs = [
+            fake_baelor.make_song('red', 'Red', 'Loving him was red\n\tBurning \\ red'),
+            fake_baelor.make_song('style', '1989', 'Midnight\nYou come and pick me up'),
+        ]
+        self.songs[1]['writers'] = ['Max Martin', 'Shellback, "Jr"']
+
+    def write(self, name, songs, format='jsonl'):
+        path = os.path.join(self.root, name)
+        with bulk.open_dump(path, 'wt') as f:
+            if format == 'json':
+                json.dump({'result': songs, 'error': None, 'success': True}, f)
+            else:
+                for song in songs:
+                    f.write(json.dumps(song) + '\n')
+        return path
+
+    def test_import(self):
+        """Import songs from JSON lines, keeping arrays and special characters."""
+        self.command = 'import_song_data'
+        stdout, _ = self.call_command(self.write('songs.jsonl', self.songs))
+        self.assertIn('Created 2, changed 0 and left 0 songs unchanged.', stdout.getvalue())
+        style = models.Song.objects.get(slug='style')
+        self.assertEqual(style.writers, ['Max Martin', 'Shellback, "Jr"'])
+        self.assertEqual(style.album.title, '1989')
+        self.assertEqual(
+            models.Song.objects.get(slug='red').lyrics, 'Loving him was red\n\tBurning \\ red')
+
+    def test_merge(self):
+        """Importing again only changes the songs which changed."""
+        self.command = 'import_song_data'
+        self.call_command(self.write('songs.json.gz', self.songs, format='json'))
+        self.songs[0]['lyrics'] = [{'content': 'Burning red'}]
+        self.songs[0]['album']['label'] = 'Republic'
+        self.songs.append(fake_baelor.make_song('shake-it-off', '1989', 'Shake it off'))
+        models.Song.objects.filter(slug='style').update(content_hash='')
+        stdout, _ = self.call_command(self.write('songs.jsonl.gz', self.songs + self.songs[:1]))
+        self.assertIn('Created 1, changed 1 and left 1 songs unchanged.', stdout.getvalue())
+        self.assertIn('Created 0 and changed 1 albums.', stdout.getvalue())
+        self.assertIn('Skipped 1 songs', stdout.getvalue())
+        self.assertEqual(models.Song.objects.get(slug='red').lyrics, 'Burning red')
+        self.assertNotIn('', models.Song.objects.values_list('content_hash', flat=True))
+
+    def test_update_chains(self):
+        """Saved chains of the albums with changed songs are rebuilt."""
+        self.command = 'import_song_data'
+        with self.settings(MARKOV_MODEL_ROOT=self.root):
+            self.call_command(self.write('songs.jsonl', self.songs))
+            red = chains.read_chain(chains.artifact_path('Red'))
+        self.assertIn('Loving him was red', str(red.rejoined_text))
+
+    def test_export(self):
+        """Exported songs can be imported again."""
+        self.command = 'import_song_data'
+        self.call_command(self.write('songs.jsonl', self.songs))
+        self.command = 'export_song_data'
+        for name in ('export.jsonl', 'export.json.gz'):
+            path = os.path.join(self.root, name)
+            _, stderr = self.call_command('--output', path)
+            self.assertIn('Exported 2 songs', stderr.getvalue())
+            songs = sorted(bulk.read_dump(path), key=lambda song: song['slug'])
+            self.assertEqual(
+                [sync.parse_song(song) for song in songs],
+                [sync.parse_song(song) for song in self.songs])
+        stdout, _ = self.call_command('--format', 'json')
+        self.assertEqual(len(json.loads(stdout.getvalue())['result']), 2)
+
+    def test_invalid(self):
+        self.command = 'import_song_data'
+        path = os.path.join(self.root, 'songs.jsonl')
+        with open(path, 'w') as f:
+            f.write('{"slug": ')
+        with self.assertRaises(CommandError):
+            self.call_command(path)
+
+
+class BuildMarkovModelsTestCase(CommandMixin, TestCase):
+    """Save the built Markov chains to disk."""
+
+    command = 'build_markov_models'
+
+    def test_build(self):
+        """Save a chain for all albums and each album."""
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        red = models.Album.objects.create(
+            title='Red', slug='red', producers=[], genres=[])
+        models.Song.objects.create(
+            title='Red', slug='red', album=red, producers=[], writers=[],
+            lyrics='Loving him was red.')
+        with self.settings(MARKOV_MODEL_ROOT=root):
+            stdout, _ = self.call_command()
+        self.assertEqual(sorted(os.listdir(root)), ['album-red.chain', 'all.chain'])
+        self.assertIn('Built 2 chains', stdout.getvalue())
+
+    def test_check(self):
+        """Chains missing or older than the songs fail the check."""
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        red = models.Album.objects.create(
+            title='Red', slug='red', producers=[], genres=[])
+        with self.settings(MARKOV_MODEL_ROOT=root):
+            with self.assertRaisesRegex(CommandError, '2 chains'):
+                self.call_command('--check')
+            self.call_command()
+            stdout, _ = self.call_command('--check')
+            self.assertIn('up to date', stdout.getvalue())
+            # Written without the signals which update the chains
+            models.Song.objects.bulk_create([models.Song(
+                title='Red', slug='red', album=red, producers=[], writers=[],
+                lyrics='Loving him was red.')])
+            with self.assertRaisesRegex(CommandError, '2 chains'):
+                stdout, _ = self.call_command('--check')
+
+
+class BenchMemoryTestCase(CommandMixin, TestCase):
+    """Compare the memory used by each chain representation."""
+
+    command = 'bench_memory'
+
+    def test_bench(self):
+        """Report a row per corpus size."""
+        stdout, _ = self.call_command('--songs', '5', '10', '--workers', '1', '--sentences', '1')
+        rows = stdout.getvalue().splitlines()
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1].split('\t')[0], '5')
+
+
+class BenchFetchTestCase(CommandMixin, TestCase):
+    """Compare ways of fetching songs from a local fake API."""
+
+    command = 'bench_fetch'
+
+    def test_bench(self):
+        """Report a row per run with every song fetched."""
+        stdout, _ = self.call_command(
+            '--songs', '25', '--per-page', '10', '--latency', '0', '--workers', '1', '3',
+            '--failures', '1', '--lines', '2')
+        rows = [row.split('\t') for row in stdout.getvalue().splitlines()]
+        self.assertEqual([row[0] for row in rows[1:]], ['unpooled', 'session', 'session'])
+        self.assertEqual(set(row[3] for row in rows[1:]), {'25'})
+
+
+class BenchSearchTestCase(CommandMixin, TestCase):
+    """Measure search latency as saved songs are added."""
+
+    command = 'bench_search'
+
+    def test_bench(self):
+        """Report a row per size, search and method, then delete the songs added."""
+        models.UserSong.objects.create(title='Style', lyrics='Midnight')
+        stdout, stderr = self.call_command(
+            '--rows', '20', '40', '--queries', '2', '--words', 'la1', '--icontains')
+        rows = [row.split('\t') for row in stdout.getvalue().splitlines()]
+        self.assertEqual(
+            [row[:2] + row[3:4] for row in rows[1:]],
+            [['20', 'la1', 'search'], ['20', 'la1', 'icontains'],
+             ['40', 'la1', 'search'], ['40', 'la1', 'icontains']])
+        self.assertIn('Loaded 40 songs', stderr.getvalue())
+        self.assertEqual(list(models.UserSong.objects.values_list('title', flat=True)), ['Style'])
+
+
+class BenchGenerationTestCase(CommandMixin, TestCase):
+    """Measure song generation on synthetic corpora."""
+
+    command = 'bench_generation'
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.output = os.path.join(root, 'results.json')
+        self.baseline = os.path.join(root, 'baseline.json')
+
+    def bench(self, *args):
+        return self.call_command(
+            '--songs', '5', '10', '--lines', '20', '--vocabulary', '50', '--sentences', '5',
+            '--generate', '2', *args)
+
+    def test_bench(self):
+        """Report a row per corpus size and write them as JSON."""
+        stdout, _ = self.bench('--output', self.output)
+        rows = [row.split('\t') for row in stdout.getvalue().splitlines()]
+        self.assertEqual([row[0] for row in rows], ['songs', '5', '10'])
+        with open(self.output) as f:
+            report = json.load(f)
+        self.assertEqual(report['config']['vocabulary'], 50)
+        self.assertEqual([row['songs'] for row in report['results']], [5, 10])
+        self.assertEqual(sorted(report['results'][0]), sorted(rows[0]))
+
+    def test_baseline(self):
+        """Metrics are compared against a baseline, failing when one regresses."""
+        self.bench('--output', self.output)
+        stdout, _ = self.bench('--baseline', self.output, '--threshold', '1000')
+        self.assertIn('No metrics regressed', stdout.getvalue())
+        with open(self.output) as f:
+            report = json.load(f)
+        report['results'][0]['song_ms'] = 0.000001
+        with open(self.baseline, 'w') as f:
+            json.dump(report, f)
+        with self.assertRaisesRegex(CommandError, '1 metrics regressed'):
+            self.bench('--baseline', self.baseline, '--threshold', '1000')
+
+    def test_invalid_baseline(self):
+        """Fail before measuring when the baseline can't be read."""
+        with self.assertRaisesRegex(CommandError, 'Error reading baseline'):
+            self.bench('--baseline', self.baseline)
+        with open(self.baseline, 'w') as f:
+            json.dump([], f)
+        with self.assertRaisesRegex(CommandError, 'no results'):
+            self.bench('--baseline', self.baseline)
+
+
+class BenchLoadTestCase(CommandMixin, LiveServerTestCase):
+    """Load test the pages of a running server."""
+
+    command = 'bench_load'
+
+    def setUp(self):
+        chains.chain_cache.clear()
+        red = models.Album.objects.create(title='Red', slug='red', producers=[], genres=[])
+        for i, lyrics in enumerate(synthetic.make_corpus(3, lines=20, vocabulary=50)):
+            models.Song.objects.create(
+                title='Red', slug='red-{}'.format(i), album=red, producers=[], writers=[],
+                lyrics=lyrics)
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.output = os.path.join(root, 'results.json')
+
+    def test_bench(self):
+        """Report each route, then delete the saved songs added."""
+        stdout, stderr = self.call_command(
+            '--url', self.live_server_url, '--songs', '3', '--saved', '30', '--lines', '2',
+            '--duration', '0.5', '--clients', '2', '--output', self.output)
+        self.assertIn('Added 30 saved songs', stderr.getvalue())
+        rows = [row.split('\t') for row in stdout.getvalue().split('\n\n')[0].splitlines()]
+        self.assertEqual(
+            [row[0] for row in rows], ['route', 'generate', 'list', 'detail', 'save', 'all'])
+        with open(self.output) as f:
+            report = json.load(f)
+        self.assertGreater(report['routes']['all']['requests'], 0)
+        self.assertEqual(report['routes']['all']['errors'], 0)
+        self.assertEqual(
+            sum(report['routes']['all']['histogram']), report['routes']['all']['requests'])
+        self.assertFalse(models.UserSong.objects.exists())
+
+    def test_add_songs(self):
+        """Source songs are only added when asked to, and are deleted with their albums.
+
+        Only the songs added by the run are deleted, even when it fails.
+        """
+        models.UserSong.objects.create(title='Mine', slug='load-mine', lyrics='Mine')
+        # Too few songs to generate from, so only the saved songs are requested
+        args = ['--url', self.live_server_url, '--songs', '5', '--saved', '5', '--lines', '2',
+                '--duration', '0.2', '--clients', '1', '--mix', 'list=1', 'detail=1']
+        with self.assertRaisesRegex(CommandError, '--add-songs'):
+            self.call_command(*args)
+        self.assertEqual(models.Song.objects.count(), 3)
+        _, stderr = self.call_command(*(args + ['--add-songs', '--albums', '1']))
+        self.assertIn('Added 2 songs', stderr.getvalue())
+        self.assertEqual(models.Song.objects.count(), 3)
+        self.assertEqual(list(models.Album.objects.values_list('title', flat=True)), ['Red'])
+        self.assertEqual(
+            list(models.UserSong.objects.values_list('slug', flat=True)), ['load-mine'])
+        self.call_command(*(args + ['--add-songs', '--keep']))
+        self.assertEqual(models.Song.objects.count(), 5)
+
+    def test_invalid_mix(self):
+        """Routes in the mix must exist."""
+        with self.assertRaisesRegex(CommandError, 'Unknown route'):
+            self.call_command('--url', self.live_server_url, '--mix', 'folklore=1')
+
+
+class GenerateSongsTestCase(CommandMixin, TestCase):
+    """Generate songs in bulk."""
+
+    command = 'generate_songs'
+
+    def setUp(self):
+        chains.chain_cache.clear()
+        red = models.Album.objects.create(
+            title='Red', slug='red', producers=[], genres=[])
+        # Several songs of many lines, so new lines can be made from them
+        for i, lyrics in enumerate(synthetic.make_corpus(3, lines=20, vocabulary=50)):
+            models.Song.objects.create(
+                title='Red', slug='red-{}'.format(i), album=red, producers=[], writers=[],
+                lyrics=lyrics)
+
+    def test_write_json(self):
+        """Songs are written as JSON lines."""
+        stdout, stderr = self.call_command('--count', '3', '--album', 'red', '--workers', '1')
+        songs = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(len(songs), 3)
+        self.assertEqual(songs[0]['album'], 'Red')
+        self.assertEqual(len(songs[0]['lyrics'].splitlines()), 28)
+        self.assertIn('Generated 3 songs', stderr.getvalue())
+
+    def test_save(self):
+        """Songs are saved in batches."""
+        self.call_command('--count', '5', '--save', '--batch-size', '2', '--workers', '1')
+        self.assertEqual(models.UserSong.objects.count(), 5)
+        for song in models.UserSong.objects.all():
+            self.assertEqual(song.preview, models.make_preview(song.lyrics))
+
+    def test_workers(self):
+        """Songs are generated by a pool of processes."""
+        output = os.path.join(tempfile.mkdtemp(), 'songs.jsonl')
+        self.addCleanup(shutil.rmtree, os.path.dirname(output))
+        self.call_command('--count', '4', '--workers', '2', '--output', output)
+        with open(output) as f:
+            self.assertEqual(len(f.readlines()), 4)
+
+    def test_unknown_album(self):
+        """The album must exist."""
+        with self.assertRaises(CommandError):
+            self.call_command('--album', 'reputation')
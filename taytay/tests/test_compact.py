@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+
+import markovify
+
+from .. import compact
+
+
+LYRICS = '''I stay up too late, got nothing in my brain
+That's what people say mmm, that's what people say mmm
+I go on too many dates, but I can't make 'em stay
+At least that's what people say mmm, that's what people say mmm'''
+
+
+class CompactChainTestCase(SimpleTestCase):
+    """Encoding Markov chains as flat arrays."""
+
+    def setUp(self):
+        self.text = markovify.text.NewlineText(LYRICS, state_size=2)
+        self.chain = compact.CompactChain(compact.encode(
+            self.text.chain.model, 2, self.text.rejoined_text, album='1989'))
+
+    def test_round_trip(self):
+        """Decoding the chain gives back the original model."""
+        self.assertEqual(self.chain.to_model(), self.text.chain.model)
+        self.assertEqual(self.chain.album, '1989')
+        self.assertEqual(str(self.chain.text), self.text.rejoined_text)
+
+    def test_walk(self):
+        """Walking the chain gives a line made from the lyrics."""
+        words = self.chain.walk()
+        self.assertTrue(words)
+        self.assertIn(' '.join(words[:2]), LYRICS)
+
+    def test_walk_with_start(self):
+        """Walking can start from a given state."""
+        words = self.chain.walk(('people', 'say'))
+        self.assertIn(words[0], ('mmm,', 'mmm'))
+
+    def test_unknown_word(self):
+        """Unknown words and states raise KeyError like markovify."""
+        with self.assertRaises(KeyError):
+            self.chain.walk(('shake', 'it'))
+        with self.assertRaises(KeyError):
+            self.chain.walk(('people', 'people'))
+
+    def test_source_text(self):
+        """Sentences are checked against the source text in the buffer."""
+        self.assertIn('people say', self.chain.text)
+        self.assertNotIn('shake it off', self.chain.text)
+
+    def test_unsupported_format(self):
+        """Chains saved in other formats are rejected."""
+        data = compact.encode(self.text.chain.model, 2, self.text.rejoined_text)
+        with self.assertRaises(ValueError):
+            compact.CompactChain(b'X' + data[1:])
+
+    def test_save_and_load(self):
+        """Saved chains are mapped from the file."""
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'all.chain')
+        compact.save(path, self.text.chain.model, 2, self.text.rejoined_text)
+        lyrics_generator = compact.load(path)
+        self.assertIsNone(lyrics_generator.chain.album)
+        self.assertEqual(lyrics_generator.chain.to_model(), self.text.chain.model)
+        self.assertEqual(os.listdir(root), ['all.chain'])
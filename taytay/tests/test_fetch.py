@@ -0,0 +1,51 @@
+import json
+
+from django.test import SimpleTestCase
+
+from .. import fake_baelor, fetch
+
+
+class IterResultsTestCase(SimpleTestCase):
+    """Parse the songs of a response as it is read."""
+
+    def chunks(self, data, size=1):
+        body = json.dumps(data, indent=1).encode('utf-8')
+        for start in range(0, len(body), size):
+            self.read += 1
+            yield body[start:start + size]
+
+    def setUp(self):
+        self.read = 0
+        self.songs = [
+            fake_baelor.make_song('red', 'Red', 'Loving him was red\nBurning red'),
+            fake_baelor.make_song('style', '1989', 'Midnight, you come and pick me up ♥'),
+        ]
+
+    def test_songs(self):
+        """Songs split across chunks, even within a character, are parsed."""
+        data = {'success': True, 'count': 12345, 'result': self.songs, 'error': None}
+        self.assertEqual(list(fetch.iter_results(self.chunks(data))), self.songs)
+
+    def test_incremental(self):
+        """Songs are yielded before the rest of the body is read."""
+        data = {'result': self.songs, 'error': None}
+        songs = fetch.iter_results(self.chunks(data, size=16))
+        self.assertEqual(next(songs), self.songs[0])
+        total = len(json.dumps(data, indent=1).encode('utf-8')) // 16
+        self.assertLess(self.read, total)
+
+    def test_empty(self):
+        self.assertEqual(list(fetch.iter_results(self.chunks({'result': []}))), [])
+        self.assertEqual(list(fetch.iter_results(self.chunks({}))), [])
+
+    def test_error(self):
+        data = {'result': [], 'error': '0x1073', 'success': False}
+        with self.assertRaises(fetch.FetchError):
+            list(fetch.iter_results(self.chunks(data)))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            list(fetch.iter_results([b'{"result": [{"slug": "red"}']))
+
+    def test_batches(self):
+        self.assertEqual(list(fetch.batches(range(5), 2)), [[0, 1], [2, 3], [4]])
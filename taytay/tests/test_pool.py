@@ -0,0 +1,70 @@
+from unittest.mock import Mock, patch
+
+from django.test import RequestFactory, SimpleTestCase
+
+from .. import chains, pool, timing
+
+
+class SongPoolTestCase(SimpleTestCase):
+    """Songs generated ahead of time."""
+
+    def setUp(self):
+        self.generate = Mock(side_effect=lambda album: ('Song from {}'.format(album), 'Title'))
+        self.pool = pool.SongPool(self.generate, size=2)
+        self.pool.start = Mock()
+
+    def test_empty(self):
+        """Nothing to serve until the queue has been refilled."""
+        self.assertIsNone(self.pool.get('Red'))
+        self.assertEqual(self.pool.depth(), {'Red': 0})
+        self.assertEqual(self.pool.misses, 1)
+        self.assertTrue(self.pool.start.called)
+
+    def test_refill(self):
+        """Requested albums are topped up to the pool size."""
+        self.pool.get('Red')
+        self.pool.get()
+        self.assertEqual(self.pool.refill(), 4)
+        self.assertEqual(self.pool.depth(), {'Red': 2, None: 2})
+        self.assertEqual(self.pool.get('Red'), ('Song from Red', 'Title'))
+        self.assertEqual(self.pool.refill(), 1)
+        stats = self.pool.stats()
+        self.assertEqual(stats['generated'], 5)
+        self.assertEqual(stats['hits'], 1)
+        self.assertGreater(stats['rate'], 0)
+
+    def test_timings(self):
+        """The depth and refill rate are counted in the timings of the request."""
+        self.pool.get('Red')
+        self.pool.refill()
+        timing.TimingMiddleware().process_request(RequestFactory().get('/'))
+        self.addCleanup(timing.finish)
+        self.pool.get('Red')
+        counts = timing.current().counts
+        self.assertEqual(counts['pool_depth'], 2)
+        self.assertGreater(counts['pool_rate'], 0)
+        self.assertEqual(counts['pool_hits'], 1)
+        self.assertNotIn('pool_misses', counts)
+
+    def test_invalidate(self):
+        """Songs from outdated chains are dropped."""
+        self.pool.get('Red')
+        self.pool.refill()
+        chains.invalidate()
+        self.assertIsNone(self.pool.get('Red'))
+
+    def test_disabled(self):
+        """A pool without any room never generates songs."""
+        empty = pool.SongPool(self.generate, size=0)
+        self.assertIsNone(empty.get('Red'))
+        self.assertEqual(empty.refill(), 0)
+        self.assertFalse(self.generate.called)
+
+    @patch('threading.Thread')
+    def test_start(self, mock_thread):
+        """The refill thread is started once per process."""
+        song_pool = pool.SongPool(self.generate, size=2)
+        mock_thread.return_value.is_alive.return_value = True
+        song_pool.start()
+        song_pool.start()
+        mock_thread.return_value.start.assert_called_once_with()
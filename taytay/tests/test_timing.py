@@ -0,0 +1,74 @@
+import json
+
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import override_settings, RequestFactory, SimpleTestCase, TestCase
+
+from .. import chains, models, synthetic, timing
+
+
+class TimingMiddlewareTestCase(TestCase):
+    """Phases of each request in a header and a log line."""
+
+    def setUp(self):
+        chains.chain_cache.clear()
+        cache.clear()
+        red = models.Album.objects.create(title='Red', slug='red', producers=[], genres=[])
+        for i, lyrics in enumerate(synthetic.make_corpus(3, lines=20, vocabulary=50)):
+            models.Song.objects.create(
+                title='Red', slug='red-{}'.format(i), album=red, producers=[], writers=[],
+                lyrics=lyrics)
+
+    def test_header(self):
+        """Phases, queries and counts are sent in the Server-Timing header."""
+        response = self.client.get(reverse('new-song'), {'album': 'red', 'seed': 3})
+        metrics = dict(
+            metric.split(';', 1) for metric in response['Server-Timing'].split(', '))
+        for name in ('total', 'chain', 'song', 'title', 'render'):
+            self.assertTrue(metrics[name].startswith('dur='), name)
+        self.assertRegex(metrics['db'], r'^dur=[\d.]+;desc="[1-9]\d* queries"$')
+        # Four stanzas, one of them the chorus sung twice
+        self.assertEqual(metrics['sentences'], 'desc="16"')
+
+    def test_log(self):
+        """Each request is logged as one JSON object."""
+        with self.assertLogs('taytay.timing', 'INFO') as logs:
+            self.client.get(reverse('new-song'), {'album': 'red', 'seed': 3})
+            with self.assertNumQueries(0):
+                self.client.get(reverse('new-song'), {'album': 'red', 'seed': 3})
+        first, cached = [json.loads(record.getMessage()) for record in logs.records]
+        self.assertEqual(first['path'], reverse('new-song'))
+        self.assertEqual(first['status'], 200)
+        self.assertGreater(first['db_queries'], 0)
+        self.assertIn('song', first['phases'])
+        self.assertEqual(first['counts']['sentences'], 16)
+        self.assertEqual(cached['db_queries'], 0)
+        self.assertNotIn('song', cached['phases'])
+
+    def test_unfinished(self):
+        """Requests whose response the middleware never sees are finished with the request."""
+        connection.force_debug_cursor = False
+        timing.TimingMiddleware().process_request(RequestFactory().get('/'))
+        self.assertTrue(connection.force_debug_cursor)
+        request_finished.send(sender=self.__class__)
+        self.assertFalse(connection.force_debug_cursor)
+        self.assertIsNone(timing.current())
+
+    @override_settings(REQUEST_TIMING=False)
+    def test_disabled(self):
+        """The middleware can be left out."""
+        response = self.client.get(reverse('home'))
+        self.assertNotIn('Server-Timing', response)
+
+
+class PhaseTestCase(SimpleTestCase):
+    """Hooks used outside of a request."""
+
+    def test_untimed(self):
+        """Phases and counts outside of a timed request are ignored."""
+        self.assertIsNone(timing.current())
+        with timing.phase('song'):
+            timing.count('sentences')
+        self.assertIsNone(timing.current())
@@ -1,15 +1,102 @@
-from unittest.mock import patch
+import calendar
+import hashlib
+import shutil
+import tempfile
+import time
+from unittest.mock import ANY, call, patch
 
+from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import connection
+from django.test import override_settings, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import http_date
 
-from .. import models
-from ..views import make_song, make_title
+from .. import bulk, chains, compact, fake_baelor, models, pages, sync, synthetic
+from .utils import shared_cache
+from ..views import make_save_token, make_song, make_title, SongForm, title_attempts
+
+
+class HomepageTestCase(TestCase):
+    """Landing page."""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_cached(self):
+        """The page is rendered once and then served from the cache."""
+        response = self.client.get(reverse('home'))
+        self.assertEqual(response.status_code, 200)
+        with self.assertTemplateNotUsed('homepage.html'):
+            cached = self.client.get(reverse('home'))
+        self.assertEqual(cached.content, response.content)
+        response = self.client.get(reverse('home'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_template_changed(self):
+        """The page is rendered again when its templates change."""
+        self.client.get(reverse('home'))
+        with patch('taytay.pages.template_version', return_value='changed'):
+            with self.assertTemplateUsed('homepage.html'):
+                self.client.get(reverse('home'))
+
+
+class AlbumChoicesTestCase(TestCase):
+    """Albums listed by the song form."""
+
+    def setUp(self):
+        cache.clear()
+        sync.sync_songs([fake_baelor.make_song('red', 'Red', 'Loving him was red.')],
+                        update_chains=False)
+
+    def test_cached(self):
+        """Albums are loaded once for every form."""
+        self.assertEqual(pages.album_choices(), [('red', 'Red')])
+        with self.assertNumQueries(0):
+            form = SongForm({'album': 'red'})
+            self.assertTrue(form.is_valid())
+            self.assertIn('Select an album...', str(form['album']))
+        self.assertEqual(form.cleaned_data['album'], 'red')
+        self.assertEqual(form.albums['red'], 'Red')
+        self.assertFalse(SongForm({'album': 'folklore'}).is_valid())
+
+    def test_synced(self):
+        """Albums added by syncing or importing songs are listed."""
+        pages.album_choices()
+        sync.sync_songs([fake_baelor.make_song('style', '1989', 'Midnight.')],
+                        update_chains=False)
+        self.assertEqual(pages.album_choices(), [('1989', '1989'), ('red', 'Red')])
+        bulk.import_songs([fake_baelor.make_song('mine', 'Speak Now', 'You are the best.')])
+        self.assertEqual(pages.album_choices(), [
+            ('1989', '1989'), ('red', 'Red'), ('speak-now', 'Speak Now')])
+
+    def test_saved(self):
+        """Albums saved or deleted one at a time are listed."""
+        pages.album_choices()
+        album = models.Album.objects.create(
+            title='Fearless', slug='fearless', producers=[], genres=[])
+        self.assertIn(('fearless', 'Fearless'), pages.album_choices())
+        album.delete()
+        self.assertNotIn(('fearless', 'Fearless'), pages.album_choices())
+
+    def test_expired(self):
+        """Albums written without invalidating the cache are listed once it expires."""
+        with self.settings(ALBUMS_TIMEOUT=1):
+            pages.album_choices()
+            models.Album.objects.bulk_create([
+                models.Album(title='Fearless', slug='fearless', producers=[], genres=[])])
+            self.assertNotIn(('fearless', 'Fearless'), pages.album_choices())
+            with patch('time.time', return_value=time.time() + 2):
+                self.assertIn(('fearless', 'Fearless'), pages.album_choices())
 
 
 class SongGeneratorTestCase(TestCase):
     """Page to generate lyrics."""
 
+    def setUp(self):
+        chains.chain_cache.clear()
+
     @patch("taytay.views.make_song")
     @patch("taytay.views.make_title")
     def test_render_page(self, mock_title, mock_song):
@@ -19,34 +106,97 @@ class SongGeneratorTestCase(TestCase):
         with self.assertTemplateUsed('taytay/song-generator.html'):
             response = self.client.get(reverse('new-song'))
             self.assertEqual(response.status_code, 200)
-            mock_song.assert_called_with(album=None)
-            mock_title.assert_called_with(mock_song.return_value)
+            mock_song.assert_called_with(album=None, lyrics_generator=ANY, seed=ANY)
+            mock_title.assert_called_with(mock_song.return_value, seed=ANY)
+
+    @patch("taytay.views.make_song")
+    @patch("taytay.views.song_pool")
+    def test_pooled_song(self, mock_pool, mock_song):
+        """Serve a song generated ahead of time."""
+        mock_pool.get.return_value = ('Shake it off...', 'Shake It Off', 13)
+        response = self.client.get(reverse('new-song'), {'title': 'Off'})
+        self.assertEqual(response.context['song'], 'Shake it off...')
+        self.assertEqual(response.context['title'], 'Off')
+        self.assertEqual(response.context['seed'], 13)
+        mock_pool.get.assert_called_with(None)
+        self.assertFalse(mock_song.called)
+
+    def test_seeded_song(self):
+        """The same seed gives the same song, which can be cached."""
+        red = models.Album.objects.create(
+            title='Red', slug='red', producers=[], genres=[])
+        for i, lyrics in enumerate(synthetic.make_corpus(3, lines=20, vocabulary=50)):
+            models.Song.objects.create(
+                title='Red', slug='red-{}'.format(i), album=red, producers=[], writers=[],
+                lyrics=lyrics)
+        url = reverse('new-song')
+        # The save token in the page is timestamped to the second
+        with patch('django.core.signing.time.time', return_value=time.time()):
+            response = self.client.get(url, {'album': 'red', 'seed': 22})
+            self.assertIn('max-age', response['Cache-Control'])
+            self.assertIn('seed=', response.context['shuffle_url'])
+            chains.chain_cache.clear()
+            cache.clear()
+            again = self.client.get(url, {'album': 'red', 'seed': 22})
+        self.assertEqual(again.content, response.content)
+        self.assertEqual(again['ETag'], response['ETag'])
+        other = self.client.get(url, {'album': 'red', 'seed': 13})
+        self.assertNotEqual(other['ETag'], response['ETag'])
+        self.assertNotEqual(other.context['song'], response.context['song'])
+        with patch("taytay.views.make_song") as mock_song:
+            cached = self.client.get(
+                url, {'album': 'red', 'seed': 22}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertFalse(mock_song.called)
+        self.assertEqual(cached['ETag'], response['ETag'])
+        self.assertEqual(cached['Cache-Control'], response['Cache-Control'])
+        # A malformed header matches nothing
+        invalid = self.client.get(url, {'album': 'red', 'seed': 22}, HTTP_IF_NONE_MATCH='"caf\xe9"')
+        self.assertEqual(invalid.status_code, 200)
+
+    def test_unseeded_song(self):
+        """Songs without a seed aren't cacheable."""
+        with patch("taytay.views.make_seeded_song") as mock_song:
+            mock_song.return_value = ('Shake it off...', 'Shake It Off', 'abc')
+            response = self.client.get(reverse('new-song'))
+        self.assertNotIn('ETag', response)
+        self.assertIsNotNone(response.context['seed'])
 
     @patch("taytay.views.make_song")
     @patch("taytay.views.make_title")
     def test_save_song(self, mock_title, mock_song):
         """Save a generated song."""
-        # Generate song and it should be saved in the session
+        # The song is signed into the form rather than saved in the session
         mock_song.return_value = 'Shake it off...'
         mock_title.return_value = 'Shake It Off'
-        self.client.get(reverse('new-song'))
-        response = self.client.post(reverse('new-song'))
+        response = self.client.get(reverse('new-song'))
+        self.assertNotIn('song', self.client.session)
+        token = response.context['save_token']
+        response = self.client.post(reverse('new-song'), {'token': token})
         song = models.UserSong.objects.latest('created_date')
         self.assertEqual(song.title, 'Shake It Off')
+        self.assertEqual(song.lyrics, 'Shake it off...')
         self.assertRedirects(response, song.get_absolute_url())
 
     @patch("taytay.views.make_song")
     @patch("taytay.views.make_title")
     def test_failed_save(self, mock_title, mock_song):
-        """Can't save if there is no song in the session."""
+        """Can't save without a valid token."""
         mock_song.return_value = 'Shake it off...'
         mock_title.return_value = 'Shake It Off'
         response = self.client.post(reverse('new-song'))
         self.assertEqual(response.status_code, 200)
+        token = make_save_token('Shake It Off', 'Shake it off...')
+        response = self.client.post(reverse('new-song'), {'token': token[:-1] + 'x'})
+        self.assertEqual(response.status_code, 200)
+        expired = time.time() + settings.SONG_CACHE_TIMEOUT + 1
+        with patch('django.core.signing.time.time', return_value=expired):
+            response = self.client.post(reverse('new-song'), {'token': token})
+        self.assertEqual(response.status_code, 200)
         with self.assertRaises(models.UserSong.DoesNotExist):
             models.UserSong.objects.latest('created_date')
 
-    @patch("markovify.text.NewlineText")
+    @patch("taytay.chains.LyricsText")
     def test_make_song_all_albums(self, mock_markov):
         """Feeding all lyrics into the markov model."""
         mock_markov.return_value.make_sentence.return_value = 'Shake it off.'
@@ -62,9 +212,11 @@ class SongGeneratorTestCase(TestCase):
             lyrics='Shake it off.')
         result = make_song()
         self.assertEqual(len(result.splitlines()), 28)
-        mock_markov.assert_called_with('Loving him was red.Shake it off.', state_size=2)
+        mock_markov.assert_called_with(state_size=2)
+        mock_markov.return_value.add.assert_has_calls([
+            call('Loving him was red.'), call('Shake it off.')])
 
-    @patch("markovify.text.NewlineText")
+    @patch("taytay.chains.LyricsText")
     def test_make_song_single_album(self, mock_markov):
         """Feeding only a single album into the markov model."""
         mock_markov.return_value.make_sentence.return_value = 'Shake it off.'
@@ -80,9 +232,22 @@ class SongGeneratorTestCase(TestCase):
             lyrics='Shake it off.')
         result = make_song(album='Red')
         self.assertEqual(len(result.splitlines()), 28)
-        mock_markov.assert_called_with('Loving him was red.', state_size=2)
+        mock_markov.return_value.add.assert_called_once_with('Loving him was red.')
 
-    @patch("markovify.text.NewlineText")
+    def test_make_song_seed(self):
+        """Songs and titles only depend on the seed and the chain."""
+        lyrics_generator = chains.LyricsText()
+        for lyrics in synthetic.make_corpus(3, lines=20, vocabulary=50):
+            lyrics_generator.add(lyrics)
+        mapped = compact.CompactText(compact.CompactChain(compact.encode(
+            lyrics_generator.chain.model, 2, lyrics_generator.rejoined_text)))
+        self.assertEqual(mapped.version, lyrics_generator.version)
+        song = make_song(lyrics_generator=lyrics_generator, seed=7)
+        self.assertEqual(make_song(lyrics_generator=mapped, seed=7), song)
+        self.assertNotEqual(make_song(lyrics_generator=lyrics_generator, seed=8), song)
+        self.assertEqual(make_title(song, seed=7), make_title(song, seed=7))
+
+    @patch("taytay.chains.LyricsText")
     def test_make_title(self, mock_markov):
         """Generate a title for a song."""
         mock_markov.return_value.make_sentence.side_effect = [None, 'I go on too many dates']
@@ -91,9 +256,74 @@ class SongGeneratorTestCase(TestCase):
             I go on too many dates, but I can't make 'em stay
             At least that's what people say mmm, that's what people say mmm'''
         result = make_title(song=song)
-        mock_markov.assert_called_with(song)
+        mock_markov.return_value.add.assert_called_once_with(song)
         self.assertEqual(result, 'I Go On')
 
+    @patch("taytay.chains.LyricsText")
+    def test_make_title_fallback(self, mock_markov):
+        """Use the start of the chorus when no title can be generated."""
+        mock_markov.return_value.make_sentence.return_value = None
+        song = 'I stay up too late\n\n \nShake it off, shake it off\n\n \nI go on'
+        fallbacks = title_attempts['fallback']
+        result = make_title(song=song, attempts=5)
+        self.assertEqual(result, 'Shake It Off')
+        self.assertEqual(mock_markov.return_value.make_sentence.call_count, 5)
+        self.assertEqual(title_attempts['fallback'], fallbacks + 1)
+
+
+class SongApiTestCase(TestCase):
+    """Generating and saving songs as JSON."""
+
+    def setUp(self):
+        chains.chain_cache.clear()
+        red = models.Album.objects.create(title='Red', slug='red', producers=[], genres=[])
+        for i, lyrics in enumerate(synthetic.make_corpus(3, lines=20, vocabulary=50)):
+            models.Song.objects.create(
+                title='Red', slug='red-{}'.format(i), album=red, producers=[], writers=[],
+                lyrics=lyrics)
+
+    def test_generate(self):
+        """Generate a song without using the session."""
+        url = reverse('api-generate')
+        chains.chain_cache.get('Red')
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {'album': 'red', 'seed': 22})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response['Cache-Control'])
+        data = response.json()
+        self.assertEqual(data['seed'], 22)
+        self.assertEqual(data['album'], 'red')
+        self.assertTrue(data['stanzas'])
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+        cached = self.client.get(
+            url, {'album': 'red', 'seed': 22}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached['ETag'], response['ETag'])
+        self.assertIn('public', cached['Cache-Control'])
+        invalid = self.client.get(
+            url, {'album': 'red', 'seed': 22}, HTTP_IF_NONE_MATCH='"caf\xe9"')
+        self.assertEqual(invalid.status_code, 200)
+
+    def test_generate_unknown_album(self):
+        response = self.client.get(reverse('api-generate'), {'album': 'folklore'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('album', response.json()['errors'])
+
+    def test_save(self):
+        """Saving a song generates it again from its seed."""
+        data = self.client.get(reverse('api-generate'), {'album': 'red', 'seed': 7}).json()
+        response = self.client.post(reverse('api-save-song'), {'album': 'red', 'seed': 7})
+        self.assertEqual(response.status_code, 201)
+        song = models.UserSong.objects.get(slug=response.json()['slug'])
+        self.assertEqual(song.title, data['title'])
+        self.assertEqual(
+            [stanza.splitlines() for stanza in song.lyrics.split("\n \n")], data['stanzas'])
+
+    def test_save_without_seed(self):
+        response = self.client.post(reverse('api-save-song'), {'album': 'red'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(models.UserSong.objects.exists())
+
 
 class SongDetailTestCase(TestCase):
     """Details of a newly generated song."""
@@ -108,6 +338,76 @@ class SongDetailTestCase(TestCase):
             response = self.client.get(self.song.get_absolute_url())
             self.assertEqual(response.status_code, 200)
 
+    def test_cached(self):
+        """The page is rendered once and served from the cache with validators."""
+        url = self.song.get_absolute_url()
+        response = self.client.get(url)
+        with self.assertNumQueries(0):
+            cached = self.client.get(url)
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(cached['ETag'], '"{}"'.format(hashlib.sha1(cached.content).hexdigest()))
+        self.assertEqual(cached['Last-Modified'], http_date(
+            calendar.timegm(self.song.created_date.utctimetuple())))
+        self.assertIn('public', cached['Cache-Control'])
+
+    def test_not_modified(self):
+        """Clients with the current page get a 304."""
+        url = self.song.get_absolute_url()
+        response = self.client.get(url)
+        for headers in ({'HTTP_IF_NONE_MATCH': response['ETag']},
+                        {'HTTP_IF_MODIFIED_SINCE': response['Last-Modified']}):
+            with self.assertNumQueries(0):
+                not_modified = self.client.get(url, **headers)
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified.content, b'')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_file_cache(self):
+        """Pages can be kept by cache backends which pickle them to files."""
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        backend = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                   'LOCATION': root}
+        with self.settings(CACHES={'default': backend}):
+            response = self.client.get(self.song.get_absolute_url())
+            with self.assertNumQueries(0):
+                cached = self.client.get(self.song.get_absolute_url())
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(cached['ETag'], response['ETag'])
+
+    def test_deleted(self):
+        """Deleted songs are no longer served from the cache."""
+        url = self.song.get_absolute_url()
+        self.client.get(url)
+        self.song.delete()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_deleted_in_bulk(self):
+        """Songs deleted in bulk are removed without loading them and no longer served."""
+        url = self.song.get_absolute_url()
+        models.UserSong.objects.create(title='Style', lyrics='Midnight...')
+        self.client.get(url)
+        self.assertContains(self.client.get(reverse('song-list')), self.song.title)
+        with patch('taytay.pages.song_deleted') as song_deleted:
+            deleted = bulk.delete_user_songs('slug = %s', [self.song.slug])
+        self.assertEqual(deleted, 1)
+        song_deleted.assert_not_called()
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertNotContains(self.client.get(reverse('song-list')), self.song.title)
+
+    def test_deleted_by_other_process(self):
+        """Songs deleted by another process, such as another web worker, are not served."""
+        url = self.song.get_absolute_url()
+        with shared_cache() as run:
+            self.client.get(url)
+            models.UserSong.objects.filter(pk=self.song.pk).update(slug='deleted')
+            self.assertEqual(self.client.get(url).status_code, 200)
+            run('from types import SimpleNamespace\nfrom taytay import pages\n'
+                'pages.song_deleted(None, SimpleNamespace(slug={!r}))'.format(self.song.slug))
+            self.assertEqual(self.client.get(url).status_code, 404)
+
 
 class SongListTestCase(TestCase):
     """Listing previously generated songs."""
@@ -127,3 +427,158 @@ class SongListTestCase(TestCase):
         with self.assertTemplateUsed('taytay/_songs.html'):
             response = self.client.get(reverse('song-list'), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
             self.assertEqual(response.status_code, 200)
+
+    @patch('taytay.views.SongListView.paginate_by', 2)
+    def test_load_more(self):
+        """Each page starts after the cursor of the last one, without counting the songs."""
+        for title in ['All Too Well', 'Blank Space', 'Blank Space', 'Style']:
+            models.UserSong.objects.create(title=title, lyrics='...')
+        pages = []
+        params = {}
+        while True:
+            with self.assertNumQueries(1):
+                response = self.client.get(
+                    reverse('song-list'), params, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertEqual(response.status_code, 200)
+            page = response.context['page_obj']
+            pages.append([song.title for song in page])
+            if not page.has_next():
+                self.assertNotContains(response, 'Load More')
+                break
+            self.assertContains(response, '?cursor={}'.format(page.next_cursor))
+            params = {'cursor': page.next_cursor}
+        self.assertEqual(pages, [
+            ['All Too Well', 'Blank Space'], ['Blank Space', 'Shake It Off'], ['Style']])
+
+    def test_preview(self):
+        """Cards show the saved first stanza without loading the lyrics."""
+        models.UserSong.objects.create(
+            title='Style', lyrics='Midnight\nYou come\n \nAnd pick me up')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('song-list'))
+        self.assertContains(response, 'Midnight<br />You come')
+        self.assertNotContains(response, 'pick me up')
+        self.assertNotIn('"lyrics"', queries[0]['sql'])
+
+    def test_cached(self):
+        """Pages and fragments are cached separately until a song is saved."""
+        url = reverse('song-list')
+        page = self.client.get(url)
+        fragment = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).content, page.content)
+            self.assertEqual(
+                self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest').content,
+                fragment.content)
+        self.assertIn('X-Requested-With', page['Vary'])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=page['ETag']).status_code, 304)
+        models.UserSong.objects.create(title='Style', lyrics='Midnight')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=page['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Style')
+
+    def test_saved_by_other_process(self):
+        """Songs saved by another process, such as another web worker, are listed."""
+        url = reverse('song-list')
+        with shared_cache() as run:
+            self.client.get(url)
+            # Saved without the signal, as the other process sends it
+            models.UserSong.objects.bulk_create([models.UserSong(title='Style', lyrics='Midnight')])
+            self.assertNotContains(self.client.get(url), 'Style')
+            run('from taytay import pages\npages.invalidate_list()')
+            self.assertContains(self.client.get(url), 'Style')
+
+    def test_invalid_cursor(self):
+        """An invalid cursor is not found."""
+        response = self.client.get(reverse('song-list'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_empty(self):
+        """The list is not found when there are no songs."""
+        self.song.delete()
+        response = self.client.get(reverse('song-list'))
+        self.assertEqual(response.status_code, 404)
+
+
+class SearchTestCase(TestCase):
+    """Full text search over saved songs and source lyrics."""
+
+    def setUp(self):
+        self.style = models.UserSong.objects.create(
+            title='Style', lyrics='Midnight\nYou come and pick me up, no headlights')
+        self.red = models.UserSong.objects.create(
+            title='Red', lyrics='Loving him is like driving a new Maserati\nLoving him was red')
+        self.other = models.UserSong.objects.create(
+            title='Love Story', lyrics='Romeo take me somewhere we can be alone & free')
+
+    def get(self, **params):
+        return self.client.get(reverse('search'), params)
+
+    def test_form(self):
+        """The page without terms only has the form."""
+        with self.assertNumQueries(0):
+            response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('songs', response.context)
+
+    def test_rank(self):
+        """Matches in the title rank above matches in the lyrics, with a snippet."""
+        with self.assertNumQueries(1):
+            response = self.get(q='loving')
+        songs = response.context['songs']
+        self.assertEqual([song.title for song in songs], ['Love Story', 'Red'])
+        self.assertIn('<b>Loving</b> him is like', songs[1].snippet)
+        self.assertContains(response, self.red.get_absolute_url())
+        self.assertFalse(response.context['page_obj'].truncated)
+
+    @override_settings(SEARCH_MAX_RANKED=1)
+    def test_max_ranked(self):
+        """Only the most recent matches are ranked, with a note that some were left out."""
+        response = self.get(q='loving')
+        self.assertEqual(list(response.context['songs']), [self.other])
+        self.assertTrue(response.context['page_obj'].truncated)
+        self.assertContains(response, 'Only the 1 most recent matches are shown.')
+        response = self.get(q='romeo')
+        self.assertEqual(list(response.context['songs']), [self.other])
+        self.assertNotContains(response, 'most recent matches')
+
+    def test_escape(self):
+        """Lyrics in the snippet are escaped."""
+        response = self.get(q='romeo')
+        self.assertContains(response, '<b>Romeo</b> take me somewhere we can be alone &amp; free')
+
+    def test_updated(self):
+        """Songs are found by their new lyrics once they are changed."""
+        self.style.lyrics = 'Cause we never go out of style'
+        self.style.save()
+        self.assertEqual(list(self.get(q='style never').context['songs']), [self.style])
+        self.assertEqual(list(self.get(q='midnight').context['songs']), [])
+
+    @override_settings(SEARCH_PAGE_SIZE=1)
+    def test_load_more(self):
+        """More results are loaded after the cursor of the last page."""
+        response = self.get(q='love')
+        titles = [song.title for song in response.context['songs']]
+        while 'next_url' in response.context:
+            with self.assertNumQueries(1):
+                response = self.client.get(
+                    reverse('search') + response.context['next_url'],
+                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertTemplateUsed(response, 'taytay/_search-results.html')
+            titles.extend(song.title for song in response.context['songs'])
+        self.assertEqual(titles, ['Love Story', 'Red'])
+
+    def test_invalid_cursor(self):
+        response = self.get(q='love', cursor='WyJhIiwxXQ')
+        self.assertEqual(response.status_code, 404)
+
+    def test_source_lyrics(self):
+        """Search the lyrics of the source songs, showing their album."""
+        album = models.Album.objects.create(
+            title='Red', slug='red', label='Big Machine', genres=[], producers=[])
+        models.Song.objects.create(
+            title='Red', slug='red', album=album, lyrics='Loving him was red',
+            writers=[], producers=[])
+        response = self.get(q='red', source='lyrics')
+        self.assertEqual([song.title for song in response.context['songs']], ['Red'])
+        self.assertContains(response, '<p class="grey-text">Red</p>', html=True)
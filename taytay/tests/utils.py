@@ -0,0 +1,106 @@
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+
+
+# Statements which can be explained, as opposed to savepoints and the like
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def full_scans(plan):
+    """Yield the tables read in full in an EXPLAIN plan.
+
+    That's a sequential scan, or an index scan filtering every row instead of
+    looking up a range of them.
+    """
+    node = plan.get('Node Type')
+    if node == 'Seq Scan' or (
+            node in ('Index Scan', 'Index Only Scan') and
+            'Filter' in plan and 'Index Cond' not in plan):
+        yield plan['Relation Name']
+    for child in plan.get('Plans', []):
+        yield from full_scans(child)
+
+
+@contextlib.contextmanager
+def shared_cache():
+    """Use a file cache shared with other processes, yielding a function to run code in one.
+
+    The code runs in a new Python process with Django set up, like a
+    management command run next to the web processes. It connects to the test
+    database, but doesn't see rows written by the test until they're committed.
+    """
+    root = tempfile.mkdtemp()
+    backend = 'django.core.cache.backends.filebased.FileBasedCache'
+    database = 'postgres://{USER}:{PASSWORD}@{HOST}:{PORT}/{NAME}'.format(
+        **connection.settings_dict)
+
+    def run(code):
+        env = dict(
+            os.environ, CACHE_BACKEND=backend, CACHE_LOCATION=root, DATABASE_URL=database,
+            DJANGO_SETTINGS_MODULE='taytay.settings')
+        subprocess.check_call(
+            [sys.executable, '-c', 'import django\ndjango.setup()\n{}'.format(code)], env=env)
+
+    try:
+        with override_settings(CACHES={'default': {'BACKEND': backend, 'LOCATION': root}}):
+            yield run
+    finally:
+        shutil.rmtree(root)
+
+
+class QueryBudgetMixin(object):
+    """Assertions on the number of queries run and how the database runs them.
+
+    Queries are explained with sequential scans disabled, so the planner only
+    reads a whole table when there is no index it could use instead. That is
+    allowed for tables with fewer than ``full_scan_rows`` rows, which are cheap
+    to read whole.
+    """
+
+    full_scan_rows = 100
+
+    @contextlib.contextmanager
+    def assertQueryBudget(self, max_queries, full_scan_rows=None):
+        """Fail if the block runs more queries or a query scans a large table."""
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        queries = [query['sql'] for query in context.captured_queries]
+        self.assertLessEqual(
+            len(queries), max_queries, 'Ran {} queries, over the budget of {}:\n{}'.format(
+                len(queries), max_queries, '\n'.join(queries)))
+        for sql in queries:
+            if sql.lstrip().upper().startswith(EXPLAINABLE):
+                self.assertNoFullScan(sql, full_scan_rows=full_scan_rows)
+
+    def assertNoFullScan(self, sql, params=None, full_scan_rows=None):
+        """Fail if a query would read a table with more rows than allowed in full."""
+        if full_scan_rows is None:
+            full_scan_rows = self.full_scan_rows
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+            try:
+                cursor.execute('EXPLAIN (FORMAT JSON) {}'.format(sql), params)
+                plan = cursor.fetchone()[0]
+            finally:
+                cursor.execute('RESET enable_seqscan')
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            for table in set(full_scans(plan[0]['Plan'])):
+                cursor.execute('SELECT count(*) FROM {}'.format(connection.ops.quote_name(table)))
+                rows = cursor.fetchone()[0]
+                self.assertLess(
+                    rows, full_scan_rows,
+                    'Full scan of {} with {} rows:\n{}'.format(table, rows, sql))
+
+    def assertQuerysetNoFullScan(self, queryset, full_scan_rows=None):
+        """Fail if a queryset would read a table with more rows than allowed in full."""
+        sql, params = queryset.query.sql_with_params()
+        self.assertNoFullScan(sql, params, full_scan_rows=full_scan_rows)
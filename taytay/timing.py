@@ -0,0 +1,139 @@
+"""Time the phases of each request, for a Server-Timing header and a JSON log line.
+
+Views mark their phases with ``phase`` and count events with ``count``. Both
+do nothing outside of a request timed by ``TimingMiddleware``, such as in the
+song pool thread or the generate_songs workers.
+"""
+import collections
+import contextlib
+import itertools
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Timings(object):
+    """Milliseconds spent in each phase of a request and counts of events in it."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+        # Queries logged before the request started
+        self.first_query = len(connection.queries_log)
+        self.force_debug_cursor = connection.force_debug_cursor
+
+    def add(self, name, ms):
+        self.phases[name] = self.phases.get(name, 0) + ms
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+
+def current():
+    """Timings of the request being handled by this thread, if it's timed."""
+    return getattr(_local, 'timings', None)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Add the time spent in the block to a phase of the current request."""
+    timings = current()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, (time.perf_counter() - start) * 1000)
+
+
+def count(name, n=1):
+    """Count an event in the current request."""
+    timings = current()
+    if timings is not None:
+        timings.count(name, n)
+
+
+def finish():
+    """Stop timing the current request, turning the debug cursor back to how it was.
+
+    Returns the timings of the request, or None if it wasn't timed or was
+    finished already.
+    """
+    timings = current()
+    if timings is not None:
+        _local.timings = None
+        connection.force_debug_cursor = timings.force_debug_cursor
+    return timings
+
+
+def request_finished(sender, **kwargs):
+    """Signal handler to finish requests whose response the middleware never saw.
+
+    That happens when an exception escapes the other middleware, and would
+    otherwise leave the debug cursor logging queries for the life of the thread.
+    """
+    finish()
+
+
+def server_timing(total, queries, db_ms, timings):
+    """Value of the Server-Timing header, with counts as descriptions."""
+    metrics = ['total;dur={:.1f}'.format(total)]
+    metrics.append('db;dur={:.1f};desc="{} queries"'.format(db_ms, queries))
+    metrics.extend('{};dur={:.1f}'.format(name, ms) for name, ms in timings.phases.items())
+    metrics.extend('{};desc="{}"'.format(name, n) for name, n in timings.counts.items())
+    return ', '.join(metrics)
+
+
+class TimingMiddleware(object):
+    """Time each request, sending the phases in a Server-Timing header and logging them.
+
+    Queries are timed by Django's debug cursor, which is turned on for the
+    request. Set REQUEST_TIMING to off to leave the middleware out.
+    """
+
+    def __init__(self):
+        if not settings.REQUEST_TIMING:
+            raise MiddlewareNotUsed
+
+    def process_request(self, request):
+        _local.timings = Timings()
+        connection.force_debug_cursor = True
+
+    def process_response(self, request, response):
+        timings = current()
+        if timings is None:
+            return response
+        queries = list(itertools.islice(connection.queries_log, timings.first_query, None))
+        finish()
+        db_ms = sum(float(query['time']) for query in queries) * 1000
+        total = (time.perf_counter() - timings.start) * 1000
+        response['Server-Timing'] = server_timing(total, len(queries), db_ms, timings)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(self.log_line(request, response, total, len(queries), db_ms, timings))
+        return response
+
+    def log_line(self, request, response, total, queries, db_ms, timings):
+        return json.dumps(collections.OrderedDict([
+            ('method', request.method),
+            ('path', request.path),
+            ('status', response.status_code),
+            ('ms', round(total, 2)),
+            ('db_queries', queries),
+            ('db_ms', round(db_ms, 2)),
+            ('phases', collections.OrderedDict(
+                (name, round(ms, 2)) for name, ms in timings.phases.items())),
+            ('counts', timings.counts),
+        ]), separators=(',', ':'))
@@ -22,7 +22,10 @@ from . import views
 
 urlpatterns = [
     url(r'^generate/$', views.song_generator, name='new-song'),
+    url(r'^api/generate/$', views.api_generate, name='api-generate'),
+    url(r'^api/songs/$', views.api_save_song, name='api-save-song'),
     url(r'^s/$', views.SongListView.as_view(), name='song-list'),
     url(r'^s/(?P<slug>\w{1,32})/$', views.song_detail, name='song-detail'),
+    url(r'^search/$', views.search_songs, name='search'),
     url(r'^$', views.HomepageView.as_view(), name='home'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
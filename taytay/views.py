@@ -1,108 +1,465 @@
+import calendar
+import collections
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import random
+import time
+
 from django import forms
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.http import Http404, HttpResponseNotModified, JsonResponse
 from django.shortcuts import get_object_or_404, render, redirect
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.functional import cached_property
+from django.utils.http import parse_etags, quote_etag, urlencode
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
 from django.views.generic import TemplateView, ListView
 
-import markovify
+from . import chains, models, pages, pagination, pool, search, timing
+
+
+logger = logging.getLogger(__name__)
+
+# Budget for generating a title before falling back to the chorus
+TITLE_ATTEMPTS = 20
+
+TITLE_TIMEOUT = 0.1
 
-from . import models
+# Number of titles made after each number of attempts, plus the fallbacks
+title_attempts = collections.Counter()
+
+MAX_SEED = 2 ** 31
+
+SAVE_TOKEN_SALT = 'taytay.views.save-song'
 
 
 def make_markov_chain(album):
-    lyrics = ""
-    if album is not None:
-        qs = models.Song.objects.filter(album__title=album)
-    else:
-        qs = models.Song.objects.all()
-    for i in qs:
-        lyrics += i.lyrics
+    with timing.phase('chain'):
+        return chains.chain_cache.get(album)
+
+
+def new_seed():
+    """Pick a seed for a new song."""
+    return random.SystemRandom().randrange(MAX_SEED)
 
-    lyrics_generator = markovify.text.NewlineText(lyrics, state_size=2)
-    return lyrics_generator
 
+def shuffle_seed(seed):
+    """Pick the seed for the song after this one, which is always the same."""
+    return random.Random('shuffle:{}'.format(seed)).randrange(MAX_SEED)
 
-def make_stanza(lyrics_generator):
+
+def make_stanza(lyrics_generator, rng=None):
     stanza = ""
     for _ in range(4):
         while True:
-            line = lyrics_generator.make_sentence()
+            line = lyrics_generator.make_sentence(rng=rng)
             if line is not None:
                 stanza += (line + "\n")
+                timing.count('sentences')
                 break
+            timing.count('retries')
     return stanza
 
 
-def make_song(album=None):
-    lyrics_generator = make_markov_chain(album)
-    chorus = make_stanza(lyrics_generator)
-    song = (make_stanza(lyrics_generator) + "\n \n" + chorus + "\n \n" +
-            make_stanza(lyrics_generator) + "\n \n" + chorus +
-            "\n \n" + make_stanza(lyrics_generator))
+def make_song(album=None, lyrics_generator=None, seed=None):
+    """Generate a song, which is always the same for a given seed and chain."""
+    if lyrics_generator is None:
+        lyrics_generator = make_markov_chain(album)
+    rng = random.Random(seed) if seed is not None else None
+    with timing.phase('song'):
+        chorus = make_stanza(lyrics_generator, rng)
+        song = (make_stanza(lyrics_generator, rng) + "\n \n" + chorus + "\n \n" +
+                make_stanza(lyrics_generator, rng) + "\n \n" + chorus +
+                "\n \n" + make_stanza(lyrics_generator, rng))
     return song
 
 
-def make_title(song):
-    while True:
-        title_generator = markovify.text.NewlineText(song)
-        title = title_generator.make_sentence()
-        if title is not None:
-            title_list = title.split(" ")
-            title = " ".join(title_list[0:3])
-            return title.title()
+def chorus_title(song):
+    """Fallback title from the start of the chorus, or the first line."""
+    stanzas = [stanza for stanza in song.split("\n \n") if stanza.strip()]
+    if not stanzas:
+        return ""
+    chorus = stanzas[1] if len(stanzas) > 1 else stanzas[0]
+    return chorus.strip().splitlines()[0]
+
+
+def make_title(song, attempts=TITLE_ATTEMPTS, timeout=TITLE_TIMEOUT, seed=None):
+    """Make a title from a line generated from the song itself.
+
+    The song is parsed once. If no line is generated within the attempt or
+    time budget the start of the chorus is used instead. The time budget is
+    ignored when a seed is given so the title is always the same.
+    """
+    with timing.phase('title'):
+        title_generator = chains.LyricsText()
+        title_generator.add(song)
+        rng = None
+        deadline = time.perf_counter() + timeout
+        if seed is not None:
+            rng = random.Random(seed)
+            deadline = float('inf')
+        title = None
+        attempt = 0
+        while title is None and attempt < attempts and time.perf_counter() < deadline:
+            attempt += 1
+            title = title_generator.make_sentence(rng=rng)
+    timing.count('title_attempts', attempt)
+    if title is None:
+        title = chorus_title(song)
+        title_attempts['fallback'] += 1
+    title_attempts[attempt] += 1
+    logger.debug('Made title in %d attempts', attempt)
+    title_list = title.split(" ")
+    title = " ".join(title_list[0:3]).rstrip(",;:")
+    return title.title()
+
+
+def song_etag(album, title, seed, version):
+    """Identify the song generated for the inputs and version of the chain."""
+    key = '\n'.join([album or '', title or '', str(seed), version])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def make_seeded_song(album=None, title=None, seed=None):
+    """Generate a song and title for a seed, returning them with their ETag.
+
+    Songs are cached by seed, album, title and chain version so asking for
+    the same song again doesn't generate it again.
+    """
+    lyrics_generator = make_markov_chain(album)
+    etag = song_etag(album, title, seed, lyrics_generator.version)
+    key = 'taytay:song:{}'.format(etag)
+    result = cache.get(key)
+    if result is None:
+        song = make_song(album=album, lyrics_generator=lyrics_generator, seed=seed)
+        result = (song, title or make_title(song, seed=seed))
+        cache.set(key, result, settings.SONG_CACHE_TIMEOUT)
+    return result + (etag, )
+
+
+def get_song(album=None, title=None, seed=None):
+    """Return the song, title, seed and ETag for a request.
+
+    Songs without a seed come from the pool when it has one ready and get a
+    new seed otherwise. Only songs asked for by seed have an ETag.
+    """
+    if seed is not None:
+        song, title, etag = make_seeded_song(album=album, title=title, seed=seed)
+        return song, title, seed, etag
+    pooled = song_pool.get(album)
+    if pooled is not None:
+        song, generated_title, seed = pooled
+        return song, title or generated_title, seed, None
+    seed = new_seed()
+    song, title, _ = make_seeded_song(album=album, title=title, seed=seed)
+    return song, title, seed, None
+
+
+def patch_song_headers(response, etag, public=False):
+    """Send the ETag of a song for a seed, which browsers, or any cache if public, can keep."""
+    response['ETag'] = quote_etag(etag)
+    if public:
+        patch_cache_control(response, public=True, max_age=settings.SONG_CACHE_TIMEOUT)
+    else:
+        patch_cache_control(response, private=True, max_age=settings.SONG_CACHE_TIMEOUT)
+
+
+def not_modified(request, album, title, seed, public=False):
+    """A 304 if the client already has the song for a seed, checked before generating it."""
+    if seed is None:
+        return None
+    etag = song_etag(album, title, seed, make_markov_chain(album).version)
+    try:
+        etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    except ValueError:
+        # A malformed header matches nothing, as in get_conditional_response
+        return None
+    if etag not in etags:
+        return None
+    response = HttpResponseNotModified()
+    patch_song_headers(response, etag, public=public)
+    return response
+
+
+def make_pooled_song(album=None):
+    seed = new_seed()
+    song, title, _ = make_seeded_song(album=album, seed=seed)
+    return song, title, seed
+
+
+# Chain shared with the processes forked by make_songs
+_bulk_chain = None
+
+
+def _make_bulk_song(album):
+    song = make_song(lyrics_generator=_bulk_chain)
+    return {'title': make_title(song), 'lyrics': song, 'album': album}
+
+
+def make_songs(count, album=None, workers=1):
+    """Generate many songs, yielding a dict with the title and lyrics of each.
 
+    The chain is built once and shared copy-on-write with a pool of forked
+    worker processes when more than one worker is requested.
+    """
+    global _bulk_chain
+    _bulk_chain = make_markov_chain(album)
+    try:
+        if workers <= 1:
+            for _ in range(count):
+                yield _make_bulk_song(album)
+        else:
+            # Workers only use the inherited chain and never touch the database
+            context = multiprocessing.get_context('fork')
+            with context.Pool(workers, initializer=random.seed) as worker_pool:
+                chunksize = max(1, min(100, count // (workers * 4)))
+                yield from worker_pool.imap_unordered(
+                    _make_bulk_song, itertools.repeat(album, count), chunksize)
+    finally:
+        _bulk_chain = None
+
+
+song_pool = pool.SongPool(
+    make_pooled_song, size=settings.SONG_POOL_SIZE, interval=settings.SONG_POOL_INTERVAL)
+
+
+def make_save_token(title, song):
+    """Sign a generated song so it can be saved without keeping it on the server."""
+    return signing.dumps([title, song], salt=SAVE_TOKEN_SALT, compress=True)
+
+
+def read_save_token(token):
+    """Return the title and lyrics from a save token, or None if it isn't valid.
+
+    Tokens expire once the pages they were sent in can no longer be cached,
+    so one leaked from a cached page can't be replayed forever.
+    """
+    try:
+        title, song = signing.loads(
+            token, salt=SAVE_TOKEN_SALT, max_age=settings.SONG_CACHE_TIMEOUT)
+    except (signing.SignatureExpired, signing.BadSignature, TypeError, ValueError):
+        return None
+    if not (isinstance(title, str) and isinstance(song, str) and title and song):
+        return None
+    return title, song
+
+
+class SongForm(forms.Form):
+    """Choices for song generation.
 
-class SongForm(forms.ModelForm):
-    """Choices for song generation."""
+    The albums are listed from the cache rather than the database, since
+    they only change when songs are synced, and only when the album field
+    is used.
+    """
 
-    class Meta:
-        model = models.Song
-        fields = ('album', 'title')
+    album = forms.ChoiceField(required=False, label='Generate Based on an Album')
+    title = forms.CharField(
+        max_length=255, required=False, label='Generate Based on a Title')
+    seed = forms.IntegerField(
+        required=False, min_value=0, max_value=MAX_SEED - 1, widget=forms.HiddenInput)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields['album'].empty_label = 'Select an album...'
-        self.fields['album'].label = 'Generate Based on an Album'
-        self.fields['album'].to_field_name = 'slug'
-        self.fields['title'].label = "Generate Based on a Title"
-        self.fields['album'].required = False
-        self.fields['title'].required = False
+        self.fields['album'].choices = lambda: (
+            [('', 'Select an album...')] + list(self.albums.items()))
+
+    @cached_property
+    def albums(self):
+        """Titles of the albums by slug."""
+        return collections.OrderedDict(pages.album_choices())
 
 
 def song_generator(request):
     """Generate a new song."""
     album = None
     title = None
+    seed = None
     context = {
         'song': '',
         'title': '',
     }
     if request.method == 'POST':
-        title = request.session.get('title')
-        song = request.session.get('song')
-        if title and song:
+        saved = read_save_token(request.POST.get('token', ''))
+        if saved is not None:
+            title, song = saved
             new_song = models.UserSong.objects.create(title=title, lyrics=song)
             return redirect(new_song)
     form = SongForm(request.GET)
     if form.is_valid():
-        album = form.cleaned_data['album']
+        slug = form.cleaned_data['album']
+        album = form.albums[slug] if slug else None
         title = form.cleaned_data['title'] or None
-    song = make_song(album=album.title if album else None)
+        seed = form.cleaned_data['seed']
+    query = {}
+    if album:
+        query['album'] = slug
+    if title:
+        query['title'] = title
+    response = not_modified(request, album, title, seed)
+    if response is not None:
+        return response
+    song, title, seed, etag = get_song(album=album, title=title, seed=seed)
     context['song'] = song
-    context['title'] = title or make_title(song)
+    context['title'] = title
+    context['seed'] = seed
+    context['shuffle_url'] = '?{}'.format(urlencode(dict(query, seed=shuffle_seed(seed))))
     context['form'] = form
-    request.session['title'] = context['title']
-    request.session['song'] = song
-    return render(request, 'taytay/song-generator.html', context)
+    context['save_token'] = make_save_token(title, song)
+    with timing.phase('render'):
+        response = render(request, 'taytay/song-generator.html', context)
+    if etag is not None:
+        patch_song_headers(response, etag)
+    return response
+
+
+class SongRequestForm(forms.Form):
+    """Choices for generating or saving a song through the API."""
+
+    album = forms.SlugField(required=False)
+    title = forms.CharField(required=False, max_length=255)
+    seed = forms.IntegerField(required=False, min_value=0, max_value=MAX_SEED - 1)
+
+    def clean_album(self):
+        """Look up the title of the album by its slug in the cached album choices."""
+        slug = self.cleaned_data['album']
+        if not slug:
+            return None
+        title = dict(pages.album_choices()).get(slug)
+        if title is None:
+            raise forms.ValidationError('Unknown album.')
+        return title
+
+
+def song_payload(song, title, seed, album_slug):
+    stanzas = [stanza.strip().splitlines() for stanza in song.split("\n \n")]
+    return {
+        'title': title,
+        'stanzas': [stanza for stanza in stanzas if stanza],
+        'seed': seed,
+        'album': album_slug or None,
+    }
+
+
+def json_response(data, **kwargs):
+    return JsonResponse(data, json_dumps_params={'separators': (',', ':')}, **kwargs)
+
+
+@require_GET
+def api_generate(request):
+    """Generate a song as JSON without using the session or templates."""
+    form = SongRequestForm(request.GET)
+    if not form.is_valid():
+        return json_response({'errors': form.errors}, status=400)
+    album, title, seed = (form.cleaned_data[name] for name in ('album', 'title', 'seed'))
+    title = title or None
+    response = not_modified(request, album, title, seed, public=True)
+    if response is not None:
+        return response
+    song, title, seed, etag = get_song(album=album, title=title, seed=seed)
+    response = json_response(song_payload(song, title, seed, request.GET.get('album')))
+    if etag is not None:
+        patch_song_headers(response, etag, public=True)
+    return response
+
+
+@csrf_exempt
+@require_POST
+def api_save_song(request):
+    """Save a song generated through the API by its album, title and seed.
+
+    The song is generated again from the seed rather than taken from the
+    request, so only songs that could have been generated can be saved.
+    """
+    form = SongRequestForm(request.POST)
+    if form.is_valid() and form.cleaned_data['seed'] is None:
+        form.add_error('seed', 'This field is required.')
+    if not form.is_valid():
+        return json_response({'errors': form.errors}, status=400)
+    song, title, _ = make_seeded_song(
+        album=form.cleaned_data['album'], title=form.cleaned_data['title'] or None,
+        seed=form.cleaned_data['seed'])
+    new_song = models.UserSong.objects.create(title=title, lyrics=song)
+    return json_response({
+        'slug': new_song.slug,
+        'title': new_song.title,
+        'url': request.build_absolute_uri(new_song.get_absolute_url()),
+    }, status=201)
 
 
 def song_detail(request, slug):
-    """Show the details of a saved song."""
-    song = get_object_or_404(models.UserSong, slug=slug)
-    context = {'song': song}
-    return render(request, 'taytay/song-detail.html', context)
+    """Show the details of a saved song, rendered once and then served from the cache."""
+    key = pages.detail_key(slug)
+    page = cache.get(key)
+    if page is None:
+        song = get_object_or_404(models.UserSong, slug=slug)
+        context = {'song': song}
+        with timing.phase('render'):
+            response = render(request, 'taytay/song-detail.html', context)
+        page = pages.CachedPage.from_response(
+            response, last_modified=calendar.timegm(song.created_date.utctimetuple()))
+        cache.set(key, page, settings.SONG_PAGE_TIMEOUT)
+    return page.respond(request, max_age=settings.SONG_PAGE_TIMEOUT)
+
+
+class SearchForm(forms.Form):
+    """Search terms and which songs to search."""
+
+    q = forms.CharField(max_length=100, label='Search for')
+    source = forms.ChoiceField(
+        choices=(('saved', 'Saved songs'), ('lyrics', 'Taylor Swift songs')), required=False)
+
+
+SEARCH_MODELS = {'saved': models.UserSong, 'lyrics': models.Song}
+
+
+def search_songs(request):
+    """Search saved songs or the source lyrics, loading more results after a cursor."""
+    form = SearchForm(request.GET or None)
+    context = {'form': form}
+    if form.is_valid():
+        terms = form.cleaned_data['q']
+        source = form.cleaned_data['source'] or 'saved'
+        try:
+            page = search.search(
+                SEARCH_MODELS[source], terms, request.GET.get('cursor'),
+                per_page=settings.SEARCH_PAGE_SIZE)
+        except ValueError:
+            raise Http404('Invalid cursor.')
+        if source == 'lyrics':
+            albums = dict(models.Album.objects.filter(
+                id__in=set(song.album_id for song in page)).values_list('id', 'title'))
+            for song in page:
+                song.album_title = albums[song.album_id]
+        context['source'] = source
+        context['songs'] = page.object_list
+        context['page_obj'] = page
+        if page.has_next():
+            context['next_url'] = '?{}'.format(
+                urlencode({'q': terms, 'source': source, 'cursor': page.next_cursor}))
+    with timing.phase('render'):
+        if request.is_ajax():
+            return render(request, 'taytay/_search-results.html', context)
+        return render(request, 'taytay/search.html', context)
 
 
 class HomepageView(TemplateView):
     template_name = 'homepage.html'
+    # Every template the page is rendered from, whose sources key the cached page
+    cache_templates = ('homepage.html', 'base.html')
+
+    def get(self, request, *args, **kwargs):
+        """Serve the page from the cache, rendering it again when its templates change."""
+        key = pages.homepage_key(self.cache_templates)
+        page = cache.get(key)
+        if page is None:
+            page = pages.CachedPage.from_response(super().get(request, *args, **kwargs))
+            cache.set(key, page, settings.HOMEPAGE_TIMEOUT)
+        return page.respond(request)
 
     def get_context_data(self, **kwargs):
         form = SongForm(label_suffix="")
@@ -113,10 +470,38 @@ class HomepageView(TemplateView):
 
 
 class SongListView(ListView):
-    queryset = models.UserSong.objects.order_by('title')
+    # The cards only show the preview, not the full lyrics
+    queryset = models.UserSong.objects.only('title', 'slug', 'preview')
     context_object_name = 'songs'
-    allow_empty = False
     paginate_by = 24
+    # Matches the index on UserSong, with the unique id last to break ties
+    ordering = ('title', 'id')
+
+    def paginate_queryset(self, queryset, page_size):
+        """Page after the cursor in the query string, raising 404 for an empty page."""
+        try:
+            page = pagination.paginate(
+                queryset, self.ordering, self.request.GET.get('cursor'), page_size)
+        except ValueError:
+            raise Http404('Invalid cursor.')
+        if not page.object_list:
+            raise Http404('No songs found.')
+        return (None, page, page.object_list, page.has_next())
+
+    def get(self, request, *args, **kwargs):
+        """Serve the page from the cache until a song is saved or deleted.
+
+        Clients revalidate every time, since a new song changes the list.
+        """
+        key = pages.list_key(request.GET.get('cursor', ''), fragment=request.is_ajax())
+        page = cache.get(key)
+        if page is None:
+            page = pages.CachedPage.from_response(super().get(request, *args, **kwargs))
+            cache.set(key, page, settings.SONG_LIST_TIMEOUT)
+        response = page.respond(request)
+        # The page and the fragment loaded by taytay.js have the same URL
+        patch_vary_headers(response, ['X-Requested-With'])
+        return response
 
     def get_template_names(self):
         if self.request.is_ajax():
@@ -19,3 +19,7 @@ from whitenoise.django import DjangoWhiteNoise
 dotenv.read_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'taytay.settings')
 application = DjangoWhiteNoise(get_wsgi_application())
+
+from taytay import chains  # noqa
+
+chains.preload()